@@ -2,9 +2,11 @@ from fastapi import APIRouter
 
 from app.tasks.cron_tasks import queue_user_tasks, weekly_suggestions
 from app.db.supabase import supabase
-from app.tasks.check_song_expiry import check_song_expiry
+from app.tasks.check_song_expiry import check_song_expiry, expire_deleted_songs
 from app.tasks.suggestion_email import send_suggestion_email
 from app.core.config import settings
+from app.core.http import connection_stats
+from app.services.rate_limiter import spotify_limiter
 
 router = APIRouter(prefix="/test", tags=["test"])
 
@@ -42,4 +44,19 @@ async def test_check_song_expiry():
     for playlist in playlists:
         task = check_song_expiry.delay(user.id, playlist.id)
         task_ids.append(task.id)
-    return {"message": "Tasks queued", "task_ids": task_ids}
\ No newline at end of file
+    return {"message": "Tasks queued", "task_ids": task_ids}
+
+@router.get("/expire_deleted_songs")
+async def test_expire_deleted_songs():
+    task = expire_deleted_songs.delay()
+    return {"message": "Task queued", "task_id": task.id}
+
+
+@router.get("/spotify_rate_limit")
+async def test_spotify_rate_limit():
+    return spotify_limiter.usage()
+
+
+@router.get("/http_stats")
+async def test_http_stats():
+    return connection_stats()
@@ -1,5 +1,8 @@
-from celery import Celery
+from celery import Celery, signals
 from app.core.config import settings
+from app.core.logging import flush_logs
+from app.core.metrics import instrument_celery
+from app.core.profiling import instrument_task_timings
 from celery.schedules import crontab
 celery_app = Celery("app")
 # celery_app.config_from_object('app.core.celery_config')
@@ -11,16 +14,33 @@ celery_app.conf.result_serializer = 'json'
 celery_app.conf.accept_content = ['json']
 celery_app.conf.timezone = 'UTC'
 
+instrument_celery()
+instrument_task_timings()
+# Pool processes exit without running atexit hooks, which would lose the last queued log records
+signals.worker_process_shutdown.connect(lambda **kwargs: flush_logs(), weak=False)
+
 celery_app.conf.task_routes = {
     "app.tasks.cron_tasks.*": {"queue": "cron_tasks"},
     "app.tasks.*": {"queue": "default"},
 }
 
 celery_app.conf.beat_schedule = {
+    "refresh-spotify-tokens-before-snapshots": {
+        "task": "app.tasks.cron_tasks.refresh_expiring_tokens",
+        "schedule": crontab(minute=55, hour='11,23'),
+    },
     "update-spotify-data-every-12-hours": {
         "task": "app.tasks.cron_tasks.queue_user_tasks",
         "schedule": crontab(minute=0, hour='0,12'),
     },
+    "refresh-taste-profiles-daily": {
+        "task": "app.tasks.cron_tasks.refresh_taste_profiles",
+        "schedule": crontab(minute=0, hour=3),
+    },
+    "expire-deleted-songs-daily": {
+        "task": "app.tasks.check_song_expiry.expire_deleted_songs",
+        "schedule": crontab(minute=30, hour=6),
+    },
     "weekly-suggestions-friday-9am": {
         "task": "app.tasks.cron_tasks.weekly_suggestions",
         "schedule": crontab(minute=0, hour=9, day_of_week=5),
@@ -19,6 +19,98 @@ class Settings(BaseSettings):
     TEST_USER_ID: Optional[str] = None
     JWT_ALGORITHM: str = "HS256"
     DEFAULT_FROM_EMAIL: str = "no-reply@trackkeeper.app"
+    # "resend" sends for real, "recording" keeps messages in memory for tests and local runs
+    EMAIL_TRANSPORT: str = "resend"
+    # weekly_suggestions sends through Resend's batch API, one task per EMAIL_BATCH_SIZE users
+    EMAIL_BATCH_ENABLED: bool = True
+    EMAIL_BATCH_SIZE: int = 100
+    EMAIL_BATCH_CONCURRENCY: int = 2  # Batch calls in flight per task
+    EMAIL_BUILD_CONCURRENCY: int = 8  # Users whose emails are prepared at once per task
+    EMAIL_SEND_RETRIES: int = 3
+    EMAIL_RETRY_BACKOFF_SECONDS: float = 1
+    # Resend's API rate limit, shared by all workers through Redis
+    RESEND_RATE_LIMIT_PER_SECOND: float = 2
+    RESEND_RATE_LIMIT_BURST: int = 2
+    # Longest a send waits for a token before failing, instead of holding the worker
+    RESEND_MAX_WAIT_SECONDS: int = 30
+    SPOTIFY_PAGE_CONCURRENCY: int = 4
+    # Web API base URL, pointed at a local fake by the load test harness
+    SPOTIFY_API_URL: str = "https://api.spotify.com/v1/"
+    # Full snapshot every N snapshots, add/remove deltas in between
+    SNAPSHOT_KEYFRAME_INTERVAL: int = 10
+    # Keyframe format, "json" (gzip JSON) or "binary" (sorted id array, see snapshot_codec).
+    # Binary only pays off for id diffs, whole-file decodes are slower and the files larger than JSON
+    SNAPSHOT_FORMAT: str = "json"
+    # Diff in the take_snapshot task instead of queueing diff_snapshots
+    SNAPSHOT_FUSED_DIFF: bool = True
+    # Worker-local LRU disk cache for snapshot files, they are never modified
+    SNAPSHOT_CACHE_ENABLED: bool = True
+    SNAPSHOT_CACHE_DIR: str = "/tmp/trackkeeper/snapshots"
+    SNAPSHOT_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    # JSON keyframes are compressed page by page in memory, then in a temp file once they pass this size
+    SNAPSHOT_SPOOL_MAX_BYTES: int = 1024 * 1024
+    SNAPSHOT_SPOOL_DIR: str = "/tmp/trackkeeper/spool"
+    # Redis cache for Spotify entities shared across users, with an in-process L1
+    ENTITY_CACHE_ENABLED: bool = True
+    ENTITY_CACHE_TTL_SECONDS: int = 7 * 24 * 60 * 60
+    ENTITY_CACHE_L1_SIZE: int = 10000
+    ENTITY_CACHE_L1_TTL_SECONDS: int = 300
+    # Pooled keep-alive HTTP connections, per worker process
+    HTTP_POOL_CONNECTIONS: int = 4  # Hosts kept in the Spotify session
+    HTTP_POOL_MAXSIZE: int = 16  # Connections per host, at least page concurrency x user concurrency
+    SUPABASE_MAX_CONNECTIONS: int = 20
+    SUPABASE_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    HTTP_KEEPALIVE_EXPIRY_SECONDS: float = 60
+    # Spotify tokens are refreshed this long before they expire
+    TOKEN_EXPIRY_MARGIN_SECONDS: int = 120
+    TOKEN_LOCK_TIMEOUT_SECONDS: int = 30
+    # Pre-cron sweep, refreshes tokens expiring within the window (Spotify tokens last an hour)
+    TOKEN_SWEEP_WINDOW_SECONDS: int = 50 * 60
+    TOKEN_SWEEP_CONCURRENCY: int = 8
+    # Cluster-wide Spotify API budget, shared by all workers through Redis
+    SPOTIFY_RATE_LIMIT_PER_SECOND: float = 10
+    SPOTIFY_RATE_LIMIT_BURST: int = 20
+    # 429s are retried in place up to this many times, longer Retry-After waits reschedule the task
+    SPOTIFY_RATE_LIMIT_RETRIES: int = 3
+    SPOTIFY_MAX_RETRY_AFTER_SECONDS: int = 30
+    # Snapshot jobs are spread over the 12 hours between queue_user_tasks runs
+    SCHEDULER_WINDOW_SECONDS: int = 12 * 60 * 60
+    SCHEDULER_SLOT_SECONDS: int = 5 * 60
+    # Planned API calls per minute, kept under the rate limit to leave room for retries and other tasks
+    SCHEDULER_CALLS_PER_MINUTE: int = 300
+    # Cost estimate for playlists that have never been snapshotted
+    SCHEDULER_DEFAULT_SONG_COUNT: int = 500
+    # Playlists of one user snapshotted at once by snapshot_user, 1 runs them in order
+    SNAPSHOT_USER_CONCURRENCY: int = 1
+    # "sync" queues a snapshot_user task per user, "async" one snapshot_users_async task per scheduler slot
+    SNAPSHOT_ENGINE: str = "sync"
+    # Async engine, per process: Spotify requests in flight and threads for the database, storage and diff steps
+    ASYNC_SNAPSHOT_CONCURRENCY: int = 32
+    ASYNC_SNAPSHOT_THREADS: int = 16
+    # Removed tracks are scored for suggestion emails at diff time, against a taste profile refreshed this often
+    SUGGESTION_PRECOMPUTE_ENABLED: bool = True
+    TASTE_PROFILE_MAX_AGE_DAYS: int = 7
+    TASTE_PROFILE_REFRESH_SPREAD_SECONDS: int = 6 * 60 * 60
+    # Learned snapshot cadence: aim for this many changes per snapshot, within the interval bounds
+    SNAPSHOT_CADENCE_TARGET_CHANGES: float = 1
+    SNAPSHOT_CADENCE_HALF_LIFE_DAYS: float = 14
+    SNAPSHOT_MIN_INTERVAL_HOURS: int = 12
+    SNAPSHOT_MAX_INTERVAL_HOURS: int = 7 * 24
+    # Prometheus: the worker serves /metrics on this port (0 disables), pool processes share samples
+    # through PROMETHEUS_MULTIPROC_DIR, which the worker clears when it starts
+    CELERY_METRICS_PORT: int = 9808
+    PROMETHEUS_MULTIPROC_DIR: Optional[str] = None
+    # Tasks log one record of the time spent per phase (fetch, upload, diff, ...). A TASK_PROFILE_SAMPLE_RATE
+    # share of tasks also runs under TASK_PROFILER, "cprofile" or "tracemalloc", with results in TASK_PROFILE_DIR
+    TASK_TIMINGS_ENABLED: bool = True
+    TASK_PROFILER: str = "cprofile"
+    TASK_PROFILE_SAMPLE_RATE: float = 0
+    TASK_PROFILE_DIR: str = "/tmp/trackkeeper/profiles"
+    # Log records are formatted and written by a background thread, records beyond the queue are dropped.
+    # INFO and DEBUG lines are limited per call site (file and line), e.g. the per-page logs of big libraries
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_RATE_LIMIT_PER_SECOND: float = 5
+    LOG_RATE_LIMIT_BURST: int = 20
 
     model_config = SettingsConfigDict(env_file="../../.env")
 
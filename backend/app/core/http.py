@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+import requests
+import urllib3
+
+from app.core.config import settings
+from app.core.metrics import SUPABASE_REQUEST_SECONDS, supabase_table
+
+# 429 is left to RateLimitedSpotify, which honours Retry-After across workers
+SPOTIFY_STATUS_FORCELIST = (500, 502, 503, 504)
+
+_lock = threading.Lock()
+_spotify_session: Optional[requests.Session] = None
+_spotify_session_pid: Optional[int] = None
+_supabase_transports: Dict[str, "PooledTransport"] = {}
+
+
+def spotify_session() -> requests.Session:
+    """
+    Keep-alive session shared by every Spotify client in this process, for both
+    the Web API and the accounts (token) endpoint. Sessions are per process: a
+    Celery worker child builds its own rather than reusing sockets opened before
+    the fork.
+    """
+    global _spotify_session, _spotify_session_pid
+    with _lock:
+        if _spotify_session is None or _spotify_session_pid != os.getpid():
+            retry = urllib3.Retry(
+                total=3,
+                connect=None,
+                read=False,
+                allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                status=3,
+                backoff_factor=0.3,
+                status_forcelist=SPOTIFY_STATUS_FORCELIST,
+                # urllib3 otherwise retries any 429 that carries a Retry-After header itself
+                respect_retry_after_header=False)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+                max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _spotify_session = session
+            _spotify_session_pid = os.getpid()
+        return _spotify_session
+
+
+class PooledTransport(httpx.HTTPTransport):
+    """
+    httpx transport that counts requests and newly opened connections, to report
+    connection reuse, and records request latency per table
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = 0
+        self.connections = 0
+
+    def _trace(self, event_name: str, info: Dict):
+        if event_name == 'connection.connect_tcp.complete':
+            self.connections += 1
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        request.extensions['trace'] = self._trace
+        started = time.perf_counter()
+        try:
+            return super().handle_request(request)
+        finally:
+            SUPABASE_REQUEST_SECONDS.labels(supabase_table(request.url.path), request.method).observe(
+                time.perf_counter() - started)
+
+
+def _pooled_client(name: str, client: httpx.Client) -> httpx.Client:
+    """Copy of an httpx client from the supabase library, on a tuned and instrumented pool"""
+    transport = PooledTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=settings.SUPABASE_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.SUPABASE_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY_SECONDS))
+    _supabase_transports[name] = transport
+    return httpx.Client(base_url=client.base_url, headers=client.headers, timeout=client.timeout,
+                        follow_redirects=True, transport=transport)
+
+
+def _swap_clients(supabase_client):
+    postgrest = supabase_client.postgrest
+    postgrest.session = _pooled_client('supabase_rest', postgrest.session)
+    storage = supabase_client.storage
+    storage.session = storage._client = _pooled_client('supabase_storage', storage.session)
+
+
+def use_pooled_clients(supabase_client):
+    """Swaps the REST and Storage httpx clients of a supabase client for pooled ones"""
+    _swap_clients(supabase_client)
+    # Connections opened before a fork must not be shared with the child. The old
+    # clients are dropped rather than closed, closing would also shut the parent's sockets.
+    os.register_at_fork(after_in_child=lambda: _swap_clients(supabase_client))
+
+
+def _reuse(requests_sent: int, connections: int) -> Dict:
+    return {
+        "requests": requests_sent,
+        "connections": connections,
+        "reuse_ratio": round(1 - connections / requests_sent, 4) if requests_sent else 0
+    }
+
+
+def connection_stats() -> Dict[str, Dict]:
+    """Requests sent and connections opened by this process, per client"""
+    stats = {}
+    if _spotify_session is not None and _spotify_session_pid == os.getpid():
+        requests_sent = connections = 0
+        for adapter in set(_spotify_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+        stats['spotify'] = _reuse(requests_sent, connections)
+
+    for name, transport in _supabase_transports.items():
+        stats[name] = _reuse(transport.requests, transport.connections)
+    return stats
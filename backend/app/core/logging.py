@@ -1,40 +1,213 @@
-import logging
+import atexit
 import json
+import logging
+import os
+import queue
 import sys
-from typing import Any, Dict
-from datetime import datetime
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard library encoder is used without it
+    orjson = None
+
+# Attributes every LogRecord has, anything else on a record came in through extra=
+RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_json_encoder = json.JSONEncoder(default=str)
+
+
+def dumps(obj: Dict[str, Any]) -> str:
+    """JSON for a log line, values that aren't JSON types are written as str()"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+        except TypeError:  # orjson.JSONEncodeError, e.g. ints wider than 64 bits
+            pass
+    return _json_encoder.encode(obj)
+
+
+def loads(text: str) -> Any:
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
 
 class JSONFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__()
+        # Records in the same second share the formatted date and time
+        self._second = None
+        self._second_text = ''
+
+    def _timestamp(self, created: float) -> str:
+        second = int(created)
+        if second != self._second:
+            self._second_text = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._second = second
+        return f"{self._second_text}.{int((created - second) * 1000000):06d}"
+
     def format(self, record: logging.LogRecord) -> str:
         log_obj: Dict[str, Any] = {
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": self._timestamp(record.created),
             "level": record.levelname,
             "message": record.getMessage(),
             "module": record.module,
             "function": record.funcName,
             "line": record.lineno
         }
-        
-        # Add extra fields if they exist
-        if hasattr(record, "extra"):
-            log_obj.update(record.extra)
-            
+
+        # Fields passed with extra= are set as attributes of the record
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_ATTRS:
+                log_obj[key] = value
+
         # Add exception info if it exists
         if record.exc_info:
-            log_obj["exception"] = self.formatException(record.exc_info)
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            log_obj["exception"] = record.exc_text
+        if record.stack_info:
+            log_obj["stack"] = self.formatStack(record.stack_info)
+
+        return dumps(log_obj)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per call site (file and line), so a log line in a hot loop
+    is written at most rate times per second after a burst of capacity.
+    Warnings and errors always pass. The next record written from a call site
+    carries how many of its records were dropped as "suppressed".
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        super().__init__()
+        self.rate = rate
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # (pathname, lineno) -> [tokens, updated_at, suppressed]
+        self.buckets: Dict[Tuple[str, int], List[float]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.capacity, now, 0]
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread, which formats and writes them. The
+    message and the extra fields are rendered here, so later changes to the
+    objects passed don't show up, tracebacks are formatted on the listener
+    thread. When the queue is full records are dropped rather than blocking.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        extras = {key: value for key, value in record.__dict__.items() if key not in RESERVED_ATTRS}
+        if extras:
+            # Callers may change or reuse what they passed once the call returns, the
+            # listener gets the JSON values as they are now
+            record.__dict__.update(loads(dumps(extras)))
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room rather than failing to stop when the queue is full
+        self.queue.put(self._sentinel)
+
+
+_lock = threading.Lock()
+_handler: Optional[BackgroundQueueHandler] = None
+_listener: Optional[QueueListener] = None
+
+
+def _start_listener():
+    global _listener
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+    _listener = _Listener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_in_child():
+    # The listener thread doesn't survive a fork, and the queue's lock may have
+    # been held by another thread when it happened
+    if _handler is not None:
+        _handler.queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+        _start_listener()
+
+
+def queue_handler() -> BackgroundQueueHandler:
+    """The process-wide handler every logger from setup_logging writes to, started on first use"""
+    global _handler
+    with _lock:
+        if _handler is None:
+            _handler = BackgroundQueueHandler(queue.Queue(maxsize=settings.LOG_QUEUE_SIZE))
+            _start_listener()
+            atexit.register(flush_logs)
+            os.register_at_fork(after_in_child=_restart_in_child)
+        return _handler
+
+
+def flush_logs():
+    """Writes out every queued record and stops the listener, e.g. before a process exits"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
 
-        return json.dumps(log_obj)
 
-def setup_logging(service_name: str, log_level: str = "INFO") -> logging.Logger:
+def setup_logging(service_name: str, log_level: str = "INFO", rate_limit: Optional[float] = None,
+                  burst: Optional[int] = None) -> logging.Logger:
+    """
+    JSON logger that formats and writes on a background thread. INFO and DEBUG
+    records are rate limited per call site, rate_limit=0 turns that off.
+    """
     logger = logging.getLogger(service_name)
     logger.setLevel(log_level)
 
     # Remove existing handlers
     logger.handlers.clear()
+    for existing in [f for f in logger.filters if isinstance(f, RateLimitFilter)]:
+        logger.removeFilter(existing)
 
-    # Create console handler
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(JSONFormatter())
-    logger.addHandler(handler)
+    rate_limit = settings.LOG_RATE_LIMIT_PER_SECOND if rate_limit is None else rate_limit
+    if rate_limit > 0:
+        logger.addFilter(RateLimitFilter(rate_limit, burst or settings.LOG_RATE_LIMIT_BURST))
+    logger.addHandler(queue_handler())
 
-    return logger
\ No newline at end of file
+    return logger
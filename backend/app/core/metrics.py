@@ -0,0 +1,165 @@
+"""
+Prometheus metrics for the API, the Celery workers and the Spotify client.
+
+With PROMETHEUS_MULTIPROC_DIR set, every process writes its samples to files in
+that directory and metrics_registry() adds them up, which is how the children
+of the prefork pool are scraped through the one endpoint the worker serves.
+"""
+import os
+import shutil
+import threading
+import time
+from typing import Dict, Union
+from urllib.parse import urlsplit
+
+from app.core.config import settings
+from app.core.logging import setup_logging
+
+# prometheus_client picks its value storage on import, so a directory that only
+# comes from the .env file has to be in the environment first
+if settings.PROMETHEUS_MULTIPROC_DIR:
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', settings.PROMETHEUS_MULTIPROC_DIR)
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,  # noqa: E402
+                               Histogram, generate_latest, multiprocess, start_http_server)
+
+logger = setup_logging("metrics")
+
+# Spotify paths that start with one of these alternate collection and id, e.g. playlists/{id}/tracks
+SPOTIFY_ID_COLLECTIONS = {'albums', 'artists', 'audio-features', 'episodes', 'playlists', 'shows',
+                          'tracks', 'users'}
+
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+TASK_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+SPOTIFY_REQUESTS = Counter(
+    'spotify_requests_total', 'Spotify Web API requests, 429s and retries counted separately',
+    ['endpoint', 'method', 'status'])
+SPOTIFY_REQUEST_SECONDS = Histogram(
+    'spotify_request_duration_seconds', 'Spotify Web API request latency, excluding rate limiter waits',
+    ['endpoint', 'method'])
+SPOTIFY_TOKEN_REFRESHES = Counter(
+    'spotify_token_refreshes_total', 'Spotify access token refreshes', ['result'])
+SNAPSHOT_PAGES = Histogram(
+    'snapshot_pages', 'Spotify pages fetched per snapshot', ['source'], buckets=COUNT_BUCKETS[1:])
+SNAPSHOT_BYTES = Histogram(
+    'snapshot_bytes', 'Snapshot file size, before (raw, JSON only) and after (stored) compression',
+    ['format', 'kind', 'stage'], buckets=BYTES_BUCKETS)
+SNAPSHOT_LOAD_SECONDS = Histogram(
+    'snapshot_load_duration_seconds', 'load_snapshot, load_snapshot_order and load_snapshot_ids latency, deltas replayed',
+    ['what'])
+SNAPSHOT_DIFF_TRACKS = Histogram(
+    'snapshot_diff_tracks', 'Tracks added and removed between consecutive snapshots', ['change'],
+    buckets=COUNT_BUCKETS)
+SUPABASE_REQUEST_SECONDS = Histogram(
+    'supabase_request_duration_seconds', 'Supabase REST and Storage request latency', ['table', 'method'])
+CELERY_TASK_SECONDS = Histogram(
+    'celery_task_duration_seconds', 'Celery task run time, from task_prerun to task_postrun',
+    ['task', 'state'], buckets=TASK_BUCKETS)
+
+_task_started: Dict[str, float] = {}
+_task_started_lock = threading.Lock()
+
+
+def is_multiprocess() -> bool:
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+
+def metrics_registry() -> CollectorRegistry:
+    """Registry to export: every process's samples in multiprocess mode, otherwise this process's"""
+    if not is_multiprocess():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics():
+    """Body and content type of a scrape"""
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
+
+
+def spotify_endpoint(url: str) -> str:
+    """Web API path with ids replaced, e.g. playlists/{id}/tracks, so labels stay bounded"""
+    path = urlsplit(url).path
+    if '/v1/' in path:
+        path = path.split('/v1/', 1)[1]
+    segments = [segment for segment in path.split('/') if segment]
+    if segments and segments[0] in SPOTIFY_ID_COLLECTIONS:
+        segments[1::2] = ['{id}'] * len(segments[1::2])
+    return '/'.join(segments) or '/'
+
+
+def supabase_table(path: str) -> str:
+    """Table (or rpc function) of a PostgREST request path, "storage" for the Storage API"""
+    segments = [segment for segment in path.split('/') if segment]
+    if len(segments) >= 3 and segments[0] == 'rest':
+        return '/'.join(segments[2:4]) if segments[2] == 'rpc' else segments[2]
+    if segments and segments[0] == 'storage':
+        return 'storage'
+    return 'other'
+
+
+def observe_spotify_request(url: str, method: str, status: Union[int, str, None], started: float):
+    """
+    Records one request, status None for a failed connection. Success codes are
+    all labelled 2xx, spotipy hides them, so its client passes '2xx' as the status
+    """
+    endpoint = spotify_endpoint(url)
+    if status is None:
+        label = 'error'
+    elif isinstance(status, str):
+        label = status
+    else:
+        label = '2xx' if 200 <= status < 300 else str(status)
+    SPOTIFY_REQUESTS.labels(endpoint, method, label).inc()
+    SPOTIFY_REQUEST_SECONDS.labels(endpoint, method).observe(time.perf_counter() - started)
+
+
+def observe_snapshot_pages(source: str, items: int, limit: int):
+    SNAPSHOT_PAGES.labels(source).observe(max(1, -(-items // limit)))
+
+
+def _task_prerun(task_id=None, **kwargs):
+    with _task_started_lock:
+        _task_started[task_id] = time.perf_counter()
+
+
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    with _task_started_lock:
+        started = _task_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_SECONDS.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - started)
+
+
+def _worker_init(**kwargs):
+    """Runs in the worker's main process before the pool starts"""
+    if is_multiprocess():
+        # Files of a previous run would be added to this one's counters
+        directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+    if settings.CELERY_METRICS_PORT:
+        if not is_multiprocess():
+            logger.warning("PROMETHEUS_MULTIPROC_DIR is not set, pool processes' metrics are not exported")
+        start_http_server(settings.CELERY_METRICS_PORT, registry=metrics_registry())
+        logger.info(f"Serving metrics on port {settings.CELERY_METRICS_PORT}",
+                    extra={"port": settings.CELERY_METRICS_PORT})
+
+
+def _worker_process_shutdown(pid=None, **kwargs):
+    if is_multiprocess():
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+def instrument_celery():
+    """Times every task and, in the worker, serves /metrics on CELERY_METRICS_PORT"""
+    from celery import signals
+
+    signals.task_prerun.connect(_task_prerun, weak=False)
+    signals.task_postrun.connect(_task_postrun, weak=False)
+    signals.worker_init.connect(_worker_init, weak=False)
+    signals.worker_process_shutdown.connect(_worker_process_shutdown, weak=False)
@@ -0,0 +1,213 @@
+"""
+Per-task phase timings and sampled profiling.
+
+Code marks where a task's time goes with `with phase('fetch'):`. Every Celery
+task that entered a phase logs one "Task timings" record when it finishes,
+with the seconds spent per phase and whatever annotate() added, e.g. the user.
+Phases are exclusive: time spent in a nested phase is not counted again in the
+enclosing one. Outside a task phase() does nothing.
+
+A TASK_PROFILE_SAMPLE_RATE share of tasks also runs under cProfile or
+tracemalloc (TASK_PROFILER), with the results written to TASK_PROFILE_DIR.
+"""
+import contextvars
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.logging import setup_logging
+
+# One record per task run, none of them may be rate limited away
+logger = setup_logging("task_timings", rate_limit=0)
+
+# Frames kept per tracemalloc allocation, more makes tracing slower
+TRACEMALLOC_FRAMES = 10
+
+_timings: contextvars.ContextVar[Optional['TaskTimings']] = contextvars.ContextVar('task_timings', default=None)
+# Seconds spent in phases nested in the current one, subtracted from its own time
+_nested: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar('task_phase_nested', default=None)
+_profiling = contextvars.ContextVar('task_profiling', default=False)
+# tracemalloc traces the whole process, so only one task at a time is sampled with it
+_tracemalloc_lock = threading.Lock()
+_running: Dict[str, Dict[str, Any]] = {}
+_running_lock = threading.Lock()
+
+
+class TaskTimings:
+    """Seconds and entries per phase of one task run, safe to add to from the task's threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+
+@contextmanager
+def phase(name: str):
+    """Times the block as phase name of the running task"""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    parent = _nested.get()
+    nested = [0.0]
+    token = _nested.set(nested)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _nested.reset(token)
+        if parent is not None:
+            parent[0] += elapsed
+        # Nested phases run in parallel threads can add up to more than the block took
+        timings.add(name, max(0.0, elapsed - nested[0]))
+
+
+def annotate(**fields):
+    """Adds fields to the running task's timings record"""
+    timings = _timings.get()
+    if timings is not None:
+        with timings.lock:
+            timings.fields.update(fields)
+
+
+def in_task_context(func: Callable) -> Callable:
+    """
+    Wraps func so it records into the calling task's timings when run on another
+    thread, e.g. by a ThreadPoolExecutor, which doesn't carry context variables over
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def _profile_path(task_name: str, task_id: str, suffix: str) -> str:
+    os.makedirs(settings.TASK_PROFILE_DIR, exist_ok=True)
+    return os.path.join(settings.TASK_PROFILE_DIR, f"{task_name.rsplit('.', 1)[-1]}-{task_id}{suffix}")
+
+
+def _start_profiler() -> Optional[Dict[str, Any]]:
+    """Starts the configured profiler for this task if it is sampled, returns its state"""
+    if not settings.TASK_PROFILE_SAMPLE_RATE or random.random() >= settings.TASK_PROFILE_SAMPLE_RATE:
+        return None
+    # Eagerly run tasks are profiled as part of the task that called them
+    if _profiling.get():
+        return None
+
+    if settings.TASK_PROFILER == 'tracemalloc':
+        if not _tracemalloc_lock.acquire(blocking=False):
+            return None
+        if tracemalloc.is_tracing():
+            _tracemalloc_lock.release()
+            return None
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        return {'kind': 'tracemalloc', 'token': _profiling.set(True)}
+
+    profiler = cProfile.Profile()
+    try:
+        # Only this thread is profiled, threads the task starts are not
+        profiler.enable()
+    except ValueError:  # Another profiler, e.g. a debugger, is active
+        return None
+    return {'kind': 'cprofile', 'profiler': profiler, 'token': _profiling.set(True)}
+
+
+def _stop_profiler(state: Dict[str, Any], task_name: str, task_id: str) -> Dict[str, Any]:
+    """Stops the profiler, writes its results and returns the fields for the timings record"""
+    _profiling.reset(state['token'])
+    if state['kind'] == 'tracemalloc':
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            _tracemalloc_lock.release()
+        # Read back with tracemalloc.Snapshot.load(path)
+        path = _profile_path(task_name, task_id, '.tracemalloc')
+        snapshot.dump(path)
+        return {'profile': path, 'peak_traced_bytes': peak}
+
+    profiler = state['profiler']
+    profiler.disable()
+    # Read back with pstats.Stats(path), or snakeviz
+    path = _profile_path(task_name, task_id, '.prof')
+    profiler.dump_stats(path)
+    return {'profile': path}
+
+
+def _task_prerun(task_id=None, task=None, **kwargs):
+    timings = TaskTimings()
+    run = {
+        'timings': timings,
+        'token': _timings.set(timings),
+        'nested_token': _nested.set(None),
+        'started': time.perf_counter(),
+        'profiler': _start_profiler(),
+    }
+    with _running_lock:
+        _running[task_id] = run
+
+
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    with _running_lock:
+        run = _running.pop(task_id, None)
+    if run is None:
+        return
+    duration = time.perf_counter() - run['started']
+    _nested.reset(run['nested_token'])
+    _timings.reset(run['token'])
+
+    timings = run['timings']
+    record = {}
+    if run['profiler']:
+        try:
+            record.update(_stop_profiler(run['profiler'], task.name, task_id))
+        except Exception as e:
+            logger.error(f"Error writing task profile: {e}", extra={"task": task.name, "task_id": task_id})
+    if not timings.phases and not record:
+        return
+
+    with timings.lock:
+        phases = {name: round(seconds, 4) for name, seconds in
+                  sorted(timings.phases.items(), key=lambda item: item[1], reverse=True)}
+        record.update({
+            **timings.fields,
+            'task': task.name,
+            'task_id': task_id,
+            'state': state,
+            'duration': round(duration, 4),
+            'phases': phases,
+            'phase_calls': dict(timings.calls),
+            # Time outside any phase, negative when phases ran in parallel threads
+            'unaccounted': round(duration - sum(timings.phases.values()), 4),
+        })
+    logger.info(f"Task timings {task.name.rsplit('.', 1)[-1]} {duration:.3f}s", extra=record)
+
+
+def instrument_task_timings():
+    """Hooks phase timings and sampled profiling into every task run"""
+    if not settings.TASK_TIMINGS_ENABLED:
+        return
+    from celery import signals
+
+    signals.task_prerun.connect(_task_prerun, weak=False)
+    signals.task_postrun.connect(_task_postrun, weak=False)
@@ -0,0 +1,6 @@
+import redis
+from app.core.config import settings
+
+# Short timeouts, callers treat Redis as an optional cache
+redis_client = redis.Redis.from_url(
+    settings.REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
@@ -1,4 +1,34 @@
+from typing import Any, Callable, Dict, List
+
 from supabase import create_client
 from app.core.config import settings
+from app.core.http import use_pooled_clients
+
+# PostgREST returns at most this many rows per request (max_rows)
+QUERY_PAGE_SIZE = 1000
+# Keeps in_ filters well within URL length limits
+IN_FILTER_BATCH_SIZE = 200
 
 supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+use_pooled_clients(supabase)
+
+
+def chunks(items: List, size: int = IN_FILTER_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def select_all(build_query: Callable[[], Any]) -> List[Dict]:
+    """
+    Every row of a query, fetched QUERY_PAGE_SIZE rows at a time. build_query
+    returns a new, ordered query for each page, so pages don't overlap.
+    """
+    rows = []
+    offset = 0
+    while True:
+        result = build_query().range(offset, offset + QUERY_PAGE_SIZE - 1).execute()
+        page = result.data or []
+        rows.extend(page)
+        if len(page) < QUERY_PAGE_SIZE:
+            return rows
+        offset += QUERY_PAGE_SIZE
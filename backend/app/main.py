@@ -1,9 +1,10 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 # from app.api.routes import spotify
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
 from app.api.routes import api, test
 from app.core.logging import setup_logging
+from app.core.metrics import render_metrics
 
 # TODO: Check if auth from web app transfers over to python backend
 # TODO: Do I need to have a POST endpoint from my supabase instance that sets stuff up for a user
@@ -52,6 +53,12 @@ async def health_check():
     return {"status": "success", "message": "Service is healthy"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -10,6 +10,9 @@ class DeletedSong(Base):
     track_id: str
     user_id: str
     active: bool
+    max_similarity: Optional[float] = None
+    avg_similarity: Optional[float] = None
+    scored_at: Optional[datetime] = None
 
 
 class DeletedSongInsert(BaseInsert):
@@ -18,6 +21,9 @@ class DeletedSongInsert(BaseInsert):
     track_id: str
     user_id: str
     active: Optional[bool] = True
+    max_similarity: Optional[float] = None
+    avg_similarity: Optional[float] = None
+    scored_at: Optional[datetime] = None
 
 
 class DeletedSongUpdate(BaseModel):
@@ -26,3 +32,6 @@ class DeletedSongUpdate(BaseModel):
     track_id: Optional[str] = None
     user_id: Optional[str] = None
     active: Optional[bool] = None
+    max_similarity: Optional[float] = None
+    avg_similarity: Optional[float] = None
+    scored_at: Optional[datetime] = None
@@ -7,6 +7,7 @@ from typing import Optional
 class LibrarySnapshot(Base):
     playlist_id: Optional[int] = None
     snapshot_id: Optional[str] = None
+    spotify_snapshot_id: Optional[str] = None
     song_count: Optional[int] = None
     user_id: str
 
@@ -14,6 +15,7 @@ class LibrarySnapshot(Base):
 class LibrarySnapshotInsert(BaseInsert):
     playlist_id: Optional[int] = None
     snapshot_id: Optional[str] = None
+    spotify_snapshot_id: Optional[str] = None
     song_count: Optional[int] = None
     user_id: str
 
@@ -21,5 +23,6 @@ class LibrarySnapshotInsert(BaseInsert):
 class LibrarySnapshotUpdate(BaseModel):
     playlist_id: Optional[int] = None
     snapshot_id: Optional[str] = None
+    spotify_snapshot_id: Optional[str] = None
     song_count: Optional[int] = None
     user_id: Optional[str] = None
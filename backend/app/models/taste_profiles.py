@@ -0,0 +1,25 @@
+from datetime import datetime
+from .base import Base, BaseInsert
+from pydantic import BaseModel
+from typing import List, Optional
+
+
+class TasteProfile(Base):
+    user_id: str
+    top_track_ids: List[str]
+    top_artist_ids: List[str]
+    updated_at: datetime
+
+
+class TasteProfileInsert(BaseInsert):
+    user_id: str
+    top_track_ids: List[str]
+    top_artist_ids: List[str]
+    updated_at: Optional[datetime] = None
+
+
+class TasteProfileUpdate(BaseModel):
+    user_id: Optional[str] = None
+    top_track_ids: Optional[List[str]] = None
+    top_artist_ids: Optional[List[str]] = None
+    updated_at: Optional[datetime] = None
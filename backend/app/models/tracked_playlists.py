@@ -13,6 +13,10 @@ class TrackedPlaylist(Base):
     removed_playlist_id: Optional[str] = None
     removed_playlist_name: Optional[str] = None
     removed_at: Optional[datetime] = None
+    song_count: Optional[int] = None
+    change_rate: Optional[float] = None
+    change_rate_updated_at: Optional[datetime] = None
+    next_snapshot_at: Optional[datetime] = None
     user_id: str
 
 
@@ -35,4 +39,8 @@ class TrackedPlaylistUpdate(BaseModel):
     public: Optional[bool] = None
     removed_playlist_id: Optional[str] = None
     removed_playlist_name: Optional[str] = None
+    song_count: Optional[int] = None
+    change_rate: Optional[float] = None
+    change_rate_updated_at: Optional[datetime] = None
+    next_snapshot_at: Optional[datetime] = None
     user_id: Optional[str] = None
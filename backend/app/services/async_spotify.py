@@ -0,0 +1,131 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import spotipy
+
+from app.core.config import settings
+from app.core.http import SPOTIFY_STATUS_FORCELIST
+from app.core.logging import setup_logging
+from app.core.metrics import observe_snapshot_pages, observe_spotify_request
+from app.models.track import Track
+from app.services.rate_limiter import TokenBucketLimiter, limiter_timeout_error, retry_after_seconds
+from app.services.scheduler import LIKED_SONGS_PAGE_SIZE, PLAYLIST_PAGE_SIZE
+from app.services.spotify_service import SpotifyService
+
+logger = setup_logging("async_spotify")
+
+# Retries for 5xx responses and dropped connections, as the sync session's urllib3 Retry does
+SERVER_ERROR_RETRIES = 3
+SERVER_ERROR_BACKOFF_SECONDS = 0.3
+
+
+def async_spotify_client() -> httpx.AsyncClient:
+    """Keep-alive client shared by every user in one async snapshot run, create it inside the event loop"""
+    return httpx.AsyncClient(
+        base_url=settings.SPOTIFY_API_URL,
+        timeout=httpx.Timeout(10.0, connect=5.0),
+        limits=httpx.Limits(max_connections=settings.ASYNC_SNAPSHOT_CONCURRENCY,
+                            max_keepalive_connections=settings.ASYNC_SNAPSHOT_CONCURRENCY,
+                            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY_SECONDS))
+
+
+class AsyncSpotify:
+    """
+    Read-only Spotify Web API client for one user, for the snapshot fetches of
+    the async engine. Every request holds the user's semaphore and the shared
+    global one, and takes a token from the cluster-wide limiter. Errors are
+    raised as SpotifyException so callers handle them like spotipy's.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, access_token: str, limiter: TokenBucketLimiter,
+                 global_semaphore: asyncio.Semaphore, user_semaphore: asyncio.Semaphore):
+        self.client = client
+        self.headers = {'Authorization': f'Bearer {access_token}'}
+        self.limiter = limiter
+        self.global_semaphore = global_semaphore
+        self.user_semaphore = user_semaphore
+
+    @staticmethod
+    def _error(response: httpx.Response) -> spotipy.SpotifyException:
+        try:
+            msg = response.json()['error']['message']
+        except (ValueError, KeyError, TypeError):
+            msg = response.text or 'error'
+        return spotipy.SpotifyException(response.status_code, -1, f"{response.url}:\n {msg}",
+                                        headers=response.headers)
+
+    async def _get(self, path: str, params: Optional[Dict] = None) -> Dict:
+        rate_limit_retries = 0
+        server_retries = 0
+        while True:
+            # User first, so a user waiting on their own limit doesn't hold a global slot
+            async with self.user_semaphore, self.global_semaphore:
+                if not await self.limiter.acquire_async(timeout=settings.SPOTIFY_MAX_RETRY_AFTER_SECONDS):
+                    raise limiter_timeout_error(self.limiter, path)
+                started = time.perf_counter()
+                try:
+                    response = await self.client.get(path, params=params, headers=self.headers)
+                    observe_spotify_request(path, 'GET', response.status_code, started)
+                except httpx.TransportError:
+                    observe_spotify_request(path, 'GET', None, started)
+                    response = None
+                    if server_retries >= SERVER_ERROR_RETRIES:
+                        raise
+
+            if response is not None and response.status_code == 429:
+                exc = self._error(response)
+                retry_after = retry_after_seconds(exc)
+                self.limiter.pause(retry_after)
+                rate_limit_retries += 1
+                if rate_limit_retries > settings.SPOTIFY_RATE_LIMIT_RETRIES or retry_after > settings.SPOTIFY_MAX_RETRY_AFTER_SECONDS:
+                    raise exc
+                logger.warning(f"Spotify rate limit hit, retrying in {retry_after}s", extra={
+                               "path": path, "retry_after": retry_after, "retries": rate_limit_retries})
+                await asyncio.sleep(retry_after)
+                continue
+
+            if response is None or (response.status_code in SPOTIFY_STATUS_FORCELIST and server_retries < SERVER_ERROR_RETRIES):
+                await asyncio.sleep(SERVER_ERROR_BACKOFF_SECONDS * 2 ** server_retries)
+                server_retries += 1
+                continue
+
+            if response.status_code >= 400:
+                raise self._error(response)
+            return response.json()
+
+    async def _fetch_all_pages(self, path: str, limit: int, params: Optional[Dict] = None) -> List[Dict]:
+        """
+        Every page of a paged endpoint, in order. The remaining offsets are
+        requested together once the first page reports the total, the user's
+        semaphore bounds how many are in flight.
+        """
+        params = dict(params or {})
+        first_page = await self._get(path, {**params, 'limit': limit, 'offset': 0})
+        items = list(first_page['items'])
+        total = first_page.get('total')
+        if not items or not total or total <= limit:
+            return items
+
+        pages = await asyncio.gather(*[
+            self._get(path, {**params, 'limit': limit, 'offset': offset})
+            for offset in range(limit, total, limit)])
+        for page in pages:
+            items.extend(page['items'])
+        return items
+
+    async def get_playlist_snapshot_id(self, playlist_id: str) -> Optional[str]:
+        result = await self._get(f'playlists/{playlist_id}', {'fields': 'snapshot_id'})
+        return result.get('snapshot_id') if result else None
+
+    async def get_user_playlist_songs(self, playlist_id: str) -> List[Track]:
+        items = await self._fetch_all_pages(f'playlists/{playlist_id}/tracks', PLAYLIST_PAGE_SIZE,
+                                            {'additional_types': 'track'})
+        observe_snapshot_pages('playlist', len(items), PLAYLIST_PAGE_SIZE)
+        return [SpotifyService._track_from_item(item) for item in items]
+
+    async def get_user_liked_songs(self) -> List[Track]:
+        items = await self._fetch_all_pages('me/tracks', LIKED_SONGS_PAGE_SIZE)
+        observe_snapshot_pages('liked_songs', len(items), LIKED_SONGS_PAGE_SIZE)
+        return [SpotifyService._track_from_item(item) for item in items]
@@ -0,0 +1,53 @@
+import math
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+import dateutil.parser
+
+from app.core.config import settings
+
+
+def _parse(value: Any) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    return dateutil.parser.parse(value)
+
+
+def update_change_rate(change_rate: Optional[float], observed_since: datetime, changes: int, now: datetime) -> float:
+    """
+    Folds one observation (changes seen since observed_since) into the playlist's
+    change rate, in changes per day. This is an exponentially weighted average
+    weighted by time: an observation counts for more the longer the period it
+    covers, and halfway after SNAPSHOT_CADENCE_HALF_LIFE_DAYS.
+    """
+    elapsed_days = max((now - observed_since).total_seconds() / 86400, 1 / 24)
+    observed_rate = changes / elapsed_days
+    if change_rate is None:
+        return observed_rate
+    weight = 1 - math.exp(-math.log(2) * elapsed_days / settings.SNAPSHOT_CADENCE_HALF_LIFE_DAYS)
+    return weight * observed_rate + (1 - weight) * change_rate
+
+
+def snapshot_interval(change_rate: float) -> timedelta:
+    """Time expected to pass before SNAPSHOT_CADENCE_TARGET_CHANGES changes, within the configured bounds"""
+    min_interval = timedelta(hours=settings.SNAPSHOT_MIN_INTERVAL_HOURS)
+    max_interval = timedelta(hours=settings.SNAPSHOT_MAX_INTERVAL_HOURS)
+    if change_rate <= 0:
+        return max_interval
+    interval = timedelta(days=settings.SNAPSHOT_CADENCE_TARGET_CHANGES / change_rate)
+    return max(min_interval, min(max_interval, interval))
+
+
+def observe_changes(tracked_playlist: Dict, last_snapshot_date: datetime, changes: int, now: datetime) -> Dict:
+    """Returns the Tracked Playlists columns to write after a snapshot (or unchanged check) saw changes"""
+    observed_since = _parse(tracked_playlist.get('change_rate_updated_at')) or last_snapshot_date
+    change_rate = update_change_rate(tracked_playlist.get('change_rate'), observed_since, changes, now)
+    return {
+        'change_rate': change_rate,
+        'change_rate_updated_at': now.isoformat(),
+        'next_snapshot_at': (now + snapshot_interval(change_rate)).isoformat()
+    }
+
+
+def next_snapshot_at(tracked_playlist: Dict) -> Optional[datetime]:
+    return _parse(tracked_playlist.get('next_snapshot_at'))
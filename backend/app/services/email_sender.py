@@ -1,38 +1,38 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict, Any
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from mjml import mjml2html
-from premailer import transform
+from typing import Callable, List, Optional, Dict, Any
 import html2text
-import resend
 from app.core.config import settings
 from app.core.security import create_unsubscribe_token
+from app.services.email_templates import TemplateCompiler
+from app.services.email_transport import email_transport, is_retryable
+from app.services.rate_limiter import RateLimitTimeout, resend_limiter
 from app.core.logging import setup_logging
 
 logger = setup_logging("email_sender")
 
 
+# Resend's batch endpoint takes at most this many emails per call
+MAX_BATCH_SIZE = 100
+
+
 class EmailSender:
-    def __init__(self):
+    def __init__(self, transport=None):
         self.template_dir = Path(__file__).parent.parent / 'email_templates'
-        self.env = Environment(
-            loader=FileSystemLoader(self.template_dir),
-            autoescape=select_autoescape(['html', 'xml'])
-        )
         self.text_converter = html2text.HTML2Text()
         self.text_converter.ignore_links = False
         self.text_converter.body_width = 0
         self.text_converter.ignore_images = True
-        resend.api_key = settings.RESEND_API_KEY
-        self.resend = resend
-
-    def _generate_text_content(self, html_content: str, context: Dict[Any, Any]) -> str:
-        """Converts HTML content to plain text with some formatting"""
-        # Convert HTML to markdown-style text
-        text_content = self.text_converter.handle(html_content)
+        # MJML and CSS inlining run once per template, not per email
+        self.templates = TemplateCompiler(self.template_dir, self.text_converter)
+        # ResendTransport unless EMAIL_TRANSPORT says otherwise, see email_transport
+        self.transport = transport or email_transport()
 
+    def _generate_text_content(self, text_content: str, context: Dict[Any, Any]) -> str:
+        """Adds the footer to the markdown-style text version"""
         # Add footer
         text_content += f"""
         ---
@@ -45,7 +45,7 @@ class EmailSender:
         return text_content.strip()
 
     def _render_mjml(self, template_name: str, context: Dict[Any, Any]) -> tuple[str, str]:
-        """Renders MJML template to HTML and creates a text version"""
+        """Renders the compiled MJML template to HTML and its text version"""
         user_id = context.get('user_id')
 
         if user_id:
@@ -65,19 +65,12 @@ class EmailSender:
         })
 
         try:
-            # Render MJML template
-            template = self.env.get_template(f"{template_name}.mjml")
-            mjml_content = template.render(**context)
-
-            # Convert MJML to HTML
-            html_output = mjml2html(mjml_content)
-
-            # Inline CSS using premailer
-            html_with_inlined_css = transform(html_output)
+            compiled = self.templates.get(template_name)
+            html_with_inlined_css = compiled.html.render(**context)
 
             # Generate text content
             text_content = self._generate_text_content(
-                html_with_inlined_css, context)
+                compiled.text.render(**context), context)
 
         except Exception as e:
             logger.error(
@@ -86,6 +79,56 @@ class EmailSender:
 
         return html_with_inlined_css, text_content
 
+    def build_email(
+        self,
+        template_name: str,
+        to_email: str,
+        subject: str,
+        context: Dict[Any, Any],
+        from_email: Optional[str] = None
+    ) -> Dict:
+        """Renders the template into a message ready for send_message or send_batch"""
+        html_content, text_content = self._render_mjml(template_name, context)
+        return {
+            "from": from_email or f"{settings.PROJECT_NAME} <{settings.DEFAULT_FROM_EMAIL}>",
+            "to": to_email,
+            "subject": subject,
+            "html": html_content,
+            "text": text_content,
+            "reply_to": "support@trackkeeper.app",
+            "headers": {
+                "List-Unsubscribe": f"<{context['unsubscribe_url']}>",
+                "Precedence": "bulk",
+            }
+        }
+
+    def _with_retries(self, call: Callable[[], Any]) -> Any:
+        """Runs a provider call within the send-rate cap, retrying rate limits and server errors with backoff"""
+        attempt = 0
+        while True:
+            # Raised as retryable, so a batch gives up instead of going one by one
+            if not resend_limiter.acquire(timeout=settings.RESEND_MAX_WAIT_SECONDS):
+                raise RateLimitTimeout(f"No send token within {settings.RESEND_MAX_WAIT_SECONDS}s")
+            try:
+                return call()
+            except Exception as e:
+                attempt += 1
+                if not is_retryable(e) or attempt > settings.EMAIL_SEND_RETRIES:
+                    raise
+                backoff = settings.EMAIL_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)
+                logger.warning(f"Email provider call failed, retrying in {backoff}s: {e}", extra={
+                               "attempt": attempt})
+                time.sleep(backoff)
+
+    def send_message(self, message: Dict):
+        """Sends one message built by build_email"""
+        try:
+            self._with_retries(lambda: self.transport.send(message))
+        except Exception as e:
+            logger.error(
+                f"Error sending email: {e}", extra={"subject": message['subject']})
+            raise
+
     def send_email(
         self,
         template_name: str,
@@ -95,27 +138,51 @@ class EmailSender:
         from_email: Optional[str] = None
     ):
         """Sends an email using the specified template"""
-        html_content, text_content = self._render_mjml(template_name, context)
+        self.send_message(self.build_email(
+            template_name, to_email, subject, context, from_email))
 
+    def _send_chunk(self, messages: List[Dict]) -> int:
+        """Sends up to MAX_BATCH_SIZE messages in one call, returns how many were sent"""
         try:
-            self.resend.Emails.send({
-                "from": f"{settings.PROJECT_NAME} <{settings.DEFAULT_FROM_EMAIL}>",
-                "to": to_email,
-                "subject": subject,
-                "html": html_content,
-                "text": text_content,
-                "reply_to": "support@trackkeeper.app",
-                "headers": {
-                    "List-Unsubscribe": f"<{context['unsubscribe_url']}>",
-                    "Precedence": "bulk",
-                }
-            })
+            self._with_retries(lambda: self.transport.send_batch(messages))
+            return len(messages)
         except Exception as e:
-            logger.error(
-                f"Error sending email: {e}", extra={"context": context})
-            raise
+            if is_retryable(e):
+                logger.error(f"Error sending email batch, giving up after retries: {e}", extra={
+                             "messages": len(messages)})
+                return 0
+            # The batch is rejected as a whole, send one by one so a single bad message only fails itself
+            logger.warning(f"Email batch rejected, sending messages one by one: {e}", extra={
+                           "messages": len(messages)})
+
+        sent = 0
+        for message in messages:
+            try:
+                self.send_message(message)
+                sent += 1
+            except Exception:
+                pass
+        return sent
+
+    def send_batch(self, messages: List[Dict]) -> Dict[str, int]:
+        """
+        Sends messages through the provider's batch API, MAX_BATCH_SIZE per call
+        with up to EMAIL_BATCH_CONCURRENCY calls in flight. Calls share the
+        cluster-wide send-rate cap.
+        """
+        if not messages:
+            return {"sent": 0, "failed": 0, "calls": 0}
+        size = max(1, min(settings.EMAIL_BATCH_SIZE, MAX_BATCH_SIZE))
+        chunks = [messages[i:i + size] for i in range(0, len(messages), size)]
+        with ThreadPoolExecutor(max_workers=max(1, min(settings.EMAIL_BATCH_CONCURRENCY, len(chunks)))) as executor:
+            sent = sum(executor.map(self._send_chunk, chunks))
+        return {"sent": sent, "failed": len(messages) - sent, "calls": len(chunks)}
 
     def preview_email(self, template_name: str, context: Dict[Any, Any]) -> str:
         """Returns HTML preview of the email for development"""
         html_content, _ = self._render_mjml(template_name, context)
         return html_content
+
+
+# Shared by every task in the process, so templates are compiled once
+email_sender = EmailSender()
@@ -0,0 +1,108 @@
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import html2text
+from jinja2 import Environment, FileSystemLoader, Template
+from mjml import mjml2html
+from premailer import transform
+
+from app.core.logging import setup_logging
+
+logger = setup_logging("email_templates")
+
+# Jinja tags, only extends and block are resolved when compiling
+JINJA_TAG = re.compile(r'\{\{.*?\}\}|\{%-?\s*(\w+).*?%\}|\{#.*?#\}', re.DOTALL)
+COMPILE_TIME_TAGS = {'extends', 'block', 'endblock'}
+# Stands in for a runtime tag while MJML, premailer and html2text run. Plain
+# letters and digits so none of them escape, reformat or drop it.
+SLOT = 'TKSLOT{}X'
+SLOT_PATTERN = re.compile(r'TKSLOT(\d+)X')
+
+
+class SlotLoader(FileSystemLoader):
+    """
+    Loads templates with every runtime Jinja tag swapped for a slot token, so the
+    compile pass only resolves template inheritance. Records the files it read
+    and their mtimes.
+    """
+
+    def __init__(self, searchpath: Path):
+        super().__init__(searchpath)
+        self.slots: List[str] = []
+        self.mtimes: Dict[str, float] = {}
+
+    def _to_slot(self, match: re.Match) -> str:
+        if match.group(0).startswith('{#'):
+            return ''
+        if match.group(1) in COMPILE_TIME_TAGS:
+            return match.group(0)
+        self.slots.append(match.group(0))
+        return SLOT.format(len(self.slots) - 1)
+
+    def get_source(self, environment: Environment, template: str) -> Tuple[str, str, Callable[[], bool]]:
+        source, filename, uptodate = super().get_source(environment, template)
+        self.mtimes[filename] = os.path.getmtime(filename)
+        return JINJA_TAG.sub(self._to_slot, source), filename, uptodate
+
+
+class CompiledTemplate:
+    def __init__(self, html: Template, text: Template, mtimes: Dict[str, float]):
+        self.html = html
+        self.text = text
+        self.mtimes = mtimes
+
+    def is_stale(self) -> bool:
+        try:
+            return any(os.path.getmtime(path) != mtime for path, mtime in self.mtimes.items())
+        except OSError:
+            return True
+
+
+class TemplateCompiler:
+    """
+    Compiles MJML templates once into Jinja templates of the final HTML (CSS
+    already inlined) and of its plain text version, so sending an email is just
+    a Jinja render. Compiled templates are cached per process and recompiled
+    when one of their source files changes.
+    """
+
+    def __init__(self, template_dir: Path, text_converter: html2text.HTML2Text):
+        self.template_dir = template_dir
+        self.text_converter = text_converter
+        self.html_env = Environment(autoescape=True)
+        self.text_env = Environment(autoescape=False)
+        self.compiled: Dict[str, CompiledTemplate] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _restore(content: str, slots: List[str]) -> str:
+        return SLOT_PATTERN.sub(lambda match: slots[int(match.group(1))], content)
+
+    def compile(self, template_name: str) -> CompiledTemplate:
+        loader = SlotLoader(self.template_dir)
+        mjml_content = Environment(loader=loader).get_template(f"{template_name}.mjml").render()
+
+        # Convert MJML to HTML and inline CSS using premailer
+        html_output = transform(mjml2html(mjml_content), disable_validation=True)
+        text_output = self.text_converter.handle(html_output)
+
+        logger.info(f"Compiled email template {template_name}", extra={
+                    "template_name": template_name, "slots": len(loader.slots), "size": len(html_output)})
+        return CompiledTemplate(
+            html=self.html_env.from_string(self._restore(html_output, loader.slots)),
+            text=self.text_env.from_string(self._restore(text_output, loader.slots)),
+            mtimes=loader.mtimes)
+
+    def get(self, template_name: str) -> CompiledTemplate:
+        compiled = self.compiled.get(template_name)
+        if compiled is not None and not compiled.is_stale():
+            return compiled
+        with self.lock:
+            compiled = self.compiled.get(template_name)
+            if compiled is None or compiled.is_stale():
+                compiled = self.compile(template_name)
+                self.compiled[template_name] = compiled
+            return compiled
@@ -0,0 +1,63 @@
+import threading
+from typing import Dict, List
+
+import requests
+import resend
+from resend.exceptions import ResendError
+
+from app.core.config import settings
+from app.services.rate_limiter import RateLimitTimeout
+
+
+class ResendTransport:
+    """Sends through the Resend API, batches go to the batch endpoint in one call"""
+
+    def __init__(self):
+        resend.api_key = settings.RESEND_API_KEY
+
+    def send(self, message: Dict) -> Dict:
+        return resend.Emails.send(message)
+
+    def send_batch(self, messages: List[Dict]) -> List[Dict]:
+        return resend.Batch.send(messages)['data']
+
+
+class RecordingTransport:
+    """Keeps messages in memory instead of sending them, for tests and local runs"""
+
+    def __init__(self):
+        self.messages: List[Dict] = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _record(self, messages: List[Dict]) -> List[Dict]:
+        with self.lock:
+            self.calls += 1
+            start = len(self.messages)
+            self.messages.extend(messages)
+            return [{'id': f"recorded-{start + i}"} for i in range(len(messages))]
+
+    def send(self, message: Dict) -> Dict:
+        return self._record([message])[0]
+
+    def send_batch(self, messages: List[Dict]) -> List[Dict]:
+        return self._record(messages)
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Rate limits, server errors and network failures, anything else won't succeed on a retry"""
+    if isinstance(exc, (requests.RequestException, RateLimitTimeout)):
+        return True
+    if isinstance(exc, ResendError):
+        try:
+            code = int(exc.code)
+        except (TypeError, ValueError):
+            return False
+        return code == 429 or code >= 500
+    return False
+
+
+def email_transport():
+    if settings.EMAIL_TRANSPORT == "recording":
+        return RecordingTransport()
+    return ResendTransport()
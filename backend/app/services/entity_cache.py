@@ -0,0 +1,94 @@
+import json
+import threading
+from typing import Any, Callable, Dict, Iterable, List
+
+from cachetools import TTLCache
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.logging import setup_logging
+from app.db.redis import redis_client
+
+logger = setup_logging("entity_cache")
+
+
+class EntityCache:
+    """
+    Cross-user cache for Spotify entities (audio features, artist genres, tracks).
+    A small in-process TTL cache sits in front of Redis, lookups and writes for a
+    batch of ids each take a single Redis round trip. Redis being unavailable
+    only means more Spotify calls, never a failed task.
+    """
+
+    def __init__(self, namespace: str, ttl: int):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.l1 = TTLCache(maxsize=settings.ENTITY_CACHE_L1_SIZE,
+                           ttl=settings.ENTITY_CACHE_L1_TTL_SECONDS)
+        # TTLCache is not thread safe, pages are fetched from a thread pool
+        self.lock = threading.Lock()
+
+    def _key(self, entity_id: str) -> str:
+        return f"spotify:{self.namespace}:{entity_id}"
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Any]:
+        """Returns the cached entries for ids, missing ids are left out"""
+        found: Dict[str, Any] = {}
+        missing: List[str] = []
+        with self.lock:
+            for entity_id in dict.fromkeys(ids):
+                if entity_id in self.l1:
+                    found[entity_id] = self.l1[entity_id]
+                else:
+                    missing.append(entity_id)
+
+        if not missing or not settings.ENTITY_CACHE_ENABLED:
+            return found
+
+        try:
+            values = redis_client.mget([self._key(entity_id) for entity_id in missing])
+        except RedisError as e:
+            logger.warning(f"Entity cache read failed: {e}", extra={
+                           "namespace": self.namespace})
+            return found
+
+        with self.lock:
+            for entity_id, value in zip(missing, values):
+                if value is not None:
+                    found[entity_id] = self.l1[entity_id] = json.loads(value)
+        return found
+
+    def set_many(self, entries: Dict[str, Any]):
+        if not entries:
+            return
+        with self.lock:
+            self.l1.update(entries)
+
+        if not settings.ENTITY_CACHE_ENABLED:
+            return
+
+        try:
+            pipeline = redis_client.pipeline(transaction=False)
+            for entity_id, value in entries.items():
+                pipeline.set(self._key(entity_id), json.dumps(value), ex=self.ttl)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Entity cache write failed: {e}", extra={
+                           "namespace": self.namespace})
+
+    def get_or_fetch(self, ids: Iterable[str], fetch: Callable[[List[str]], Dict[str, Any]]) -> Dict[str, Any]:
+        """Looks ids up in the cache and fetches (then caches) the ones that are missing"""
+        found = self.get_many(ids)
+        missing = [entity_id for entity_id in dict.fromkeys(ids) if entity_id not in found]
+        if missing:
+            fetched = fetch(missing)
+            self.set_many(fetched)
+            found.update(fetched)
+        return found
+
+
+audio_features_cache = EntityCache(
+    'audio_features', ttl=settings.ENTITY_CACHE_TTL_SECONDS)
+artist_genres_cache = EntityCache(
+    'artist_genres', ttl=settings.ENTITY_CACHE_TTL_SECONDS)
+tracks_cache = EntityCache('tracks', ttl=settings.ENTITY_CACHE_TTL_SECONDS)
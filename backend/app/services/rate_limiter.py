@@ -0,0 +1,228 @@
+import asyncio
+import math
+import time
+from typing import Dict, Optional
+
+import requests
+import spotipy
+import urllib3
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.http import spotify_session
+from app.core.metrics import observe_spotify_request
+from app.core.logging import setup_logging
+from app.db.redis import redis_client
+
+logger = setup_logging("rate_limiter")
+
+# Takes one token from the bucket and returns 0, or returns how many ms to wait.
+# While the pause key exists (set from a Retry-After) nobody gets a token.
+# Uses the Redis clock so workers with drifting clocks share one timeline.
+TOKEN_BUCKET_SCRIPT = """
+local pause = redis.call('PTTL', KEYS[2])
+if pause > 0 then
+    return pause
+end
+
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate / 1000)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket shared by every worker through Redis. Requests take a token or
+    sleep until one is due, so the cluster as a whole stays at rate requests per
+    second with bursts of up to capacity. pause() stops everyone for a
+    Retry-After period. If Redis is unavailable requests go through unlimited.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.bucket_key = f"ratelimit:{name}:bucket"
+        self.pause_key = f"ratelimit:{name}:pause"
+        self.script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self) -> float:
+        """Takes a token if one is available and returns 0, otherwise returns the seconds to wait"""
+        try:
+            wait_ms = self.script(keys=[self.bucket_key, self.pause_key],
+                                  args=[self.rate, self.capacity])
+        except RedisError as e:
+            logger.warning(f"Rate limiter unavailable: {e}", extra={
+                           "bucket": self.bucket_key})
+            return 0
+        return max(0, wait_ms) / 1000
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until a token is available, returns False if that takes longer than timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        """acquire() for asyncio code, waits without blocking the event loop"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # The script call itself is a single sub-millisecond Redis round trip
+            wait = self.try_acquire()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stops all workers from taking tokens for the next seconds, e.g. from a Retry-After header"""
+        try:
+            redis_client.set(self.pause_key, 1, px=max(1, int(seconds * 1000)))
+        except RedisError as e:
+            logger.warning(f"Rate limiter unavailable: {e}", extra={
+                           "bucket": self.bucket_key})
+
+    def paused_for(self) -> float:
+        try:
+            remaining = redis_client.pttl(self.pause_key)
+        except RedisError:
+            return 0
+        return max(0, remaining) / 1000
+
+    def usage(self) -> Dict[str, float]:
+        """Current budget: tokens left in the bucket and how long requests are paused for"""
+        try:
+            tokens, updated_at = redis_client.hmget(self.bucket_key, 'tokens', 'updated_at')
+            seconds, microseconds = redis_client.time()
+        except RedisError as e:
+            logger.warning(f"Rate limiter unavailable: {e}", extra={
+                           "bucket": self.bucket_key})
+            return {"rate": self.rate, "capacity": self.capacity, "available": self.capacity, "paused_for": 0}
+
+        available = float(self.capacity)
+        if tokens is not None:
+            now = seconds * 1000 + microseconds // 1000
+            elapsed = max(0, now - int(float(updated_at)))
+            available = min(self.capacity, float(tokens) + elapsed * self.rate / 1000)
+
+        return {
+            "rate": self.rate,
+            "capacity": self.capacity,
+            "available": available,
+            "used": self.capacity - available,
+            "paused_for": self.paused_for()
+        }
+
+
+def retry_after_seconds(exc: spotipy.SpotifyException, default: float = 1) -> float:
+    """Seconds to wait after a 429, from its Retry-After header"""
+    try:
+        return max(0, float(exc.headers.get('Retry-After', default)))
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimitTimeout(Exception):
+    """No token came up within the time a caller is allowed to wait for one"""
+
+
+def limiter_timeout_error(limiter: TokenBucketLimiter, url: str) -> spotipy.SpotifyException:
+    """
+    A 429 for a request that never got a token, with the remaining pause as its
+    Retry-After, so callers reschedule as they do for one from Spotify.
+    """
+    retry_after = max(1, math.ceil(limiter.paused_for()))
+    return spotipy.SpotifyException(429, -1, f"{url}:\n Rate limiter paused for {retry_after}s",
+                                    headers={'Retry-After': str(retry_after)})
+
+
+def hand_back_429s(session: requests.Session):
+    """
+    Makes urllib3 return 429s instead of retrying them. Leaving 429 out of
+    status_forcelist isn't enough, a 429 with a Retry-After header is retried
+    (after sleeping through it) unless respect_retry_after_header is off.
+    """
+    for adapter in session.adapters.values():
+        retry = getattr(adapter, 'max_retries', None)
+        if not isinstance(retry, urllib3.Retry):
+            continue
+        status_forcelist = [status for status in retry.status_forcelist or () if status != 429]
+        if retry.respect_retry_after_header or len(status_forcelist) != len(retry.status_forcelist or ()):
+            adapter.max_retries = retry.new(respect_retry_after_header=False, status_forcelist=status_forcelist)
+
+
+class RateLimitedSpotify(spotipy.Spotify):
+    """
+    Spotify client that takes a token from the shared limiter before every
+    request. A 429 pauses the limiter for Retry-After for every worker, short
+    waits are retried here and longer ones are raised for the task to reschedule.
+    Requests that can't get a token within SPOTIFY_MAX_RETRY_AFTER_SECONDS (a
+    pause set by another worker) are raised as a 429 the same way.
+    """
+
+    def __init__(self, *args, limiter: TokenBucketLimiter, **kwargs):
+        kwargs.setdefault('requests_session', spotify_session())
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+        # urllib3 would otherwise sleep through Retry-After inside a single worker and, once
+        # out of retries, raise without the header, so the limiter is never paused for it
+        hand_back_429s(self._session)
+        self.prefix = settings.SPOTIFY_API_URL
+
+    def __del__(self):
+        # spotipy closes its session here, this one is shared by the whole process
+        pass
+
+    def _internal_call(self, method, url, payload, params):
+        retries = 0
+        while True:
+            if not self.limiter.acquire(timeout=settings.SPOTIFY_MAX_RETRY_AFTER_SECONDS):
+                raise limiter_timeout_error(self.limiter, url)
+            started = time.perf_counter()
+            try:
+                result = super()._internal_call(method, url, payload, params)
+                observe_spotify_request(url, method, '2xx', started)
+                return result
+            except spotipy.SpotifyException as exc:
+                observe_spotify_request(url, method, exc.http_status, started)
+                if exc.http_status != 429:
+                    raise
+                retry_after = retry_after_seconds(exc)
+                self.limiter.pause(retry_after)
+                retries += 1
+                if retries > settings.SPOTIFY_RATE_LIMIT_RETRIES or retry_after > settings.SPOTIFY_MAX_RETRY_AFTER_SECONDS:
+                    raise
+                logger.warning(f"Spotify rate limit hit, retrying in {retry_after}s", extra={
+                               "url": url, "retry_after": retry_after, "retries": retries})
+            except Exception:
+                observe_spotify_request(url, method, None, started)
+                raise
+
+
+spotify_limiter = TokenBucketLimiter(
+    'spotify', rate=settings.SPOTIFY_RATE_LIMIT_PER_SECOND, capacity=settings.SPOTIFY_RATE_LIMIT_BURST)
+resend_limiter = TokenBucketLimiter(
+    'resend', rate=settings.RESEND_RATE_LIMIT_PER_SECOND, capacity=settings.RESEND_RATE_LIMIT_BURST)
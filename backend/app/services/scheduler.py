@@ -0,0 +1,107 @@
+import heapq
+from math import ceil
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+from app.core.logging import setup_logging
+
+logger = setup_logging("scheduler")
+
+# Page sizes used by SpotifyService when fetching tracks
+PLAYLIST_PAGE_SIZE = 100
+LIKED_SONGS_PAGE_SIZE = 50
+
+
+class SnapshotJob(BaseModel):
+    user_id: str
+    playlists: List[Dict]  # Tracked Playlists id, playlist_id and playlist_name
+    cost: int  # Estimated Spotify API calls
+
+
+class ScheduledJob(BaseModel):
+    job: SnapshotJob
+    slot: int
+    countdown: float  # Seconds from now
+
+
+class SchedulePlan(BaseModel):
+    jobs: List[ScheduledJob]
+    slot_seconds: int
+    slot_capacity: float
+    load: List[int]  # Estimated API calls per slot
+
+    def report(self) -> Dict:
+        """Summary of the planned load curve"""
+        total = sum(self.load)
+        peak = max(self.load, default=0)
+        mean = total / len(self.load) if self.load else 0
+        return {
+            "jobs": len(self.jobs),
+            "slots": len(self.load),
+            "total_calls": total,
+            "peak_calls_per_slot": peak,
+            "mean_calls_per_slot": round(mean, 2),
+            "peak_to_mean": round(peak / mean, 2) if mean else 0,
+            "slot_capacity": round(self.slot_capacity, 2),
+            "slots_over_budget": sum(1 for load in self.load if load > self.slot_capacity),
+        }
+
+
+def estimate_cost(song_count: Optional[int], liked_songs: bool, default_song_count: int) -> int:
+    """API calls one snapshot is expected to make: the track pages plus the snapshot_id check for playlists"""
+    if song_count is None:
+        song_count = default_song_count
+    page_size = LIKED_SONGS_PAGE_SIZE if liked_songs else PLAYLIST_PAGE_SIZE
+    pages = max(1, ceil(song_count / page_size))
+    return pages if liked_songs else pages + 1
+
+
+def spread_order(num_slots: int) -> List[int]:
+    """
+    Rank of each slot in a bit-reversal order (0, n/2, n/4, 3n/4, ...). Used to
+    break ties between equally loaded slots so that, while the window is far
+    from full, jobs are still spread over all of it rather than packed at the start.
+    """
+    bits = max(1, (num_slots - 1).bit_length())
+    order = sorted(range(num_slots), key=lambda slot: int(
+        format(slot, f'0{bits}b')[::-1], 2))
+    ranks = [0] * num_slots
+    for rank, slot in enumerate(order):
+        ranks[slot] = rank
+    return ranks
+
+
+def plan_schedule(jobs: List[SnapshotJob], window_seconds: int, slot_seconds: int, calls_per_minute: int) -> SchedulePlan:
+    """
+    Packs jobs into slot_seconds wide slots across window_seconds, balancing the
+    estimated API calls per slot. Jobs are placed largest first, each in the
+    currently least loaded slot (LPT), which keeps the peak close to the mean.
+    Within a slot, job start times are staggered in proportion to their cost.
+    """
+    num_slots = max(1, window_seconds // slot_seconds)
+    slot_capacity = calls_per_minute * slot_seconds / 60
+    ranks = spread_order(num_slots)
+
+    heap = [(0, ranks[slot], slot) for slot in range(num_slots)]
+    heapq.heapify(heap)
+    slot_jobs: List[List[SnapshotJob]] = [[] for _ in range(num_slots)]
+    load = [0] * num_slots
+
+    for job in sorted(jobs, key=lambda job: job.cost, reverse=True):
+        slot_load, rank, slot = heapq.heappop(heap)
+        slot_jobs[slot].append(job)
+        load[slot] = slot_load + job.cost
+        heapq.heappush(heap, (load[slot], rank, slot))
+
+    scheduled: List[ScheduledJob] = []
+    for slot, jobs_in_slot in enumerate(slot_jobs):
+        offset = 0
+        for job in jobs_in_slot:
+            countdown = slot * slot_seconds + \
+                (offset / load[slot]) * slot_seconds if load[slot] else slot * slot_seconds
+            scheduled.append(ScheduledJob(job=job, slot=slot, countdown=countdown))
+            offset += job.cost
+
+    scheduled.sort(key=lambda scheduled_job: scheduled_job.countdown)
+    return SchedulePlan(jobs=scheduled, slot_seconds=slot_seconds, slot_capacity=slot_capacity, load=load)
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Union
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.logging import setup_logging
+from app.services.snapshot_codec import ID_DTYPE
+
+logger = setup_logging("snapshot_cache")
+
+DATA_SUFFIX = '.snapshot'
+IDS_SUFFIX = '.ids'
+
+
+class SnapshotCache:
+    """
+    Worker-local disk cache for snapshot files. Snapshots are written once and
+    never modified, so entries never go stale and are only dropped to stay under
+    max_bytes, least recently used first. Writes go to a temp file that is renamed
+    into place, so concurrent workers never read a partial file.
+
+    Besides the raw file, the pre-parsed sorted id array of a snapshot can be
+    stored next to it so a diff does not have to decode the file again.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.directory / (hashlib.sha1(key.encode('utf-8')).hexdigest() + suffix)
+
+    def _read(self, path: Path) -> Optional[bytes]:
+        try:
+            data = path.read_bytes()
+            # Bump the mtime so eviction sees this entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except OSError as e:
+            logger.warning(f"Error reading snapshot cache: {e}", extra={"path": str(path)})
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def _write(self, path: Path, data: Union[bytes, BinaryIO]):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    if isinstance(data, bytes):
+                        tmp_file.write(data)
+                    else:
+                        shutil.copyfileobj(data, tmp_file)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Error writing snapshot cache: {e}", extra={"path": str(path)})
+            return
+        self.evict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._read(self._path(key, DATA_SUFFIX))
+
+    def put(self, key: str, data: bytes):
+        self._write(self._path(key, DATA_SUFFIX), data)
+
+    def put_file(self, key: str, file: BinaryIO):
+        """put() for a snapshot that was written to a file, copied without reading it all into memory"""
+        self._write(self._path(key, DATA_SUFFIX), file)
+
+    def get_ids(self, key: str) -> Optional[np.ndarray]:
+        data = self._read(self._path(key, IDS_SUFFIX))
+        if data is None:
+            return None
+        return np.frombuffer(data, dtype=ID_DTYPE)
+
+    def put_ids(self, key: str, ids: np.ndarray):
+        self._write(self._path(key, IDS_SUFFIX), ids.tobytes())
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes"""
+        try:
+            entries = [(entry.stat(), entry) for entry in os.scandir(self.directory)
+                       if entry.is_file() and not entry.name.endswith('.tmp')]
+        except OSError:
+            return
+
+        total = sum(stat.st_size for stat, _ in entries)
+        if total <= self.max_bytes:
+            return
+
+        for stat, entry in sorted(entries, key=lambda item: item[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(entry.path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+snapshot_cache: Optional[SnapshotCache] = SnapshotCache(
+    settings.SNAPSHOT_CACHE_DIR, settings.SNAPSHOT_CACHE_MAX_BYTES) if settings.SNAPSHOT_CACHE_ENABLED else None
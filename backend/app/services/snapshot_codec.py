@@ -0,0 +1,203 @@
+"""
+Compact binary snapshot format.
+
+    header     magic, version, flags, id count, metadata length
+    positions  track count, uint32
+    ids        sorted, unique track ids as 16-byte big-endian integers
+    order      uint32 index into ids of every track, in playlist order
+    added_at   int64 epoch seconds, aligned with order
+    metadata   optional gzip JSON of [name, artist, album, image], aligned with order
+
+Spotify ids are base62 encodings of 128-bit integers, so they fit in 16 bytes
+and sort the same way as bytes. Diffing two snapshots is then a setdiff1d on
+the id arrays without building any per-track Python objects. The order section
+gives the playlist back in order, with repeated tracks. Tracks without an id
+(local files), or with one that isn't a 22 character base62 id below 2**128,
+can't be stored.
+
+Version 1 files have no positions or order section, their added_at and
+metadata are aligned with ids, so they decode sorted by id without repeats.
+"""
+
+import gzip
+import json
+import struct
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.models.track import Track
+
+BASE62_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+BASE62_VALUES = {char: value for value, char in enumerate(BASE62_ALPHABET)}
+ID_LENGTH = 22
+ID_BYTES = 16
+ID_DTYPE = np.dtype(f'S{ID_BYTES}')
+ADDED_AT_DTYPE = np.dtype('>i8')
+ORDER_DTYPE = np.dtype('>u4')
+MISSING_ADDED_AT = np.iinfo(np.int64).min
+
+MAGIC = b'TKSNAP'
+VERSION = 2
+FLAG_METADATA = 0x01
+HEADER = struct.Struct('>6sBBIQ')
+POSITIONS = struct.Struct('>I')
+
+
+def encode_track_id(track_id: str) -> bytes:
+    """Raises ValueError for anything that isn't a Spotify id"""
+    if not isinstance(track_id, str) or len(track_id) != ID_LENGTH:
+        raise ValueError(f"Not a Spotify id: {track_id!r}")
+    value = 0
+    try:
+        for char in track_id:
+            value = value * 62 + BASE62_VALUES[char]
+        return value.to_bytes(ID_BYTES, 'big')
+    except (KeyError, OverflowError):
+        raise ValueError(f"Not a Spotify id: {track_id!r}")
+
+
+def is_track_id(track_id: Optional[str]) -> bool:
+    """Whether an id fits the 16-byte encoding"""
+    try:
+        encode_track_id(track_id)
+    except ValueError:
+        return False
+    return True
+
+
+def decode_track_id(raw: bytes) -> str:
+    # numpy drops trailing null bytes from fixed width values
+    value = int.from_bytes(raw.ljust(ID_BYTES, b'\x00'), 'big')
+    chars = []
+    for _ in range(ID_LENGTH):
+        value, digit = divmod(value, 62)
+        chars.append(BASE62_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def encode_track_ids(track_ids: Iterable[Optional[str]]) -> np.ndarray:
+    """
+    Sorted array of unique encoded ids. Tracks without an id (local files) and
+    ids that aren't Spotify ids are skipped, so they never show up in a diff.
+    """
+    encoded = []
+    for tid in track_ids:
+        try:
+            encoded.append(encode_track_id(tid))
+        except ValueError:
+            continue
+    return np.unique(np.array(encoded, dtype=ID_DTYPE))
+
+
+def decode_track_ids(ids: np.ndarray) -> List[str]:
+    raw = ids.astype(ID_DTYPE).tobytes()
+    return [decode_track_id(raw[i:i + ID_BYTES]) for i in range(0, len(raw), ID_BYTES)]
+
+
+def diff_track_ids(previous_ids: np.ndarray, current_ids: np.ndarray) -> np.ndarray:
+    """Ids in previous_ids that are missing from current_ids"""
+    return np.setdiff1d(previous_ids, current_ids, assume_unique=True)
+
+
+def _to_epoch(added_at: Optional[str]) -> int:
+    if not added_at:
+        return MISSING_ADDED_AT
+    return int(datetime.fromisoformat(added_at.replace('Z', '+00:00')).timestamp())
+
+
+def _from_epoch(seconds: int) -> Optional[str]:
+    if seconds == MISSING_ADDED_AT:
+        return None
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def is_binary_snapshot(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode_snapshot(tracks: List[Track], include_metadata: bool = True) -> bytes:
+    # Tracks without an id (local files) or with a malformed one can't be encoded
+    tracks = [track for track in tracks if is_track_id(track['id'])]
+    encoded = np.array([encode_track_id(track['id']) for track in tracks], dtype=ID_DTYPE)
+    ids, order = np.unique(encoded, return_inverse=True)
+
+    added_at = np.array([_to_epoch(track.get('added_at')) for track in tracks],
+                        dtype=ADDED_AT_DTYPE)
+
+    metadata = b''
+    flags = 0
+    if include_metadata:
+        metadata = gzip.compress(json.dumps([
+            [track.get('name'), track.get('artist'), track.get('album'), track.get('image')]
+            for track in tracks
+        ]).encode('utf-8'))
+        flags |= FLAG_METADATA
+
+    header = HEADER.pack(MAGIC, VERSION, flags, len(ids), len(metadata)) + POSITIONS.pack(len(tracks))
+    return (header + ids.tobytes() + order.astype(ORDER_DTYPE).tobytes() + added_at.tobytes()
+            + metadata)
+
+
+def _read_header(data: bytes):
+    """Version, flags, id count, track count, metadata length and the offset of the ids"""
+    magic, version, flags, count, metadata_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary snapshot")
+    if version == 1:
+        return version, flags, count, count, metadata_length, HEADER.size
+    if version != VERSION:
+        raise ValueError(f"Unsupported binary snapshot version {version}")
+    positions, = POSITIONS.unpack_from(data, HEADER.size)
+    return version, flags, count, positions, metadata_length, HEADER.size + POSITIONS.size
+
+
+def decode_snapshot_ids(data: bytes) -> np.ndarray:
+    """Only reads the id section, the rest of the file is never parsed"""
+    _, _, count, _, _, offset = _read_header(data)
+    return np.frombuffer(data, dtype=ID_DTYPE, count=count, offset=offset)
+
+
+def _decode_order(data: bytes) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Ids, the index into them of every track in playlist order, and the offset after the order"""
+    version, _, count, positions, _, offset = _read_header(data)
+    ids = np.frombuffer(data, dtype=ID_DTYPE, count=count, offset=offset)
+    offset += count * ID_BYTES
+    if version == 1:
+        return ids, np.arange(count), offset
+    order = np.frombuffer(data, dtype=ORDER_DTYPE, count=positions, offset=offset)
+    return ids, order, offset + positions * ORDER_DTYPE.itemsize
+
+
+def decode_snapshot_order(data: bytes) -> List[str]:
+    """Track ids in playlist order, repeats included, without reading the metadata"""
+    ids, order, _ = _decode_order(data)
+    track_ids = decode_track_ids(ids)
+    return [track_ids[index] for index in order.tolist()]
+
+
+def decode_snapshot(data: bytes) -> List[Track]:
+    _, flags, _, positions, metadata_length, _ = _read_header(data)
+    ids, order, added_at_offset = _decode_order(data)
+    added_at = np.frombuffer(data, dtype=ADDED_AT_DTYPE,
+                             count=positions, offset=added_at_offset)
+
+    if flags & FLAG_METADATA:
+        metadata_offset = added_at_offset + positions * ADDED_AT_DTYPE.itemsize
+        metadata = json.loads(gzip.decompress(
+            data[metadata_offset:metadata_offset + metadata_length]).decode('utf-8'))
+    else:
+        metadata = [[None, None, None, None]] * positions
+
+    # Each id is decoded once, repeats share it
+    track_ids = decode_track_ids(ids)
+    return [{
+        'id': track_ids[index],
+        'name': name,
+        'artist': artist,
+        'album': album,
+        'added_at': _from_epoch(int(seconds)),
+        'image': image
+    } for index, seconds, (name, artist, album, image)
+        in zip(order.tolist(), added_at, metadata)]
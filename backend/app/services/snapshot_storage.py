@@ -0,0 +1,436 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.logging import setup_logging
+from app.core.metrics import SNAPSHOT_BYTES, SNAPSHOT_LOAD_SECONDS
+from app.core.profiling import phase
+from app.db.supabase import supabase
+from app.models.track import Track
+from app.services.snapshot_cache import snapshot_cache
+from app.services.snapshot_codec import (decode_snapshot, decode_snapshot_ids, decode_snapshot_order,
+                                         encode_snapshot, encode_track_ids, is_binary_snapshot, is_track_id)
+
+logger = setup_logging("snapshot_storage")
+
+SNAPSHOT_BUCKET = 'user-snapshots'
+KEYFRAME_SUFFIX = '.json.gz'
+DELTA_SUFFIX = '.delta.json.gz'
+BINARY_SUFFIX = '.tks'
+# Guards against broken chains, well above any sensible keyframe interval
+MAX_DELTA_CHAIN = 100
+
+
+def snapshot_file_name(user_id: str, spotify_playlist_id: str, timestamp: int, delta: bool = False) -> str:
+    if delta:
+        suffix = DELTA_SUFFIX
+    elif settings.SNAPSHOT_FORMAT == 'binary':
+        suffix = BINARY_SUFFIX
+    else:
+        suffix = KEYFRAME_SUFFIX
+    return f"{user_id}/snapshot_{spotify_playlist_id}_{timestamp}{suffix}"
+
+
+def is_delta(file_name: Optional[str]) -> bool:
+    return bool(file_name) and file_name.endswith(DELTA_SUFFIX)
+
+
+def is_binary(file_name: Optional[str]) -> bool:
+    return bool(file_name) and file_name.endswith(BINARY_SUFFIX)
+
+
+def needs_keyframe(recent_snapshots: List[Dict]) -> bool:
+    """
+    Takes the most recent Library Snapshots rows for a playlist (newest first) and
+    decides if the next snapshot should be a full keyframe. A keyframe is written
+    every SNAPSHOT_KEYFRAME_INTERVAL snapshots, deltas in between.
+    """
+    if not recent_snapshots:
+        return True
+
+    deltas_since_keyframe = 0
+    for row in recent_snapshots:
+        if not is_delta(row.get('snapshot_id')):
+            break
+        deltas_since_keyframe += 1
+    else:
+        # The keyframe this chain is built on is out of view
+        return True
+
+    return deltas_since_keyframe + 1 >= settings.SNAPSHOT_KEYFRAME_INTERVAL
+
+
+def find_removed_tracks(previous_tracks: List[Track], current_ids: Set[str]) -> List[Track]:
+    """Tracks from the previous list that are gone, one entry per track id"""
+    removed: Dict[str, Track] = {}
+    for track in previous_tracks:
+        if track['id'] not in current_ids and track['id'] not in removed:
+            removed[track['id']] = track
+    return list(removed.values())
+
+
+def build_delta(base_file_name: str, previous_tracks: List[Track], tracks: List[Track]) -> Dict[str, Any]:
+    """
+    Builds the add/remove delta between two track lists. Added tracks keep their
+    index in the new list so the reader can rebuild it in order. If moved or
+    repeated tracks keep that from rebuilding the new list, see add_delta_order.
+    """
+    previous_ids = {track['id'] for track in previous_tracks}
+    current_ids = {track['id'] for track in tracks}
+
+    delta = {
+        'format': 'delta',
+        'base': base_file_name,
+        'added': [{'index': index, 'track': track} for index, track in enumerate(tracks)
+                  if track['id'] not in previous_ids],
+        'removed': find_removed_tracks(previous_tracks, current_ids)
+    }
+    add_delta_order(delta, [track['id'] for track in previous_tracks], [track['id'] for track in tracks])
+    return delta
+
+
+def add_delta_order(delta: Dict[str, Any], previous_ids: List[Optional[str]], current_ids: List[Optional[str]]):
+    """
+    Replays the delta on the previous ids and, when that doesn't give back the
+    current ids (tracks were moved, repeated or lost a copy), adds "order": the
+    index in the previous list of every current track that wasn't added.
+    """
+    if apply_delta_ids(previous_ids, delta) == current_ids:
+        return
+
+    positions: Dict[Optional[str], List[int]] = {}
+    for index, track_id in enumerate(previous_ids):
+        positions.setdefault(track_id, []).append(index)
+    added_indexes = {added['index'] for added in delta['added']}
+    copies: Dict[Optional[str], int] = {}
+    order = []
+    for index, track_id in enumerate(current_ids):
+        if index in added_indexes:
+            continue
+        # More copies than before reuse the last previous one
+        copy = copies.get(track_id, 0)
+        order.append(positions[track_id][min(copy, len(positions[track_id]) - 1)])
+        copies[track_id] = copy + 1
+    delta['order'] = order
+
+
+def apply_delta(tracks: List[Track], delta: Dict[str, Any]) -> List[Track]:
+    if 'order' in delta:
+        result = [tracks[index] for index in delta['order']]
+    else:
+        removed_ids = {track['id'] for track in delta['removed']}
+        result = [track for track in tracks if track['id'] not in removed_ids]
+    for added in sorted(delta['added'], key=lambda added: added['index']):
+        result.insert(added['index'], added['track'])
+    return result
+
+
+def apply_delta_ids(track_ids: List[Optional[str]], delta: Dict[str, Any]) -> List[Optional[str]]:
+    """apply_delta on the ids of a track list"""
+    if 'order' in delta:
+        result = [track_ids[index] for index in delta['order']]
+    else:
+        removed_ids = {track['id'] for track in delta['removed']}
+        result = [track_id for track_id in track_ids if track_id not in removed_ids]
+    for added in sorted(delta['added'], key=lambda added: added['index']):
+        result.insert(added['index'], added['track']['id'])
+    return result
+
+
+def _store(file_name: str, file: Union[bytes, str], content_type: str):
+    """Uploads bytes, or the file at a path, and keeps a copy in the snapshot cache"""
+    with phase('upload'):
+        if isinstance(file, bytes):
+            supabase.storage.from_(SNAPSHOT_BUCKET).upload(
+                path=file_name, file=file, file_options={"content-type": content_type})
+        else:
+            # Sent in chunks from the open file
+            with open(file, 'rb') as upload_file:
+                supabase.storage.from_(SNAPSHOT_BUCKET).upload(
+                    path=file_name, file=upload_file, file_options={"content-type": content_type})
+        # This snapshot is the "previous" one of the next run
+        if snapshot_cache:
+            if isinstance(file, bytes):
+                snapshot_cache.put(file_name, file)
+            else:
+                with open(file, 'rb') as cache_file:
+                    snapshot_cache.put_file(file_name, cache_file)
+
+
+def upload_snapshot(file_name: str, payload: Any) -> int:
+    """Uploads a keyframe (list of tracks) or delta (dict), returns the stored size"""
+    kind = 'delta' if is_delta(file_name) else 'keyframe'
+    with phase('serialize'):
+        # Ids the binary format can't hold are stored as JSON instead, readers go by the content
+        if is_binary(file_name) and all(is_track_id(track['id']) for track in payload if track['id']):
+            data = encode_snapshot(payload)
+            content_type = "application/octet-stream"
+            SNAPSHOT_BYTES.labels('binary', kind, 'stored').observe(len(data))
+        else:
+            raw = json.dumps(payload).encode('utf-8')
+            data = gzip.compress(raw)
+            content_type = "application/gzip"
+            SNAPSHOT_BYTES.labels('json', kind, 'raw').observe(len(raw))
+            SNAPSHOT_BYTES.labels('json', kind, 'stored').observe(len(data))
+    _store(file_name, data, content_type)
+    return len(data)
+
+
+class SnapshotWriter:
+    """
+    Builds a snapshot from pages of tracks as they are fetched, so a library is
+    never held as one JSON string and one compressed buffer at the same time.
+
+    JSON keyframes are compressed page by page, in memory until they pass
+    SNAPSHOT_SPOOL_MAX_BYTES and in a temp file after that. Deltas only keep the
+    added tracks and are built from the previous snapshot's ids (see
+    load_snapshot_order), the details of removed tracks are looked up on upload().
+    Binary keyframes are ordered by id, so their tracks are kept until upload().
+    Only the ids of the tracks written are kept besides that, for the diff
+    against the previous snapshot.
+    """
+
+    def __init__(self, file_name: str, base_file_name: Optional[str] = None,
+                 previous_ids: Optional[List[Optional[str]]] = None):
+        self.file_name = file_name
+        self.count = 0
+        self.track_ids: Set[str] = set()
+        self.delta: Optional[Dict[str, Any]] = None
+        self._tracks: List[Track] = []
+        self._compressor = None
+        self._buffer: Optional[io.BytesIO] = None
+        self._spool = None
+        self._stored = 0
+        self._raw = 0
+
+        if is_delta(file_name):
+            self._previous_order = previous_ids or []
+            self._previous_ids = set(self._previous_order)
+            self.delta = {'format': 'delta', 'base': base_file_name, 'added': [], 'removed': []}
+            # In order, to check the delta rebuilds them
+            self._current_ids: List[Optional[str]] = []
+        elif not is_binary(file_name):
+            # wbits 31 writes a gzip header, so the file reads back with gzip.decompress
+            self._compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            self._buffer = io.BytesIO()
+
+    def __enter__(self) -> 'SnapshotWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_compressed(self, raw: bytes, final: bool = False):
+        self._raw += len(raw)
+        data = self._compressor.compress(raw)
+        if final:
+            data += self._compressor.flush()
+        if not data:
+            return
+        self._stored += len(data)
+        if self._spool is not None:
+            self._spool.write(data)
+            return
+        self._buffer.write(data)
+        if self._buffer.tell() > settings.SNAPSHOT_SPOOL_MAX_BYTES:
+            os.makedirs(settings.SNAPSHOT_SPOOL_DIR, exist_ok=True)
+            self._spool = tempfile.NamedTemporaryFile(
+                dir=settings.SNAPSHOT_SPOOL_DIR, suffix=KEYFRAME_SUFFIX, delete=False)
+            self._spool.write(self._buffer.getbuffer())
+            self._buffer = None
+
+    def write(self, tracks: List[Track]):
+        """Adds the next page of tracks, in library order"""
+        if self.delta is not None:
+            self.delta['added'].extend(
+                {'index': self.count + index, 'track': track} for index, track in enumerate(tracks)
+                if track['id'] not in self._previous_ids)
+            self._current_ids.extend(track['id'] for track in tracks)
+        elif self._compressor is not None:
+            # Same text as json.dumps of the whole list
+            text = ', '.join(json.dumps(track) for track in tracks)
+            if tracks:
+                self._write_compressed(((', ' if self.count else '[') + text).encode('utf-8'))
+        else:
+            self._tracks.extend(tracks)
+        self.track_ids.update(track['id'] for track in tracks)
+        self.count += len(tracks)
+
+    def ids(self) -> np.ndarray:
+        """Sorted, encoded ids of the tracks written"""
+        return encode_track_ids(self.track_ids)
+
+    def upload(self) -> int:
+        """Finishes and uploads the snapshot, returns the stored size"""
+        if self.delta is not None:
+            with phase('diff'):
+                removed_ids = self._previous_ids - self.track_ids
+                if removed_ids:
+                    removed = find_snapshot_tracks(self.delta['base'], removed_ids)
+                    self.delta['removed'] = [removed[track_id] for track_id in dict.fromkeys(self._previous_order)
+                                             if track_id in removed]
+                add_delta_order(self.delta, self._previous_order, self._current_ids)
+            return upload_snapshot(self.file_name, self.delta)
+        if self._compressor is None:
+            return upload_snapshot(self.file_name, self._tracks)
+
+        with phase('serialize'):
+            self._write_compressed(b']' if self.count else b'[]', final=True)
+            SNAPSHOT_BYTES.labels('json', 'keyframe', 'raw').observe(self._raw)
+            SNAPSHOT_BYTES.labels('json', 'keyframe', 'stored').observe(self._stored)
+        if self._spool is not None:
+            self._spool.close()
+            _store(self.file_name, self._spool.name, "application/gzip")
+        else:
+            _store(self.file_name, self._buffer.getvalue(), "application/gzip")
+        return self._stored
+
+    def close(self):
+        """Deletes the temp file, if one was needed"""
+        if self._spool is not None:
+            self._spool.close()
+            try:
+                os.unlink(self._spool.name)
+            except FileNotFoundError:
+                pass
+            self._spool = None
+
+
+def _download(file_name: str) -> bytes:
+    if snapshot_cache:
+        data = snapshot_cache.get(file_name)
+        if data is not None:
+            return data
+    with phase('download'):
+        data = supabase.storage.from_(SNAPSHOT_BUCKET).download(file_name)
+    if snapshot_cache:
+        snapshot_cache.put(file_name, data)
+    return data
+
+
+def _decode(data: bytes) -> Any:
+    if is_binary_snapshot(data):
+        return decode_snapshot(data)
+    return json.loads(gzip.decompress(data).decode('utf-8'))
+
+
+def _download_chain(file_name: str) -> Tuple[bytes, List[Dict[str, Any]]]:
+    """Follows delta bases back to the keyframe, returns its raw bytes and the deltas newest first"""
+    chain = []
+    data = _download(file_name)
+    while is_delta(file_name):
+        delta = _decode(data)
+        chain.append(delta)
+        if len(chain) > MAX_DELTA_CHAIN:
+            raise ValueError(
+                f"Delta chain is longer than {MAX_DELTA_CHAIN}")
+        file_name = delta['base']
+        data = _download(file_name)
+    return data, chain
+
+
+def download_snapshot(file_name: str) -> Any:
+    """Downloads and decodes a single snapshot file without replaying deltas"""
+    return _decode(_download(file_name))
+
+
+def load_snapshot(file_name: str) -> Optional[List[Track]]:
+    """Loads the full track list of a snapshot, replaying deltas back to their keyframe"""
+    started = time.perf_counter()
+    try:
+        keyframe, chain = _download_chain(file_name)
+        tracks = _decode(keyframe)
+        for delta in reversed(chain):
+            tracks = apply_delta(tracks, delta)
+        return tracks
+    except Exception as e:
+        logger.error("Error loading snapshot", extra={
+                     "file_name": file_name, "error": str(e)})
+        return None
+    finally:
+        SNAPSHOT_LOAD_SECONDS.labels('tracks').observe(time.perf_counter() - started)
+
+
+def load_snapshot_order(file_name: str) -> Optional[List[Optional[str]]]:
+    """
+    Loads the track ids of a snapshot in playlist order, repeats included. Binary
+    keyframes are read without their metadata, JSON ones are only held until
+    their ids are taken.
+    """
+    started = time.perf_counter()
+    try:
+        keyframe, chain = _download_chain(file_name)
+        if is_binary_snapshot(keyframe):
+            track_ids = decode_snapshot_order(keyframe)
+        else:
+            track_ids = [track['id'] for track in _decode(keyframe)]
+        for delta in reversed(chain):
+            track_ids = apply_delta_ids(track_ids, delta)
+        return track_ids
+    except Exception as e:
+        logger.error("Error loading snapshot order", extra={
+                     "file_name": file_name, "error": str(e)})
+        return None
+    finally:
+        SNAPSHOT_LOAD_SECONDS.labels('order').observe(time.perf_counter() - started)
+
+
+def find_snapshot_tracks(file_name: str, track_ids: Set[Optional[str]]) -> Dict[Optional[str], Track]:
+    """
+    Details of some tracks of a snapshot, by id. The added tracks of its deltas
+    are searched newest first, the keyframe is only decoded for ids still missing.
+    """
+    keyframe, chain = _download_chain(file_name)
+    found: Dict[Optional[str], Track] = {}
+    for delta in chain:
+        for added in delta['added']:
+            track = added['track']
+            if track['id'] in track_ids and track['id'] not in found:
+                found[track['id']] = track
+    if len(found) < len(track_ids):
+        for track in _decode(keyframe):
+            if track['id'] in track_ids and track['id'] not in found:
+                found[track['id']] = track
+    return found
+
+
+def load_snapshot_ids(file_name: str) -> Optional[np.ndarray]:
+    """
+    Loads only the sorted, encoded track ids of a snapshot. Binary keyframes are
+    read without touching their metadata, deltas are replayed on the id array.
+    """
+    started = time.perf_counter()
+    if snapshot_cache:
+        ids = snapshot_cache.get_ids(file_name)
+        if ids is not None:
+            SNAPSHOT_LOAD_SECONDS.labels('ids').observe(time.perf_counter() - started)
+            return ids
+
+    try:
+        keyframe, chain = _download_chain(file_name)
+        if is_binary_snapshot(keyframe):
+            ids = decode_snapshot_ids(keyframe)
+        else:
+            ids = encode_track_ids(track['id'] for track in _decode(keyframe))
+
+        for delta in reversed(chain):
+            removed_ids = encode_track_ids(track['id'] for track in delta['removed'])
+            added_ids = encode_track_ids(added['track']['id'] for added in delta['added'])
+            ids = np.union1d(np.setdiff1d(ids, removed_ids, assume_unique=True), added_ids)
+    except Exception as e:
+        logger.error("Error loading snapshot ids", extra={
+                     "file_name": file_name, "error": str(e)})
+        return None
+
+    if snapshot_cache:
+        snapshot_cache.put_ids(file_name, ids)
+    SNAPSHOT_LOAD_SECONDS.labels('ids').observe(time.perf_counter() - started)
+    return ids
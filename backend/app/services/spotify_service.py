@@ -1,17 +1,23 @@
-from typing import Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from pydantic import BaseModel
 from sklearn.preprocessing import StandardScaler
-import spotipy
 
-from datetime import datetime, timezone
+from spotipy import SpotifyException
 from spotipy.oauth2 import SpotifyClientCredentials
 
 from app.core.config import settings
-from app.db.supabase import supabase
+from app.core.metrics import observe_snapshot_pages
 from app.models.track import Track
 from app.models.spotify_access import SpotifyAccess
 from app.models.cached_tracks import CachedTrack
 from app.models.tracked_playlists import TrackedPlaylist
+from app.services.rate_limiter import RateLimitedSpotify, spotify_limiter
+from app.services.entity_cache import artist_genres_cache, audio_features_cache, tracks_cache
+from app.services.similarity import SimilarityMatrixEngine, top_k_indices
+from app.services.token_manager import token_manager
 from app.core.logging import setup_logging
 import numpy as np
 
@@ -27,20 +33,30 @@ class Suggestion(BaseModel):
 
 
 class SpotifyService:
-    def __init__(self, spotify_access: Optional[SpotifyAccess] = None):
-        access_token = self.get_access_token(spotify_access)
+    def __init__(self, spotify_access: Optional[SpotifyAccess] = None, page_concurrency: Optional[int] = None,
+                 access_token: Optional[str] = None):
+        if not access_token:
+            access_token = self.get_access_token(spotify_access)
         if not access_token:
             logger.error(
                 f"Could not get access token for user {spotify_access.user_id}")
             raise Exception(
                 f"Could not get access token for user {spotify_access.user_id}")
-        self.sp = spotipy.Spotify(auth=access_token)
+        self.sp = RateLimitedSpotify(auth=access_token, limiter=spotify_limiter)
         self.cache = {
             'top_tracks': None,
             'top_artists': None,
             'audio_features': {},
-            'artist_genres': {}
+            'artist_genres': {},
+            'tracks': {}
         }
+        # Max pages fetched at once for this user, 1 fetches sequentially
+        self.page_concurrency = page_concurrency or settings.SPOTIFY_PAGE_CONCURRENCY
+
+    @classmethod
+    def for_user(cls, user_id: str, page_concurrency: Optional[int] = None) -> 'SpotifyService':
+        """Builds a service for user_id with a token from the token manager"""
+        return cls(page_concurrency=page_concurrency, access_token=token_manager.get_token(user_id))
 
     def create_playlist(self, user_id: str, tracked_playlist: TrackedPlaylist):
         result = self.sp.user_playlist_create(user_id, tracked_playlist.removed_playlist_name, public=tracked_playlist.public,
@@ -50,9 +66,10 @@ class SpotifyService:
         return result['id']
 
     def remove_tracks_from_playlist(self, playlist_id: str, track_ids: list[str]):
-        body = [{"uri": f"spotify:track:{tid}"} for tid in track_ids]
-        self.sp.playlist_remove_all_occurrences_of_items(
-            playlist_id=playlist_id, items=body)
+        # Spotify allows up to 100 tracks per request, spotipy builds the {"uri": ...} body itself
+        for i in range(0, len(track_ids), 100):
+            self.sp.playlist_remove_all_occurrences_of_items(
+                playlist_id=playlist_id, items=track_ids[i:i+100])
 
     def add_tracks_to_playlist(self, playlist_id: str, track_ids: list[str]):
         self.sp.playlist_add_items(playlist_id, track_ids)
@@ -71,19 +88,65 @@ class SpotifyService:
 
     def get_audio_features(self, track_ids: List[str]) -> List[Dict]:
         missing_ids = [
-            tid for tid in track_ids if tid not in self.cache['audio_features']]
+            tid for tid in dict.fromkeys(track_ids) if tid not in self.cache['audio_features']]
         if missing_ids:
-            features = self.sp.audio_features(missing_ids)
-            for tid, feature in zip(missing_ids, features):
+            features = audio_features_cache.get_or_fetch(
+                missing_ids, self._fetch_audio_features)
+            for tid, feature in features.items():
                 if feature:  # Check if feature is not None
                     self.cache['audio_features'][tid] = feature
         return [self.cache['audio_features'].get(tid) for tid in track_ids if self.cache['audio_features'].get(tid)]
 
+    def _fetch_audio_features(self, track_ids: List[str]) -> Dict[str, Optional[Dict]]:
+        features = {}
+        # Spotify allows up to 100 tracks per request
+        for i in range(0, len(track_ids), 100):
+            batch = track_ids[i:i+100]
+            features.update(zip(batch, self.sp.audio_features(batch)))
+        return features
+
     def get_artist_genres(self, artist_id: str) -> List[str]:
-        if artist_id not in self.cache['artist_genres']:
-            self.cache['artist_genres'][artist_id] = self.sp.artist(artist_id)[
-                'genres']
-        return self.cache['artist_genres'][artist_id]
+        return self.get_artists_genres([artist_id]).get(artist_id, [])
+
+    def get_artists_genres(self, artist_ids: List[str]) -> Dict[str, List[str]]:
+        missing_ids = [
+            aid for aid in dict.fromkeys(artist_ids) if aid not in self.cache['artist_genres']]
+        if missing_ids:
+            self.cache['artist_genres'].update(
+                artist_genres_cache.get_or_fetch(missing_ids, self._fetch_artist_genres))
+        return {aid: self.cache['artist_genres'][aid] for aid in artist_ids if aid in self.cache['artist_genres']}
+
+    def _fetch_artist_genres(self, artist_ids: List[str]) -> Dict[str, List[str]]:
+        genres = {}
+        # Spotify allows up to 50 artists per request
+        for i in range(0, len(artist_ids), 50):
+            batch = artist_ids[i:i+50]
+            for artist in self.sp.artists(batch)['artists']:
+                if artist:
+                    genres[artist['id']] = artist['genres']
+        return genres
+
+    def get_tracks(self, track_ids: List[str]) -> Dict[str, Dict]:
+        """Full track objects, shared across users through the entity cache"""
+        missing_ids = [
+            tid for tid in dict.fromkeys(track_ids) if tid not in self.cache['tracks']]
+        if missing_ids:
+            self.cache['tracks'].update(
+                tracks_cache.get_or_fetch(missing_ids, self._fetch_tracks))
+        return {tid: self.cache['tracks'][tid] for tid in track_ids if tid in self.cache['tracks']}
+
+    def _fetch_tracks(self, track_ids: List[str]) -> Dict[str, Dict]:
+        tracks = {}
+        # Spotify allows up to 50 tracks per request
+        for i in range(0, len(track_ids), 50):
+            batch = track_ids[i:i+50]
+            for track in self.sp.tracks(batch)['tracks']:
+                if track:
+                    # Market lists make up most of a track object and are never used
+                    track.pop('available_markets', None)
+                    track.get('album', {}).pop('available_markets', None)
+                    tracks[track['id']] = track
+        return tracks
 
     def search_track(self, track_name: str, artist_name: str) -> Optional[Dict]:
         query = f"track:{track_name} artist:{artist_name}"
@@ -152,25 +215,15 @@ class SpotifyService:
 
         return final_similarity
 
-    def suggest_accidentally_removed_tracks(self, songs: List[str], similarity_threshold: float = 0.7) -> List[Suggestion]:
-        top_tracks = self.get_user_top_tracks(limit=50)
-        top_track_ids = [track['id'] for track in top_tracks]
-        user_top_artists = self.get_user_top_artists(limit=50)
-
+    def _score_tracks(self, songs: List[str], top_track_ids: List[str],
+                      top_artist_ids: List[str]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """Max and mean similarity of each of songs against the top tracks, for the songs that could be scored"""
         # Batch fetch audio features
         all_track_ids = top_track_ids + songs
         self.get_audio_features(all_track_ids)
 
-        # Batch fetch full track info
-        tracks_to_fetch = songs + \
-            [tid for tid in top_track_ids if tid not in self.cache.get(
-                'tracks', {})]
-        if tracks_to_fetch:
-            track_infos = self.sp.tracks(tracks_to_fetch)['tracks']
-            if 'tracks' not in self.cache:
-                self.cache['tracks'] = {}
-            for track in track_infos:
-                self.cache['tracks'][track['id']] = track
+        # Batch fetch full track info, top tracks that came back as full objects are already cached
+        self.get_tracks(all_track_ids)
 
         # Batch fetch artist genres
         all_artist_ids = set()
@@ -178,126 +231,181 @@ class SpotifyService:
             if track_id in self.cache['tracks']:
                 all_artist_ids.add(
                     self.cache['tracks'][track_id]['artists'][0]['id'])
+        self.get_artists_genres(list(all_artist_ids))
 
-        missing_artist_ids = [
-            aid for aid in all_artist_ids if aid not in self.cache['artist_genres']]
-        if missing_artist_ids:
-            # Spotify allows up to 50 artists per request
-            for i in range(0, len(missing_artist_ids), 50):
-                batch = missing_artist_ids[i:i+50]
-                artists = self.sp.artists(batch)['artists']
-                for artist in artists:
-                    self.cache['artist_genres'][artist['id']
-                                                ] = artist['genres']
-
-        suggestions = []
-
+        # Only score pairs where both sides have features and track info
+        top_ids = [tid for tid in top_track_ids
+                   if self.cache['audio_features'].get(tid) and self.cache['tracks'].get(tid)]
+        candidate_ids = []
         for track_id in songs:
-            track_features = self.cache['audio_features'].get(track_id)
-            track_info = self.cache['tracks'].get(track_id)
-
-            if not track_features or not track_info:
+            if not self.cache['audio_features'].get(track_id) or not self.cache['tracks'].get(track_id):
                 logger.warning(
                     f"Skipping track {track_id} due to missing data", extra={"track_id": track_id})
                 continue
+            candidate_ids.append(track_id)
 
-            similarities = [
-                self.calculate_similarity(
-                    track_features, track_info,
-                    self.cache['audio_features'].get(top_id),
-                    self.cache['tracks'].get(top_id),
-                    user_top_artists
-                )
-                for top_id in top_track_ids
-                if self.cache['audio_features'].get(top_id) and self.cache['tracks'].get(top_id)
-            ]
+        if not candidate_ids:
+            return [], np.zeros(0), np.zeros(0)
 
-            max_similarity = max(similarities) if similarities else 0
-            avg_similarity = np.mean(similarities) if similarities else 0
+        engine = SimilarityMatrixEngine(
+            top_features=[self.cache['audio_features'][tid] for tid in top_ids],
+            top_infos=[self.cache['tracks'][tid] for tid in top_ids],
+            top_artist_ids=top_artist_ids,
+            artist_genres=self.cache['artist_genres'],
+        )
+        max_similarities, avg_similarities = engine.summarize(
+            [self.cache['audio_features'][tid] for tid in candidate_ids],
+            [self.cache['tracks'][tid] for tid in candidate_ids],
+        )
 
-            logger.info(
-                f"Track: {track_info['name']} by {track_info['artists'][0]['name']}", extra={"track_id": track_id})
-            logger.info(
-                f"Max Similarity: {max_similarity:.4f}", extra={"track_id": track_id})
-            logger.info(
-                f"Average Similarity: {avg_similarity:.4f}", extra={"track_id": track_id})
+        logger.info(f"Scored {len(candidate_ids)} tracks against {len(top_ids)} top tracks", extra={
+                    "candidates": len(candidate_ids), "top_tracks": len(top_ids)})
+        return candidate_ids, max_similarities, avg_similarities
+
+    def _suggestion(self, track_id: str, max_similarity: float, avg_similarity: float) -> Suggestion:
+        track_info = self.cache['tracks'][track_id]
+        return Suggestion(
+            track_id=track_id,
+            name=track_info['name'],
+            artist=track_info['artists'][0]['name'],
+            max_similarity=float(max_similarity),
+            avg_similarity=float(avg_similarity)
+        )
 
-            if max_similarity > similarity_threshold:
-                suggestions.append(Suggestion(
-                    track_id=track_id,
-                    name=track_info['name'],
-                    artist=track_info['artists'][0]['name'],
-                    max_similarity=max_similarity,
-                    avg_similarity=avg_similarity
-                ))
+    def score_removed_tracks(self, songs: List[str], top_track_ids: List[str],
+                             top_artist_ids: List[str]) -> List[Suggestion]:
+        """Scores songs against a stored taste profile, unranked and without a threshold"""
+        candidate_ids, max_similarities, avg_similarities = self._score_tracks(
+            songs, top_track_ids, top_artist_ids)
+        return [self._suggestion(track_id, max_similarities[index], avg_similarities[index])
+                for index, track_id in enumerate(candidate_ids)]
 
-        suggestions.sort(key=lambda x: x.max_similarity, reverse=True)
-        return suggestions
+    def suggest_accidentally_removed_tracks(self, songs: List[str], similarity_threshold: float = 0.7,
+                                            limit: Optional[int] = None) -> List[Suggestion]:
+        top_tracks = self.get_user_top_tracks(limit=50)
+        top_track_ids = [track['id'] for track in top_tracks]
+        user_top_artists = self.get_user_top_artists(limit=50)
 
-    # Fetch all songs for a user's playlist
-    def get_user_playlist_songs(self, spotify_user_id, playlist_id) -> list[Track]:
-        all_tracks: list[Track] = []
-        total_tracks = 0
-        offset = 0
-        limit = 100  # Spotify allows up to 100 tracks per request for playlists
+        # Top tracks already come back as full objects
+        for track in top_tracks:
+            self.cache['tracks'].setdefault(track['id'], track)
+
+        candidate_ids, max_similarities, avg_similarities = self._score_tracks(
+            songs, top_track_ids, [artist['id'] for artist in user_top_artists])
+        if not candidate_ids:
+            return []
+
+        above_threshold = np.flatnonzero(max_similarities > similarity_threshold)
+        ranked = above_threshold[top_k_indices(
+            max_similarities[above_threshold], limit)]
+
+        return [self._suggestion(candidate_ids[index], max_similarities[index], avg_similarities[index])
+                for index in ranked]
+
+    def get_playlist_snapshot_id(self, playlist_id: str) -> Optional[str]:
+        # Spotify's version identifier for the playlist, changes on every edit
+        result = self.sp.playlist(playlist_id, fields='snapshot_id')
+        return result.get('snapshot_id') if result else None
+
+    @staticmethod
+    def _track_from_item(item: Dict) -> Track:
+        track = item['track']
+        return {
+            'id': track['id'],
+            'name': track['name'],
+            'artist': track['artists'][0]['name'],
+            'album': track['album']['name'],
+            'added_at': item['added_at'],
+            'image': track['album']['images'][0]['url'] if track['album']['images'] else None
+        }
 
-        while True:
-            results = self.sp.user_playlist_tracks(spotify_user_id, playlist_id,
-                                                   limit=limit,
-                                                   offset=offset,
-                                                   )
+    def _iter_pages(self, fetch_page: Callable[[int, int], Dict], limit: int) -> Iterator[List[Dict]]:
+        """
+        Yields the items of every page of a paged endpoint, in order. Once the
+        first page reports the total, the next offsets are fetched concurrently
+        (up to page_concurrency at a time, never more than twice that ahead of the
+        consumer). If that fails with a transport or 5xx error, the remaining pages
+        are fetched one after another, other Spotify errors are raised.
+        """
+        first_page = fetch_page(limit, 0)
+        total = first_page.get('total')
+        if not first_page['items']:
+            return
+        yield first_page['items']
+        fetched = len(first_page['items'])
+
+        offset = limit
+        if self.page_concurrency > 1 and total and total > limit:
+            offsets = iter(range(limit, total, limit))
+            pending = deque()
+            executor = ThreadPoolExecutor(max_workers=min(
+                self.page_concurrency, -(-(total - limit) // limit)))
+            try:
+                for page_offset in islice(offsets, self.page_concurrency * 2):
+                    pending.append((page_offset, executor.submit(fetch_page, limit, page_offset)))
+                while pending:
+                    page_offset, future = pending[0]
+                    page = future.result()
+                    pending.popleft()
+                    for next_offset in islice(offsets, 1):
+                        pending.append((next_offset, executor.submit(fetch_page, limit, next_offset)))
+                    offset = page_offset + limit
+                    fetched += len(page['items'])
+                    logger.info(f"Fetched {fetched} of {total} tracks so far", extra={
+                                "total_tracks": fetched})
+                    yield page['items']
+            except Exception as exc:
+                # Fetching one page at a time only helps with transport and server errors, a
+                # rate limit or a rejected token would fail again with twice the calls
+                if isinstance(exc, SpotifyException) and exc.http_status is not None and exc.http_status < 500:
+                    raise
+                logger.warning(f"Concurrent page fetch failed, falling back to sequential: {exc}", extra={
+                               "total": total, "error": str(exc)})
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+        # Sequential fetching of whatever is left
+        while total is None or offset < total:
+            results = fetch_page(limit, offset)
             if not results['items']:
                 break
-
-            for item in results['items']:
-                track = item['track']
-                all_tracks.append({
-                    'id': track['id'],
-                    'name': track['name'],
-                    'artist': track['artists'][0]['name'],
-                    'album': track['album']['name'],
-                    'added_at': item['added_at'],
-                    'image': track['album']['images'][0]['url'] if track['album']['images'] else None
-                })
-
-            total_tracks += len(results['items'])
+            yield results['items']
+            fetched += len(results['items'])
             offset += limit
 
             logger.info(
-                f"Fetched {total_tracks} tracks from playlist so far", extra={"total_tracks": total_tracks})
-
-        return all_tracks
+                f"Fetched {fetched} tracks so far", extra={"total_tracks": fetched})
 
-    # Fetch all liked songs for a user
-    def get_user_liked_songs(self) -> list[Track]:
-        all_tracks: list[Track] = []
-        total_tracks = 0
-        offset = 0
-        limit = 50
+    def _iter_track_pages(self, fetch_page: Callable[[int, int], Dict], limit: int, source: str) -> Iterator[List[Track]]:
+        items = 0
+        for page in self._iter_pages(fetch_page, limit):
+            items += len(page)
+            yield [self._track_from_item(item) for item in page]
+        observe_snapshot_pages(source, items, limit)
 
-        while True:
-            results = self.sp.current_user_saved_tracks(
-                limit=limit, offset=offset)
-            if not results['items']:
-                break
+    # Fetch a user's playlist one page of songs at a time
+    def iter_user_playlist_songs(self, spotify_user_id, playlist_id) -> Iterator[List[Track]]:
+        limit = 100  # Spotify allows up to 100 tracks per request for playlists
+        return self._iter_track_pages(
+            lambda page_limit, offset: self.sp.user_playlist_tracks(
+                spotify_user_id, playlist_id, limit=page_limit, offset=offset),
+            limit, 'playlist')
 
-            for item in results['items']:
-                all_tracks.append({
-                    'id': item['track']['id'],
-                    'name': item['track']['name'],
-                    'artist': item['track']['artists'][0]['name'],
-                    'album': item['track']['album']['name'],
-                    'added_at': item['added_at'],
-                    'image': item['track']['album']['images'][0]['url'] if item['track']['album']['images'] else None
-                })
-
-            total_tracks += len(results['items'])
-            offset += limit
+    # Fetch a user's liked songs one page at a time
+    def iter_user_liked_songs(self) -> Iterator[List[Track]]:
+        limit = 50
+        return self._iter_track_pages(
+            lambda page_limit, offset: self.sp.current_user_saved_tracks(
+                limit=page_limit, offset=offset),
+            limit, 'liked_songs')
 
-            logger.info(
-                f"Fetched {total_tracks} tracks so far", extra={"total_tracks": total_tracks})
+    # Fetch all songs for a user's playlist
+    def get_user_playlist_songs(self, spotify_user_id, playlist_id) -> list[Track]:
+        return [track for page in self.iter_user_playlist_songs(spotify_user_id, playlist_id) for track in page]
 
-        return all_tracks
+    # Fetch all liked songs for a user
+    def get_user_liked_songs(self) -> list[Track]:
+        return [track for page in self.iter_user_liked_songs() for track in page]
 
     def get_tracks_info(self, track_ids):
         # Fetch Full Track information for a list of track ids
@@ -311,44 +419,13 @@ class SpotifyService:
 
     def get_access_token(self, spotify_access: Optional[SpotifyAccess] = None):
         if spotify_access:
-            access_token = spotify_access.access_token
-            refresh_token = spotify_access.refresh_token
-            expires_at = spotify_access.expires_at
-
-            current_time = datetime.now(timezone.utc)
-            if current_time.timestamp() >= expires_at.timestamp():
-                # Token has expired, refresh it
-                new_access_token, new_expires_at = self.refresh_access_token(
-                    refresh_token)
-
-                # Convert new_expires_at to datetime if it's an integer
-                if isinstance(new_expires_at, int):
-                    new_expires_at = datetime.fromtimestamp(
-                        new_expires_at, tz=timezone.utc)
-
-                # Update the database with new token information
-                supabase.table('Spotify Access').update({
-                    'access_token': new_access_token,
-                    'expires_at': new_expires_at.isoformat()
-                }).eq('id', spotify_access.id).execute()
-
-                # Use the new access token
-                access_token = new_access_token
-            return access_token
+            return token_manager.get_token(spotify_access.user_id, spotify_access)
         else:
-            logger.error(
-                f"No Spotify access found for user {spotify_access.user_id}", extra={"spotify_access": spotify_access.model_dump()})
-            raise Exception(
-                f"No Spotify access found for user {spotify_access.user_id}")
+            logger.error("No Spotify access found")
+            raise Exception("No Spotify access found")
 
     def refresh_access_token(self, refresh_token):
-        sp_oauth = spotipy.SpotifyOAuth(
-            client_id=settings.SPOTIFY_CLIENT_ID,
-            client_secret=settings.SPOTIFY_CLIENT_SECRET,
-            redirect_uri='https://fsbhjfbuuxyyqixspxgo.supabase.co/auth/v1/callback',
-            scope='user-library-read,user-read-email,playlist-read-private,playlist-modify-private,playlist-modify-public,user-top-read',
-        )
-        token_info = sp_oauth.refresh_access_token(refresh_token)
+        token_info = token_manager.refresh_access_token(refresh_token)
         return token_info['access_token'], token_info['expires_at']
 
 
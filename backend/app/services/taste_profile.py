@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+from app.db.supabase import supabase
+from app.models.taste_profiles import TasteProfile
+from app.services.spotify_service import SpotifyService, Suggestion
+from app.core.logging import setup_logging
+
+logger = setup_logging("taste_profile")
+
+# These songs can't be removed by accident
+EXCLUDED_PLAYLISTS = ['On Repeat', 'Release Radar']
+SIMILARITY_THRESHOLD = 0.7
+
+
+def load_taste_profile(user_id: str) -> Optional[TasteProfile]:
+    result = supabase.table('Taste Profiles').select(
+        '*').eq('user_id', user_id).limit(1).execute()
+    return TasteProfile(**result.data[0]) if result and result.data else None
+
+
+def is_stale(profile: TasteProfile, now: datetime) -> bool:
+    return profile.updated_at < now - timedelta(days=settings.TASTE_PROFILE_MAX_AGE_DAYS)
+
+
+def refresh_taste_profile(user_id: str, spotify_service: Optional[SpotifyService] = None) -> TasteProfile:
+    """Stores the user's current top tracks and artists, the side removed tracks are scored against"""
+    if spotify_service is None:
+        spotify_service = SpotifyService.for_user(user_id)
+    top_tracks = spotify_service.get_user_top_tracks(limit=50)
+    top_artists = spotify_service.get_user_top_artists(limit=50)
+    # Top tracks come back as full objects, score_removed_tracks can use them without refetching
+    for track in top_tracks:
+        spotify_service.cache['tracks'].setdefault(track['id'], track)
+
+    result = supabase.table('Taste Profiles').upsert({
+        'user_id': user_id,
+        'top_track_ids': [track['id'] for track in top_tracks],
+        'top_artist_ids': [artist['id'] for artist in top_artists],
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    }, on_conflict='user_id').execute()
+    if not result or not result.data:
+        logger.error("Error upserting Taste Profile", extra={
+                     "user_id": user_id, "result": result})
+        raise Exception(f"Error upserting Taste Profile for user {user_id}")
+
+    logger.info(f"Refreshed taste profile for user {user_id}", extra={
+                "user_id": user_id, "top_tracks": len(top_tracks), "top_artists": len(top_artists)})
+    return TasteProfile(**result.data[0])
+
+
+def score_removed_songs(user_id: str, track_ids: List[str], spotify_service: SpotifyService) -> Dict[str, Dict]:
+    """
+    Deleted Songs score columns for each of track_ids, scored against the user's
+    taste profile. Builds the profile first if the user doesn't have one yet.
+    Tracks that can't be scored get no entry.
+    """
+    profile = load_taste_profile(user_id)
+    if profile is None:
+        profile = refresh_taste_profile(user_id, spotify_service)
+
+    scored_at = datetime.now(timezone.utc).isoformat()
+    suggestions = spotify_service.score_removed_tracks(
+        track_ids, profile.top_track_ids, profile.top_artist_ids)
+    return {suggestion.track_id: {
+        'max_similarity': suggestion.max_similarity,
+        'avg_similarity': suggestion.avg_similarity,
+        'scored_at': scored_at
+    } for suggestion in suggestions}
+
+
+def precomputed_suggestions(deleted_songs: List[Dict], limit: int) -> List[Suggestion]:
+    """Top suggestions among Deleted Songs rows (joined with their Cached Track) that were scored at diff time"""
+    suggestions = [Suggestion(
+        track_id=song['track_id'],
+        name=song['track']['name'],
+        artist=song['track']['artist'],
+        max_similarity=song['max_similarity'],
+        avg_similarity=song['avg_similarity']
+    ) for song in deleted_songs
+        if song.get('scored_at') and song.get('max_similarity') is not None and song['max_similarity'] > SIMILARITY_THRESHOLD]
+    # Best score per track, a track removed from several playlists has a row for each
+    best = {}
+    for suggestion in sorted(suggestions, key=lambda suggestion: suggestion.max_similarity, reverse=True):
+        best.setdefault(suggestion.track_id, suggestion)
+    return list(best.values())[:limit]
@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import spotipy
+from redis.exceptions import LockError, RedisError
+
+from app.core.config import settings
+from app.core.http import spotify_session
+from app.core.logging import setup_logging
+from app.core.metrics import SPOTIFY_TOKEN_REFRESHES
+from app.db.redis import redis_client
+from app.db.supabase import chunks, select_all, supabase
+from app.models.spotify_access import SpotifyAccess
+
+logger = setup_logging("token_manager")
+
+SPOTIFY_REDIRECT_URI = 'https://fsbhjfbuuxyyqixspxgo.supabase.co/auth/v1/callback'
+SPOTIFY_SCOPE = 'user-library-read,user-read-email,playlist-read-private,playlist-modify-private,playlist-modify-public,user-top-read'
+
+
+class TokenManager:
+    """
+    Hands out valid Spotify access tokens per user. Valid tokens are cached in
+    Redis until shortly before they expire, so a task normally gets its token
+    without touching Spotify Access or the OAuth endpoint. Refreshes are
+    single-flight: a Redis lock per user makes concurrent tasks for the same
+    user wait for one refresh instead of each running their own.
+    """
+
+    def __init__(self, margin: int):
+        # Tokens expiring within margin seconds are treated as expired
+        self.margin = margin
+        # Built once, the in-memory cache handler stops spotipy writing a .cache file per refresh
+        self._oauth = spotipy.SpotifyOAuth(
+            client_id=settings.SPOTIFY_CLIENT_ID,
+            client_secret=settings.SPOTIFY_CLIENT_SECRET,
+            redirect_uri=SPOTIFY_REDIRECT_URI,
+            scope=SPOTIFY_SCOPE,
+            cache_handler=spotipy.MemoryCacheHandler(),
+            requests_session=False,
+        )
+
+    @property
+    def oauth(self) -> spotipy.SpotifyOAuth:
+        # The manager is created before workers fork, so the pooled session is looked up per call
+        self._oauth._session = spotify_session()
+        return self._oauth
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"spotify:token:{user_id}"
+
+    @staticmethod
+    def _lock_key(user_id: str) -> str:
+        return f"spotify:token-lock:{user_id}"
+
+    def _get_cached(self, user_id: str) -> Optional[str]:
+        try:
+            token = redis_client.get(self._key(user_id))
+        except RedisError as e:
+            logger.warning(f"Token cache read failed: {e}", extra={"user_id": user_id})
+            return None
+        return token.decode('utf-8') if token else None
+
+    def _set_cached(self, user_id: str, access_token: str, expires_at: datetime):
+        ttl = int(expires_at.timestamp() - datetime.now(timezone.utc).timestamp()) - self.margin
+        if ttl <= 0:
+            return
+        try:
+            redis_client.set(self._key(user_id), access_token, ex=ttl)
+        except RedisError as e:
+            logger.warning(f"Token cache write failed: {e}", extra={"user_id": user_id})
+
+    def _is_valid(self, spotify_access: SpotifyAccess, margin: int) -> bool:
+        if not spotify_access.expires_at:
+            return False
+        return datetime.now(timezone.utc).timestamp() + margin < spotify_access.expires_at.timestamp()
+
+    @staticmethod
+    def load_access(user_id: str) -> SpotifyAccess:
+        spotify_access_result = supabase.table('Spotify Access').select(
+            '*').eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
+        if not spotify_access_result or not spotify_access_result.data:
+            logger.error(f"Error fetching Spotify access for user {user_id}", extra={
+                         "user_id": user_id, "spotify_access_result": spotify_access_result})
+            raise Exception(
+                f"Error fetching Spotify access for user {user_id}")
+        return SpotifyAccess(**spotify_access_result.data[0])
+
+    def refresh_access_token(self, refresh_token: str) -> Dict:
+        return self.oauth.refresh_access_token(refresh_token)
+
+    def _refresh(self, spotify_access: SpotifyAccess) -> SpotifyAccess:
+        try:
+            token_info = self.refresh_access_token(spotify_access.refresh_token)
+        except Exception:
+            SPOTIFY_TOKEN_REFRESHES.labels('error').inc()
+            raise
+        SPOTIFY_TOKEN_REFRESHES.labels('success').inc()
+        expires_at = datetime.fromtimestamp(token_info['expires_at'], tz=timezone.utc)
+
+        update = {
+            'access_token': token_info['access_token'],
+            'expires_at': expires_at.isoformat()
+        }
+        # Spotify may rotate the refresh token
+        if token_info.get('refresh_token') and token_info['refresh_token'] != spotify_access.refresh_token:
+            update['refresh_token'] = token_info['refresh_token']
+        supabase.table('Spotify Access').update(
+            update).eq('id', spotify_access.id).execute()
+
+        logger.info(f"Refreshed Spotify token for user {spotify_access.user_id}", extra={
+                    "user_id": spotify_access.user_id, "expires_at": expires_at})
+        return spotify_access.model_copy(update={
+            'access_token': update['access_token'],
+            'refresh_token': update.get('refresh_token', spotify_access.refresh_token),
+            'expires_at': expires_at
+        })
+
+    def _resolve(self, user_id: str, spotify_access: Optional[SpotifyAccess], min_valid: int) -> str:
+        """Returns a token valid for min_valid more seconds, refreshing it if needed. Caller holds the lock."""
+        if spotify_access is None or not self._is_valid(spotify_access, min_valid):
+            # The row we were given may be older than a refresh another worker just wrote
+            spotify_access = self.load_access(user_id)
+        if not self._is_valid(spotify_access, min_valid):
+            spotify_access = self._refresh(spotify_access)
+        self._set_cached(user_id, spotify_access.access_token, spotify_access.expires_at)
+        return spotify_access.access_token
+
+    def _single_flight(self, user_id: str, spotify_access: Optional[SpotifyAccess], min_valid: int, use_cache: bool) -> str:
+        lock = None
+        try:
+            lock = redis_client.lock(self._lock_key(user_id), timeout=settings.TOKEN_LOCK_TIMEOUT_SECONDS,
+                                     blocking_timeout=settings.TOKEN_LOCK_TIMEOUT_SECONDS)
+            if not lock.acquire():
+                # Whoever holds the lock is slow, go ahead without it rather than fail the task
+                logger.warning(f"Timed out waiting for token lock for user {user_id}", extra={
+                               "user_id": user_id})
+                lock = None
+        except RedisError as e:
+            logger.warning(f"Token lock unavailable: {e}", extra={"user_id": user_id})
+            lock = None
+
+        try:
+            if use_cache and lock:
+                # The previous lock holder has most likely refreshed the token for us
+                token = self._get_cached(user_id)
+                if token:
+                    return token
+            return self._resolve(user_id, spotify_access, min_valid)
+        finally:
+            if lock:
+                try:
+                    lock.release()
+                except (LockError, RedisError):
+                    pass
+
+    def get_token(self, user_id: str, spotify_access: Optional[SpotifyAccess] = None) -> str:
+        """Returns a valid access token for user_id, pass spotify_access if it is already loaded"""
+        token = self._get_cached(user_id)
+        if token:
+            return token
+        return self._single_flight(user_id, spotify_access, self.margin, use_cache=True)
+
+    def invalidate(self, user_id: str, spotify_access: Optional[SpotifyAccess] = None):
+        """
+        Drops the cached token and marks the stored one expired, e.g. after Spotify
+        rejected it. Pass spotify_access if the row is already loaded.
+        """
+        try:
+            redis_client.delete(self._key(user_id))
+        except RedisError as e:
+            logger.warning(f"Token cache delete failed: {e}", extra={"user_id": user_id})
+        if spotify_access is None:
+            spotify_access = self.load_access(user_id)
+        now = datetime.now(timezone.utc).isoformat()
+        # Only the row tokens are read from, older rows of the user are left as they are
+        supabase.table('Spotify Access').update(
+            {'expires_at': now}).eq('id', spotify_access.id).execute()
+
+    def refresh_expiring(self, user_ids: List[str], window: int, concurrency: int) -> Tuple[int, int]:
+        """
+        Refreshes, in parallel, the tokens of user_ids that expire within the next
+        window seconds. Returns the number of refreshed and failed users.
+        """
+        if not user_ids:
+            return 0, 0
+
+        # Latest Spotify Access row per user, a batch of users at a time. Rows are paged
+        # by id, which grows with created_at, so a user's last row is their latest one
+        latest: Dict[str, SpotifyAccess] = {}
+        for user_batch in chunks(user_ids):
+            rows = select_all(lambda: supabase.table('Spotify Access').select(
+                '*').in_('user_id', user_batch).order('id'))
+            for row in rows:
+                latest[row['user_id']] = SpotifyAccess(**row)
+
+        expiring = [access for access in latest.values()
+                    if not self._is_valid(access, window)]
+
+        def refresh(spotify_access: SpotifyAccess) -> bool:
+            try:
+                self._single_flight(spotify_access.user_id, spotify_access, window, use_cache=False)
+                return True
+            except Exception as e:
+                logger.error(f"Error refreshing token for user {spotify_access.user_id}: {e}", extra={
+                             "user_id": spotify_access.user_id})
+                return False
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            results = list(executor.map(refresh, expiring))
+
+        refreshed = sum(results)
+        return refreshed, len(results) - refreshed
+
+
+token_manager = TokenManager(margin=settings.TOKEN_EXPIRY_MARGIN_SECONDS)
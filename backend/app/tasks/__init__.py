@@ -1,5 +1,7 @@
-from .cron_tasks import queue_user_tasks, weekly_suggestions
-from .take_snapshot import take_snapshot
+from .cron_tasks import queue_user_tasks, weekly_suggestions, refresh_taste_profiles
+from .taste_profiles import refresh_taste_profile
+from .take_snapshot import take_snapshot, snapshot_user
+from .async_snapshots import snapshot_users_async
 from .diff_snapshots import diff_snapshots
-from .suggestion_email import send_suggestion_email
-from .check_song_expiry import check_song_expiry
\ No newline at end of file
+from .suggestion_email import send_suggestion_email, send_suggestion_emails_batch
+from .check_song_expiry import check_song_expiry, expire_deleted_songs
\ No newline at end of file
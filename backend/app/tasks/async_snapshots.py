@@ -0,0 +1,119 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import httpx
+import spotipy
+from requests import HTTPError
+
+from app.core.celery_app import celery_app
+from app.core.config import settings
+from app.core.profiling import phase
+from app.db.supabase import supabase
+from app.services.async_spotify import AsyncSpotify, async_spotify_client
+from app.services.rate_limiter import spotify_limiter
+from app.services.token_manager import token_manager
+from app.tasks.take_snapshot import SnapshotContext, prepare_snapshot, record_unchanged, retry_countdown, store_snapshot, take_snapshot
+from app.core.logging import setup_logging
+
+logger = setup_logging("async_snapshots")
+
+
+async def snapshot_playlist_async(context: SnapshotContext, spotify: AsyncSpotify, playlist: Dict, tracked_playlist: Dict) -> bool:
+    """
+    snapshot_playlist with the Spotify fetches on the event loop. The database,
+    storage and diff steps are the sync ones, run on the loop's thread pool.
+    """
+    user_id = context.user_id
+    playlist_id = playlist['id']
+    spotify_playlist_id = playlist['playlist_id']
+    try:
+        state = await asyncio.to_thread(prepare_snapshot, user_id, playlist_id, tracked_playlist)
+        if state is None:
+            return True
+
+        spotify_snapshot_id = None
+        # Each user's fetches overlap with the others', so this phase adds up to more than the task took
+        if spotify_playlist_id == 'liked_songs':
+            with phase('fetch'):
+                all_tracks = await spotify.get_user_liked_songs()
+        else:
+            # Spotify's snapshot_id only changes when the playlist is edited
+            with phase('fetch'):
+                spotify_snapshot_id = await spotify.get_playlist_snapshot_id(spotify_playlist_id)
+            if await asyncio.to_thread(record_unchanged, state, user_id, playlist_id, spotify_playlist_id, spotify_snapshot_id):
+                return True
+            with phase('fetch'):
+                all_tracks = await spotify.get_user_playlist_songs(spotify_playlist_id)
+
+        # The whole list is written as one page, only the sync engine streams pages as they arrive
+        await asyncio.to_thread(store_snapshot, context, state, playlist_id, spotify_playlist_id, spotify_snapshot_id, [all_tracks])
+        return True
+    except (HTTPError, httpx.HTTPError, spotipy.SpotifyException) as exc:
+        logger.error(f"Error taking snapshot for user {user_id}: {exc}, {spotify_playlist_id}", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+        countdown = await asyncio.to_thread(retry_countdown, exc, user_id)
+        if isinstance(exc, spotipy.SpotifyException) and exc.http_status == 401:
+            context.reset_spotify_service()
+        # Requeued on its own, like snapshot_user does
+        take_snapshot.apply_async(args=[user_id, playlist_id, spotify_playlist_id, playlist['playlist_name']], countdown=countdown)
+    except Exception as exc:
+        logger.error(f"Unexpected error occurred: {str(exc)}", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+    return False
+
+
+async def snapshot_user_async(client: httpx.AsyncClient, global_semaphore: asyncio.Semaphore,
+                              user_id: str, playlists: List[Dict]) -> List[bool]:
+    """All of one user's playlists at once, at most SPOTIFY_PAGE_CONCURRENCY requests in flight for the user"""
+    context = SnapshotContext(user_id)
+    try:
+        with phase('token'):
+            access_token = await asyncio.to_thread(token_manager.get_token, user_id)
+        with phase('db_lookup'):
+            tracked_playlists_result = await asyncio.to_thread(
+                supabase.table('Tracked Playlists').select('*').in_('id', [playlist['id'] for playlist in playlists]).execute)
+    except Exception as exc:
+        logger.error(f"Error preparing snapshots for user {user_id}: {exc}", extra={"user_id": user_id, "playlists": len(playlists)})
+        return [False] * len(playlists)
+    tracked_playlists = {row['id']: row for row in (tracked_playlists_result.data or [])}
+
+    spotify = AsyncSpotify(client, access_token, spotify_limiter, global_semaphore,
+                           asyncio.Semaphore(max(1, settings.SPOTIFY_PAGE_CONCURRENCY)))
+    return await asyncio.gather(*[
+        snapshot_playlist_async(context, spotify, playlist, tracked_playlists.get(playlist['id']))
+        for playlist in playlists])
+
+
+async def run_snapshot_jobs(jobs: List[Dict]) -> Dict:
+    """Drives the snapshots of every job (dicts with user_id and playlists) from one event loop"""
+    loop = asyncio.get_running_loop()
+    # Bounds the sync database, storage and diff steps running at once
+    executor = ThreadPoolExecutor(max_workers=settings.ASYNC_SNAPSHOT_THREADS)
+    loop.set_default_executor(executor)
+    global_semaphore = asyncio.Semaphore(max(1, settings.ASYNC_SNAPSHOT_CONCURRENCY))
+
+    try:
+        async with async_spotify_client() as client:
+            results = await asyncio.gather(*[
+                snapshot_user_async(client, global_semaphore, job['user_id'], job['playlists'])
+                for job in jobs])
+    finally:
+        executor.shutdown(wait=True)
+
+    outcomes = [outcome for user_results in results for outcome in user_results]
+    succeeded = sum(outcomes)
+    return {"users": len(jobs), "succeeded": succeeded, "failed": len(outcomes) - succeeded}
+
+
+@celery_app.task
+def snapshot_users_async(jobs: List[Dict]):
+    """
+    Snapshots many users' playlists from one worker process with asyncio, the
+    async counterpart of queueing a snapshot_user task per user. jobs are dicts
+    with user_id and playlists (id, playlist_id and playlist_name).
+    """
+    logger.info("Taking snapshots for users", extra={"users": len(jobs), "playlists": sum(len(job['playlists']) for job in jobs)})
+    start = time.monotonic()
+    response = asyncio.run(run_snapshot_jobs(jobs))
+    logger.info("Snapshots done for users", extra={**response, "seconds": round(time.monotonic() - start, 2)})
+    return response
@@ -1,8 +1,8 @@
+from typing import Dict, List, Optional
 from app.core.celery_app import celery_app
-from app.db.supabase import supabase
+from app.core.profiling import annotate, phase
+from app.db.supabase import chunks, select_all, supabase
 from app.services.spotify_service import SpotifyService
-from app.models.deleted_songs import DeletedSong
-from app.models.spotify_access import SpotifyAccess
 from app.models.tracked_playlists import TrackedPlaylist
 from app.models.user_settings import UserSettings
 from datetime import datetime, timezone, timedelta
@@ -10,31 +10,136 @@ from app.core.logging import setup_logging
 
 logger = setup_logging("check_song_expiry")
 
+# Define persistence periods in days
+PERSISTENCE_PERIODS = {
+    "30 days": 30,
+    "90 days": 90,
+    "180 days": 180,
+    "1 year": 365
+}
+
+
+def find_expired_songs(user_ids: List[str], max_age_days: int, current_time: datetime,
+                       playlist_id: Optional[int] = None) -> List[Dict]:
+    """Active Deleted Songs rows of user_ids removed more than max_age_days ago"""
+    expiry_threshold = (current_time - timedelta(days=max_age_days)).isoformat()
+    expired = []
+    for user_batch in chunks(user_ids):
+        def query():
+            query = supabase.table('Deleted Songs').select('id, user_id, playlist_id, track_id').in_(
+                'user_id', user_batch).eq('active', True).lte('removed_at', expiry_threshold)
+            if playlist_id is not None:
+                query = query.eq('playlist_id', playlist_id)
+            return query.order('id')
+        with phase('db_lookup'):
+            expired.extend(select_all(query))
+    return expired
+
+
+def expire_songs(expired_songs: List[Dict], user_settings: Dict[str, UserSettings]) -> Dict:
+    """
+    Removes expired songs from each removed-tracks playlist, then marks them
+    inactive with bulk updates. Rows of a user whose Spotify removal failed stay
+    active so the next sweep picks them up again, which makes the sweep safe to rerun.
+    """
+    songs_by_user: Dict[str, List[Dict]] = {}
+    for song in expired_songs:
+        songs_by_user.setdefault(song['user_id'], []).append(song)
+
+    # Removed-tracks playlists, for users that want expired songs taken out of them
+    removal_playlist_ids = list({song['playlist_id'] for song in expired_songs
+                                 if user_settings[song['user_id']].remove_from_playlist})
+    tracked_playlists: Dict[int, TrackedPlaylist] = {}
+    for playlist_batch in chunks(removal_playlist_ids):
+        with phase('db_lookup'):
+            tracked_playlists_result = supabase.table('Tracked Playlists').select(
+                '*').in_('id', playlist_batch).execute()
+        for playlist in tracked_playlists_result.data or []:
+            tracked_playlists[playlist['id']] = TrackedPlaylist(**playlist)
+
+    expired_ids = []
+    removed_from_playlists = 0
+    failed_users = 0
+    for user_id, songs in songs_by_user.items():
+        track_ids_by_playlist: Dict[str, List[str]] = {}
+        if user_settings[user_id].remove_from_playlist:
+            for song in songs:
+                tracked_playlist = tracked_playlists.get(song['playlist_id'])
+                if tracked_playlist and tracked_playlist.removed_playlist_id:
+                    track_ids_by_playlist.setdefault(
+                        tracked_playlist.removed_playlist_id, []).append(song['track_id'])
+
+        if track_ids_by_playlist:
+            try:
+                with phase('token'):
+                    spotify_service = SpotifyService.for_user(user_id)
+                for removed_playlist_id, track_ids in track_ids_by_playlist.items():
+                    with phase('spotify_write'):
+                        spotify_service.remove_tracks_from_playlist(
+                            removed_playlist_id, list(dict.fromkeys(track_ids)))
+                    removed_from_playlists += len(track_ids)
+            except Exception as e:
+                logger.error(f"Error removing expired songs for user {user_id}: {e}", extra={
+                             "user_id": user_id, "songs": len(songs)})
+                failed_users += 1
+                continue
+
+        expired_ids.extend(song['id'] for song in songs)
+
+    for id_batch in chunks(expired_ids):
+        with phase('write_back'):
+            supabase.table('Deleted Songs').update(
+                {'active': False}).in_('id', id_batch).execute()
+
+    return {
+        "expired_songs": len(expired_ids),
+        "removed_from_playlists": removed_from_playlists,
+        "failed_users": failed_users
+    }
+
+
+@celery_app.task
+def expire_deleted_songs():
+    """
+    Periodic sweep over every user: one batched query per persistence setting
+    finds expired Deleted Songs, which are then expired in bulk.
+    """
+    current_time = datetime.now(timezone.utc)
+    with phase('db_lookup'):
+        user_settings_rows = select_all(lambda: supabase.table('User Settings').select(
+            '*').in_('playlist_persistence', list(PERSISTENCE_PERIODS)).order('user_id'))
+    if not user_settings_rows:
+        logger.info("No users with expiring songs. Task ended.")
+        return {"expired_songs": 0, "removed_from_playlists": 0, "failed_users": 0}
+
+    user_settings = {setting['user_id']: UserSettings(**setting)
+                     for setting in user_settings_rows}
+
+    expired_songs: List[Dict] = []
+    for persistence, max_age_days in PERSISTENCE_PERIODS.items():
+        user_ids = [user_id for user_id, setting in user_settings.items()
+                    if setting.playlist_persistence == persistence]
+        if user_ids:
+            expired_songs.extend(find_expired_songs(user_ids, max_age_days, current_time))
+
+    response = expire_songs(expired_songs, user_settings)
+    logger.info("Expired deleted songs", extra={
+                "users": len(user_settings), **response})
+    return response
+
 
 @celery_app.task
 def check_song_expiry(user_id: str, playlist_id: int):
     """
     This Function takes user_id and playlist_id, and checks if any songs in the deleted songs table have expired
     """
-    response = {}
     logger.info("Checking song expiry", extra={
                 "user_id": user_id, "playlist_id": playlist_id})
+    annotate(user_id=user_id, playlist_id=playlist_id)
 
-    # Fetch the tracked playlist
-    tracked_playlist_result = supabase.table('Tracked Playlists').select(
-        '*').eq('id', playlist_id).eq('user_id', user_id).single().execute()
-
-    if not tracked_playlist_result or not tracked_playlist_result.data:
-        logger.error("Error fetching tracked playlist", extra={
-                     "user_id": user_id, "playlist_id": playlist_id, "tracked_playlist_result": tracked_playlist_result})
-        return {
-            "message": f"Error fetching tracked playlist for user {user_id}: {tracked_playlist_result}. Task ended."
-        }
-
-    tracked_playlist = TrackedPlaylist(**tracked_playlist_result.data)
-
-    user_settings_result = supabase.table('User Settings').select(
-        '*').eq('user_id', user_id).single().execute()
+    with phase('db_lookup'):
+        user_settings_result = supabase.table('User Settings').select(
+            '*').eq('user_id', user_id).single().execute()
 
     if not user_settings_result or not user_settings_result.data:
         logger.error("Error fetching user settings", extra={
@@ -44,71 +149,19 @@ def check_song_expiry(user_id: str, playlist_id: int):
 
     user_settings = UserSettings(**user_settings_result.data)
 
-    if user_settings.playlist_persistence == "forever":
+    if user_settings.playlist_persistence not in PERSISTENCE_PERIODS:
         logger.info("Song persistence is set to forever. Task ended.")
         return {
             "message": f"Song persistence is set to forever. Task ended."
         }
 
-    # Fetch the deleted songs
-    deleted_songs_result = supabase.table('Deleted Songs').select(
-        '*').eq('user_id', user_id).eq('playlist_id', playlist_id).eq('active', True).execute()
-
-    if not deleted_songs_result or not deleted_songs_result.data:
-        logger.error("Error fetching deleted songs", extra={
-                     "user_id": user_id, "playlist_id": playlist_id, "deleted_songs_result": deleted_songs_result})
-        raise Exception(
-            f"Error fetching deleted songs for user {user_id}: {deleted_songs_result}. Task ended."
-        )
-
-    deleted_songs = [DeletedSong(**song) for song in deleted_songs_result.data]
-
-    songs_to_expire = []
-    current_time = datetime.now(timezone.utc)
-
-    # Define persistence periods in days
-    persistence_periods = {
-        "30 days": 30,
-        "90 days": 90,
-        "180 days": 180,
-        "1 year": 365
-    }
-
-    if user_settings.playlist_persistence in persistence_periods:
-        max_age_days = persistence_periods[user_settings.playlist_persistence]
-        expiry_threshold = current_time - timedelta(days=max_age_days)
-
-        for song in deleted_songs:
-            if song.removed_at <= expiry_threshold:
-                songs_to_expire.append(song)
-
-    if len(songs_to_expire) > 0:
-        if user_settings.remove_from_playlist and tracked_playlist.removed_playlist_id:
-            spotify_access_result = supabase.table('Spotify Access').select(
-                '*').eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
-            if not spotify_access_result or not spotify_access_result.data:
-                logger.error("Error fetching Spotify access", extra={
-                             "user_id": user_id, "spotify_access_result": spotify_access_result})
-                raise Exception(
-                    f"Error fetching Spotify access for user {user_id}")
-
-            spotify_access: SpotifyAccess = SpotifyAccess(
-                **spotify_access_result.data[0])
-            spotify_service = SpotifyService(spotify_access)
-
-            removed_track_ids = [song.track_id for song in songs_to_expire]
-            spotify_service.remove_tracks_from_playlist(
-                tracked_playlist.removed_playlist_id, removed_track_ids)
-            response['modified_playlist'] = f"Removed {len(removed_track_ids)} tracks from {tracked_playlist.removed_playlist_name}"
-        for song in songs_to_expire:
-            supabase.table('Deleted Songs').update(
-                {'active': False}).eq('id', song.id).execute()
-            response['removed_songs'] = f"Removed {len(songs_to_expire)} songs from Deleted Songs table"
-
-        return response
+    expired_songs = find_expired_songs(
+        [user_id], PERSISTENCE_PERIODS[user_settings.playlist_persistence], datetime.now(timezone.utc), playlist_id)
+    if not expired_songs:
+        logger.info("No songs to expire", extra={
+                    "user_id": user_id, "playlist_id": playlist_id})
+        return {
+            "message": f"No songs to expire for user {user_id} and playlist {playlist_id}"
+        }
 
-    logger.info("No songs to expire", extra={
-                "user_id": user_id, "playlist_id": playlist_id})
-    return {
-        "message": f"No songs to expire for user {user_id} and playlist {playlist_id}"
-    }
+    return expire_songs(expired_songs, {user_id: user_settings})
@@ -1,15 +1,23 @@
 from datetime import datetime, timedelta, timezone
-from math import ceil
 import typing_extensions
-from typing import List
+from typing import List, Optional
 
 from app.core.celery_app import celery_app
-from app.db.supabase import supabase
-from app.tasks.take_snapshot import take_snapshot
-from app.tasks.suggestion_email import send_suggestion_email
+from app.core.config import settings
+from app.db.supabase import chunks, select_all, supabase
+from app.services.cadence import next_snapshot_at
+from app.services.scheduler import SnapshotJob, estimate_cost, plan_schedule
+from app.services.taste_profile import is_stale
+from app.services.token_manager import token_manager
+from app.tasks.taste_profiles import refresh_taste_profile
+from app.models.taste_profiles import TasteProfile
+from app.tasks.take_snapshot import snapshot_user
+from app.tasks.async_snapshots import snapshot_users_async
+from app.tasks.suggestion_email import send_suggestion_email, send_suggestion_emails_batch
 from app.core.logging import setup_logging
 
-logger = setup_logging("cron_tasks")
+# One record per cron run, none of them may be rate limited away
+logger = setup_logging("cron_tasks", rate_limit=0)
 
 
 class TrackedPlaylist(typing_extensions.TypedDict):
@@ -17,90 +25,163 @@ class TrackedPlaylist(typing_extensions.TypedDict):
     user_id: str
     playlist_id: str
     playlist_name: str
+    liked_songs: bool
+    song_count: Optional[int]
+    next_snapshot_at: Optional[str]
 
 
 @celery_app.task
 def queue_user_tasks():
-    EXECUTION_WINDOW = timedelta(hours=1)
-    SUBSET_WINDOW = timedelta(minutes=5)
-    MAX_USERS_PER_SUBSET = 1
-
     logger.info("Queueing user tasks")
-    # Fetch all user settings and tracked playlists in one query
-    user_settings = supabase.table('User Settings').select(
-        'user_id').eq('snapshots_enabled', True).execute()
-    tracked_playlists = supabase.table('Tracked Playlists').select(
-        'id, user_id, playlist_id, playlist_name').eq('active', True).execute()
+    # Fetch all user settings and tracked playlists, paged past the API's row limit
+    user_settings = select_all(lambda: supabase.table('User Settings').select(
+        'user_id').eq('snapshots_enabled', True).order('user_id'))
+    tracked_playlists = select_all(lambda: supabase.table('Tracked Playlists').select(
+        'id, user_id, playlist_id, playlist_name, liked_songs, song_count, next_snapshot_at').eq('active', True).order('id'))
 
-    if not user_settings or not user_settings.data:
+    if not user_settings:
         logger.error("Error Fetching User Settings. Task ended.",
                      extra={"user_settings": user_settings})
+        return
 
-    if not tracked_playlists or not tracked_playlists.data:
+    if not tracked_playlists:
         logger.error("Error Fetching Tracked Playlists. Task ended.",
                      extra={"tracked_playlists": tracked_playlists})
         return
 
     # Create a dictionary of user settings for quick lookup
     active_users: List[str] = [setting['user_id']
-                               for setting in user_settings.data]
+                               for setting in user_settings]
 
     # Create a dictionary of tracked playlists for each user
     user_playlists: dict[str, List[TrackedPlaylist]] = {}
-    for playlist in tracked_playlists.data:
+    for playlist in tracked_playlists:
         user_playlists.setdefault(playlist['user_id'], []).append(playlist)
 
     total_users = len(active_users)
 
     logger.info("Total users", extra={"total_users": total_users})
 
-    num_subsets = ceil(total_users / MAX_USERS_PER_SUBSET)
+    # Playlists with a learned cadence are only queued when due before the window closes
+    start_time = datetime.now(timezone.utc)
+    window_end = start_time + timedelta(seconds=settings.SCHEDULER_WINDOW_SECONDS)
+    not_due = 0
 
-    # Ensure we don't exceed the execution window
-    if num_subsets * SUBSET_WINDOW > EXECUTION_WINDOW:
-        num_subsets = EXECUTION_WINDOW // SUBSET_WINDOW
-        MAX_USERS_PER_SUBSET = ceil(total_users / num_subsets)
+    # One job per user covering their due playlists, costed by the API calls their last snapshots needed
+    jobs: List[SnapshotJob] = []
+    for user_id in active_users:
+        due_playlists = []
+        cost = 0
+        for playlist in user_playlists.get(user_id, []):
+            planned_snapshot_date = next_snapshot_at(playlist)
+            if planned_snapshot_date and planned_snapshot_date > window_end:
+                not_due += 1
+                continue
+            # Pass in Supabase id, spotify id, and spotify name
+            due_playlists.append({'id': playlist['id'], 'playlist_id': playlist['playlist_id'], 'playlist_name': playlist['playlist_name']})
+            cost += estimate_cost(playlist.get('song_count'), playlist.get('liked_songs') or playlist['playlist_id'] == 'liked_songs',
+                                  settings.SCHEDULER_DEFAULT_SONG_COUNT)
+        if due_playlists:
+            jobs.append(SnapshotJob(user_id=user_id, playlists=due_playlists, cost=cost))
+
+    plan = plan_schedule(jobs, settings.SCHEDULER_WINDOW_SECONDS,
+                         settings.SCHEDULER_SLOT_SECONDS, settings.SCHEDULER_CALLS_PER_MINUTE)
+    report = plan.report()
+    logger.info("Planned snapshot load", extra={**report, "not_due": not_due, "load": plan.load})
+    if report["slots_over_budget"]:
+        logger.warning("Planned snapshot load exceeds the API budget", extra=report)
+
+    if settings.SNAPSHOT_ENGINE == "async":
+        # One task per slot drives all of the slot's users from a single event loop
+        slots: dict[int, List[dict]] = {}
+        for scheduled in plan.jobs:
+            slots.setdefault(scheduled.slot, []).append(
+                {'user_id': scheduled.job.user_id, 'playlists': scheduled.job.playlists})
+        for slot, slot_jobs in slots.items():
+            snapshot_users_async.apply_async(
+                args=[slot_jobs], countdown=slot * plan.slot_seconds)
+    else:
+        for scheduled in plan.jobs:
+            snapshot_user.apply_async(
+                args=[scheduled.job.user_id, scheduled.job.playlists], countdown=scheduled.countdown)
 
-    logger.info("Number of subsets", extra={"num_subsets": num_subsets})
-    logger.info("Users per subset", extra={
-                "MAX_USERS_PER_SUBSET": MAX_USERS_PER_SUBSET})
+    end_time = start_time + \
+        timedelta(seconds=plan.jobs[-1].countdown if plan.jobs else 0)
+    logger.info("Queued tasks", extra={
+                "total_users": total_users, "total_jobs": len(plan.jobs), "total_playlists": sum(len(scheduled.job.playlists) for scheduled in plan.jobs), "start_time": start_time, "end_time": end_time})
+    return f"Queued tasks for {total_users} users. Execution will be from {start_time} to {end_time}"
 
-    start_time = datetime.now(timezone.utc)
-    for i in range(num_subsets):
-        subset_start = i * MAX_USERS_PER_SUBSET
-        subset_end = min((i + 1) * MAX_USERS_PER_SUBSET, total_users)
-        subset_users: List[str] = active_users[subset_start:subset_end]
 
-        logger.info("Subset", extra={"subset_users": subset_users})
-        for user_id in subset_users:
-            # Calculate delay for this task
-            delay = i * SUBSET_WINDOW.total_seconds()
+@celery_app.task
+def refresh_expiring_tokens():
+    """Runs ahead of queue_user_tasks so snapshot tasks start with a valid, cached token"""
+    user_settings = select_all(lambda: supabase.table('User Settings').select(
+        'user_id').eq('snapshots_enabled', True).order('user_id'))
+    if not user_settings:
+        logger.error("Error Fetching User Settings. Task ended.",
+                     extra={"user_settings": user_settings})
+        return
 
-            for playlist in user_playlists.get(user_id):
-                # Pass in Supabase id, spotify id, and spotify name
-                take_snapshot.apply_async(
-                    args=[user_id, playlist['id'], playlist['playlist_id'], playlist['playlist_name']], countdown=delay)
+    active_users: List[str] = [setting['user_id']
+                               for setting in user_settings]
+    refreshed, failed = token_manager.refresh_expiring(
+        active_users, settings.TOKEN_SWEEP_WINDOW_SECONDS, settings.TOKEN_SWEEP_CONCURRENCY)
 
-        logger.info("Queued subset", extra={
-                    "subset_number": i+1, "num_subsets": num_subsets, "subset_users": subset_users})
+    logger.info("Refreshed expiring tokens", extra={
+                "total_users": len(active_users), "refreshed": refreshed, "failed": failed})
+    return f"Refreshed {refreshed} tokens, {failed} failed"
 
-    end_time = start_time + \
-        timedelta(seconds=(num_subsets - 1) * SUBSET_WINDOW.total_seconds())
-    logger.info("Queued tasks", extra={
-                "total_users": total_users, "start_time": start_time, "end_time": end_time})
-    return f"Queued tasks for {total_users} users. Execution will be from {start_time} to {end_time}"
+
+@celery_app.task
+def refresh_taste_profiles():
+    """Refreshes stale taste profiles of users getting suggestion emails, spread over a few hours"""
+    user_settings = select_all(lambda: supabase.table('User Settings').select(
+        'user_id').eq('suggestion_emails', True).order('user_id'))
+    if not user_settings:
+        logger.error("Error Fetching User Settings. Task ended.",
+                     extra={"user_settings": user_settings})
+        return
+
+    active_users: List[str] = [setting['user_id']
+                               for setting in user_settings]
+    profiles = {}
+    for user_batch in chunks(active_users):
+        profiles_result = supabase.table('Taste Profiles').select(
+            '*').in_('user_id', user_batch).execute()
+        for profile in profiles_result.data or []:
+            profiles[profile['user_id']] = TasteProfile(**profile)
+
+    # Users without a profile are included, so their next diff does not have to build one
+    now = datetime.now(timezone.utc)
+    stale_users = [user_id for user_id in active_users
+                   if user_id not in profiles or is_stale(profiles[user_id], now)]
+    spread = settings.TASTE_PROFILE_REFRESH_SPREAD_SECONDS
+    for index, user_id in enumerate(stale_users):
+        refresh_taste_profile.apply_async(
+            args=[user_id], countdown=index * spread / len(stale_users))
+
+    logger.info("Queued taste profile refreshes", extra={
+                "total_users": len(active_users), "stale_users": len(stale_users)})
+    return f"Queued {len(stale_users)} taste profile refreshes"
 
 
 @celery_app.task
 def weekly_suggestions():
-    user_settings = supabase.table('User Settings').select(
-        'user_id, suggestion_emails').eq('suggestion_emails', True).execute()
-    if not user_settings or not user_settings.data:
+    user_settings = select_all(lambda: supabase.table('User Settings').select(
+        'user_id, suggestion_emails').eq('suggestion_emails', True).order('user_id'))
+    if not user_settings:
         logger.error("Error Fetching User Settings. Task ended.",
                      extra={"user_settings": user_settings})
         raise Exception("Error Fetching User Settings. Task ended.")
 
-    active_users = [setting['user_id'] for setting in user_settings.data]
+    active_users = [setting['user_id'] for setting in user_settings]
+
+    if settings.EMAIL_BATCH_ENABLED:
+        # One task per batch of users, each sending its emails in a single batch call
+        for i in range(0, len(active_users), settings.EMAIL_BATCH_SIZE):
+            send_suggestion_emails_batch.apply_async(
+                args=[active_users[i:i + settings.EMAIL_BATCH_SIZE]])
+        return
 
     for user_id in active_users:
         send_suggestion_email.apply_async(args=[user_id])
@@ -1,14 +1,18 @@
 from datetime import datetime, timezone
-import gzip
-import json
-from typing import Optional
+from typing import List, Optional
+
+import numpy as np
 from app.core.celery_app import celery_app
+from app.core.config import settings
+from app.core.profiling import annotate, phase
 from app.db.supabase import supabase
 from app.services.spotify_service import SpotifyService
-from app.models.spotify_access import SpotifyAccess
+from app.services.taste_profile import EXCLUDED_PLAYLISTS, score_removed_songs
+from app.services.snapshot_codec import decode_track_ids, diff_track_ids
+from app.services.snapshot_storage import download_snapshot, is_delta, load_snapshot, load_snapshot_ids
 from app.models.cached_tracks import CachedTrackInsert
 from app.models.tracked_playlists import TrackedPlaylist
-from app.tasks.check_song_expiry import check_song_expiry
+from app.models.track import Track
 from app.core.logging import setup_logging
 
 logger = setup_logging("diff_snapshots")
@@ -21,11 +25,12 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
     """
     logger.info("Starting diff snapshots task", extra={
                 "user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id})
-    current_time = datetime.now(timezone.utc).isoformat()
+    annotate(user_id=user_id, playlist_id=playlist_id)
 
     # Fetch the tracked playlist
-    tracked_playlist_result = supabase.table('Tracked Playlists').select(
-        '*').eq('id', playlist_id).single().execute()
+    with phase('db_lookup'):
+        tracked_playlist_result = supabase.table('Tracked Playlists').select(
+            '*').eq('id', playlist_id).single().execute()
 
     # Check if tracked playlist exists
     if not tracked_playlist_result or not tracked_playlist_result.data:
@@ -37,8 +42,9 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
     tracked_playlist = TrackedPlaylist(**tracked_playlist_result.data)
 
     # Fetch the latest two snapshots for the user
-    snapshots = supabase.table('Library Snapshots').select('*').eq('user_id', user_id).eq(
-        'playlist_id', playlist_id).order('created_at', desc=True).limit(2).execute()
+    with phase('db_lookup'):
+        snapshots = supabase.table('Library Snapshots').select('*').eq('user_id', user_id).eq(
+            'playlist_id', playlist_id).order('created_at', desc=True).limit(2).execute()
 
     # Check if we have at least two snapshots
     if len(snapshots.data) < 2:
@@ -58,30 +64,85 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
         raise Exception(
             f"Snapshot IDs are None for user {user_id}. Task ended.")
 
-    previous_snapshot = load_snapshot(previous_snapshot_row['snapshot_id'])
-    if not previous_snapshot:
-        logger.error("Error loading previous snapshot", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id,
-                     "latest_snapshot_id": latest_snapshot_row['snapshot_id'], "previous_snapshot_id": previous_snapshot_row['snapshot_id']})
-        raise Exception(
-            f"Error loading previous snapshot for user {user_id}: {latest_snapshot_row['snapshot_id']} {previous_snapshot_row['snapshot_id']}")
+    latest_snapshot_id = latest_snapshot_row['snapshot_id']
+    previous_snapshot_id = previous_snapshot_row['snapshot_id']
+
+    # A delta against the previous snapshot already lists the removed tracks
+    removed_tracks = None
+    if is_delta(latest_snapshot_id):
+        with phase('diff'):
+            latest_delta = download_snapshot(latest_snapshot_id)
+        if latest_delta.get('base') == previous_snapshot_id:
+            removed_tracks = latest_delta['removed']
+            logger.info(f"Using stored delta for diff: {len(latest_delta['added'])} added, {len(removed_tracks)} removed", extra={
+                        "user_id": user_id, "playlist_id": playlist_id, "latest_snapshot_id": latest_snapshot_id})
+
+    if removed_tracks is None:
+        with phase('diff'):
+            latest_ids = load_snapshot_ids(latest_snapshot_id)
+            if latest_ids is None:
+                logger.error("Error loading latest snapshot", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id,
+                             "latest_snapshot_id": latest_snapshot_id, "previous_snapshot_id": previous_snapshot_id})
+                raise Exception(
+                    f"Error loading latest snapshot for user {user_id}: {latest_snapshot_id}")
+            removed_tracks = find_removed_since(previous_snapshot_id, latest_ids)
+
+    if not removed_tracks:
+        logger.info(f"No changes found for user {user_id}. Task ended.")
+        return {
+            "message": f"No changes found for user {user_id}. Task ended."
+        }
+
+    record_removed_tracks(user_id, spotify_user_id,
+                          tracked_playlist, removed_tracks)
+    return {
+        "message": f"Found snapshots for diff: Latest {latest_snapshot_id}, Previous {previous_snapshot_id}"
+    }
 
-    old_tracks_ids = set(track['id'] for track in previous_snapshot)
-    new_tracks_ids = set(track['id'] for track in load_snapshot(
-        latest_snapshot_row['snapshot_id']))
 
-    print("Length Old Tracks: ", len(old_tracks_ids))
-    print("Length New Tracks: ", len(new_tracks_ids))
+def find_removed_since(previous_snapshot_id: str, current_ids: np.ndarray) -> List[Track]:
+    """
+    Diffs a stored snapshot against the sorted, encoded ids of a newer track list
+    and returns the removed tracks. Only the ids of the stored snapshot are read
+    unless something was actually removed.
+    """
+    previous_ids = load_snapshot_ids(previous_snapshot_id)
+    if previous_ids is None:
+        logger.error("Error loading previous snapshot", extra={
+                     "previous_snapshot_id": previous_snapshot_id})
+        raise Exception(
+            f"Error loading previous snapshot {previous_snapshot_id}")
 
     logger.info(
-        f"Track Length Comparison {len(old_tracks_ids)} {len(new_tracks_ids)}")
+        f"Track Length Comparison {len(previous_ids)} {len(current_ids)}")
 
-    removed_tracks_ids = old_tracks_ids - new_tracks_ids
+    # Sorted id arrays, only decode the few ids that were actually removed
+    removed_ids = set(decode_track_ids(
+        diff_track_ids(previous_ids, current_ids)))
+    if not removed_ids:
+        return []
 
-    if not removed_tracks_ids or len(removed_tracks_ids) == 0:
-        logger.info(f"No changes found for user {user_id}. Task ended.")
-        return {
-            "message": f"No changes found for user {user_id}. Task ended."
-        }
+    # Track details for the removed ids come from the previous snapshot
+    previous_snapshot = load_snapshot(previous_snapshot_id)
+    if not previous_snapshot:
+        logger.error("Error loading previous snapshot", extra={
+                     "previous_snapshot_id": previous_snapshot_id})
+        raise Exception(
+            f"Error loading previous snapshot {previous_snapshot_id}")
+    return list({track['id']: track for track in previous_snapshot
+                 if track['id'] in removed_ids}.values())
+
+
+def record_removed_tracks(user_id: str, spotify_user_id: str, tracked_playlist: TrackedPlaylist,
+                          removed_tracks: List[Track], spotify_service: Optional[SpotifyService] = None):
+    """
+    Caches the removed tracks, records them as deleted songs and adds them to the
+    playlist of removed songs. Shared by diff_snapshots and the fused path in
+    take_snapshot, which passes in the SpotifyService it already has.
+    """
+    current_time = datetime.now(timezone.utc).isoformat()
+    playlist_id = tracked_playlist.id
+    removed_tracks_ids = set(track['id'] for track in removed_tracks)
 
     cached_tracks_upserts: list[CachedTrackInsert] = [{
         'track_id': track['id'],
@@ -90,11 +151,12 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
         'artist': track['artist'],
         'image': track['image'],
         'album': track['album']
-    } for track in previous_snapshot if track['id'] in removed_tracks_ids]
+    } for track in removed_tracks]
 
     # Upsert Into Cached Tracks
-    cached_tracks_result = supabase.table('Cached Tracks').upsert(
-        cached_tracks_upserts, on_conflict='track_id').execute()
+    with phase('write_back'):
+        cached_tracks_result = supabase.table('Cached Tracks').upsert(
+            cached_tracks_upserts, on_conflict='track_id').execute()
     if not cached_tracks_result:
         logger.error("Error upserting Cached Tracks", extra={"user_id": user_id, "spotify_user_id": spotify_user_id,
                      "playlist_id": playlist_id, "cached_tracks_upserts": cached_tracks_upserts, "cached_tracks_result": cached_tracks_result})
@@ -102,8 +164,9 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
             f"Error upserting Cached Tracks: {cached_tracks_result}")
 
     # Fetch Settings For User
-    user_settings = supabase.table('User Settings').select(
-        '*').eq('user_id', user_id).single().execute()
+    with phase('db_lookup'):
+        user_settings = supabase.table('User Settings').select(
+            '*').eq('user_id', user_id).single().execute()
 
     if not user_settings or not user_settings.data:
         logger.error("Error fetching user settings", extra={
@@ -111,27 +174,36 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
         raise Exception(
             f"Error fetching user settings for user {user_id}. Task ended.")
 
-    spotify_access_result = supabase.table('Spotify Access').select(
-        '*').eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
-    if not spotify_access_result or not spotify_access_result.data:
-        logger.error("Error fetching Spotify access", extra={
-                     "user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_access_result": spotify_access_result})
-        raise Exception(f"Error fetching Spotify access for user {user_id}")
-
-    spotify_access: SpotifyAccess = SpotifyAccess(
-        **spotify_access_result.data[0])
-    spotify_service = SpotifyService(spotify_access)
+    if spotify_service is None:
+        with phase('token'):
+            spotify_service = SpotifyService.for_user(user_id)
+
+    # Score the removed tracks now rather than all at once when the weekly email goes out
+    scores = {}
+    if settings.SUGGESTION_PRECOMPUTE_ENABLED and user_settings.data.get('suggestion_emails') \
+            and tracked_playlist.playlist_name not in EXCLUDED_PLAYLISTS:
+        try:
+            with phase('score'):
+                scores = score_removed_songs(user_id, list(removed_tracks_ids), spotify_service)
+        except Exception as e:
+            # The weekly email scores whatever is left unscored
+            logger.warning(f"Error scoring removed tracks: {e}", extra={
+                           "user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id})
 
     # Insert Deleted Songs
+    unscored = {'max_similarity': None, 'avg_similarity': None, 'scored_at': None}
     deleted_songs_inserts = [{
         'user_id': user_id,
         'track_id': track_id,
         'removed_at': current_time,
-        'playlist_id': playlist_id
+        'playlist_id': playlist_id,
+        # Every row needs the same columns in a bulk upsert
+        **(scores.get(track_id, unscored) if scores else {})
     } for track_id in removed_tracks_ids]
 
-    deleted_songs_result = supabase.table('Deleted Songs').upsert(
-        deleted_songs_inserts, on_conflict='track_id,user_id,playlist_id').execute()
+    with phase('write_back'):
+        deleted_songs_result = supabase.table('Deleted Songs').upsert(
+            deleted_songs_inserts, on_conflict='track_id,user_id,playlist_id').execute()
 
     logger.info("Deleted Songs Result", extra={"user_id": user_id, "spotify_user_id": spotify_user_id,
                 "playlist_id": playlist_id, "deleted_songs_inserts": deleted_songs_inserts, "deleted_songs_result": deleted_songs_result})
@@ -142,10 +214,11 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
     # All tracked playlists should have a spotify playlist id, even liked songs
     if not tracked_playlist.removed_playlist_id:
         # Create new playlist for removed songs
-        created_playlist_id = spotify_service.create_playlist(
-            spotify_user_id,
-            tracked_playlist
-        )
+        with phase('spotify_write'):
+            created_playlist_id = spotify_service.create_playlist(
+                spotify_user_id,
+                tracked_playlist
+            )
 
         if not created_playlist_id:
             logger.error("Failed to create playlist", extra={
@@ -153,34 +226,14 @@ def diff_snapshots(user_id: str, spotify_user_id: str, playlist_id: int):
             raise Exception(
                 f"Failed to create playlist for user {user_id} Task ended.")
 
-        supabase.table('Tracked Playlists').update({
-            'removed_playlist_id': created_playlist_id
-        }).eq('user_id', user_id).eq('id', tracked_playlist.id).execute()
+        with phase('write_back'):
+            supabase.table('Tracked Playlists').update({
+                'removed_playlist_id': created_playlist_id
+            }).eq('user_id', user_id).eq('id', tracked_playlist.id).execute()
         removed_playlist_id = created_playlist_id
 
     spotify_uris = [
-        f"spotify:track:{track_id}" for track_id in list(removed_tracks_ids)]
-    spotify_service.add_tracks_to_playlist(
-        playlist_id=removed_playlist_id, track_ids=spotify_uris)
-
-    check_song_expiry.apply_async(args=[user_id, playlist_id])
-    return {
-        "message": f"Found snapshots for diff: Latest {latest_snapshot_row['snapshot_id']}, Previous {previous_snapshot_row['snapshot_id']}"
-    }
-
-
-def load_snapshot(file_name) -> Optional[list[CachedTrackInsert]]:
-    try:
-        # Download the file
-        response = supabase.storage.from_('user-snapshots').download(file_name)
-
-        # Decompress the gzip data
-        decompressed_data = gzip.decompress(response)
-
-        # Parse the JSON data
-        tracks = json.loads(decompressed_data.decode('utf-8'))
-
-        return tracks
-    except Exception as e:
-        logger.error("Error loading snapshot", extra={"error": e})
-        return None
+        f"spotify:track:{track_id}" for track_id in removed_tracks_ids]
+    with phase('spotify_write'):
+        spotify_service.add_tracks_to_playlist(
+            playlist_id=removed_playlist_id, track_ids=spotify_uris)
@@ -1,18 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 from app.core.celery_app import celery_app
 from app.core.security import create_unsubscribe_token
 from app.db.supabase import supabase
-from app.models.spotify_access import SpotifyAccess
-from app.services.email_sender import EmailSender
+from app.services.email_sender import email_sender
 from app.services.spotify_service import SpotifyService
+from app.services.taste_profile import EXCLUDED_PLAYLISTS, SIMILARITY_THRESHOLD, precomputed_suggestions
 from app.models.cached_tracks import CachedTrack
 from app.core.config import settings
+from app.core.profiling import annotate, in_task_context, phase
 from app.core.logging import setup_logging
 
 logger = setup_logging("suggestion_email")
 
+MAX_EMAIL_SONGS = 10
+
 
 class SuggestionEmailSong(BaseModel):
     track_id: str
@@ -23,58 +28,55 @@ class SuggestionEmailSong(BaseModel):
     accident: bool = False
 
 
-@celery_app.task
-def send_suggestion_email(user_id: str):
+def build_suggestion_email(user_id: str) -> Optional[Dict]:
     """
-    This Function takes user_id, and sends an email with suggestions for accidentally removed songs
+    This Function takes user_id, and builds the email with suggestions for accidentally removed songs, None if there is nothing to send
     """
     # Write a query to get all items from
     # Get the date one week ago
     one_week_ago = datetime.now(timezone.utc) - timedelta(days=7)
 
     # Query to get deleted songs for the user in the last week from liked songs
-    deleted_songs_query = supabase.table('Deleted Songs')\
-        .select('*, playlist:"Tracked Playlists"(liked_songs, playlist_name), track:"Cached Tracks"(*)') \
-        .eq('user_id', user_id) \
-        .gte('removed_at', one_week_ago.isoformat()) \
-        .execute()
+    with phase('db_lookup'):
+        deleted_songs_query = supabase.table('Deleted Songs')\
+            .select('*, playlist:"Tracked Playlists"(liked_songs, playlist_name), track:"Cached Tracks"(*)') \
+            .eq('user_id', user_id) \
+            .gte('removed_at', one_week_ago.isoformat()) \
+            .execute()
     # .eq('playlist.liked_songs', True) \
 
     if not deleted_songs_query.data:
         logger.warning(f"No deleted songs found for user {user_id} in the last week.", extra={
                        "user_id": user_id})
-        return
+        return None
 
     deleted_songs_map = {song['track_id']                         : song for song in deleted_songs_query.data}
 
-    # These songs can't be removed by accident
-    excluded_playlists = ['On Repeat', 'Release Radar']
-    songs_to_check = [CachedTrack(
-        **song['track']) for song in deleted_songs_query.data if song['playlist']['playlist_name'] not in excluded_playlists]
+    songs_to_check = [song for song in deleted_songs_query.data
+                      if song['playlist']['playlist_name'] not in EXCLUDED_PLAYLISTS]
 
     deleted_songs = [CachedTrack(
         **song['track']
     ) for song in deleted_songs_query.data]
     # print("Deleted Songs: ", deleted_songs)
 
-    if songs_to_check and len(songs_to_check) > 0:
-        spotify_access_result = supabase.table('Spotify Access').select(
-            '*').eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
-        if not spotify_access_result or not spotify_access_result.data:
-            logger.error(f"Error fetching Spotify access for user {user_id}", extra={
-                         "user_id": user_id, "spotify_access_result": spotify_access_result})
-            raise Exception(
-                f"Error fetching Spotify access for user {user_id}")
-
-        spotify_access: SpotifyAccess = SpotifyAccess(
-            **spotify_access_result.data[0])
-        spotify_service = SpotifyService(spotify_access)
-
-        suggest_song_ids = [song.track_id for song in songs_to_check]
-        suggestions = spotify_service.suggest_accidentally_removed_tracks(
-            suggest_song_ids)
-        logger.info(f"Accidentally Removed Suggestions", extra={
-                    "user_id": user_id, "suggestions": suggestions})
+    # Most songs were scored when diff_snapshots found them, only score what is left
+    suggestions = precomputed_suggestions(songs_to_check, MAX_EMAIL_SONGS)
+    unscored_song_ids = list(dict.fromkeys(
+        song['track_id'] for song in songs_to_check if not song.get('scored_at')))
+    if unscored_song_ids:
+        with phase('token'):
+            spotify_service = SpotifyService.for_user(user_id)
+        with phase('score'):
+            suggestions += spotify_service.suggest_accidentally_removed_tracks(
+                unscored_song_ids, similarity_threshold=SIMILARITY_THRESHOLD, limit=MAX_EMAIL_SONGS)
+    # The same track can be scored for more than one playlist
+    suggestions = list({suggestion.track_id: suggestion for suggestion in sorted(
+        suggestions, key=lambda suggestion: suggestion.max_similarity)}.values())
+    suggestions.sort(key=lambda suggestion: suggestion.max_similarity, reverse=True)
+    suggestions = suggestions[:MAX_EMAIL_SONGS]
+    logger.info(f"Accidentally Removed Suggestions", extra={
+                "user_id": user_id, "suggestions": suggestions, "scored_now": len(unscored_song_ids)})
 
         # Create final list starting with suggestions if they exist
     final_songs: list[SuggestionEmailSong] = []
@@ -112,11 +114,12 @@ def send_suggestion_email(user_id: str):
     final_songs.extend(not_in_suggested_tracks)
 
     # Truncate to max 10 songs
-    final_songs = final_songs[:10]
+    final_songs = final_songs[:MAX_EMAIL_SONGS]
 
     if final_songs and len(final_songs) > 0:
         # Get User
-        user_response = supabase.auth.admin.get_user_by_id(user_id)
+        with phase('db_lookup'):
+            user_response = supabase.auth.admin.get_user_by_id(user_id)
         if not user_response or not user_response.user:
             logger.error(f"Error fetching user {user_id}", extra={
                          "user_id": user_id, "user_response": user_response})
@@ -124,17 +127,54 @@ def send_suggestion_email(user_id: str):
 
         user = user_response.user
 
-        email_sender = EmailSender()
-        email_sender.send_email(
-            template_name="deleted_songs",
-            to_email=user.email,
-            subject="Recently Removed from Spotify",
-            context={
-                'songs': [{
-                    **song.model_dump(),
-                    'removed_at': song.removed_at.strftime("%B %d, %Y")
-                } for song in final_songs],
-                'user_id': user_id,
-                'preheader_text': "Here are your recently removed songs from Spotify"
-            }
-        )
+        with phase('render'):
+            return email_sender.build_email(
+                template_name="deleted_songs",
+                to_email=user.email,
+                subject="Recently Removed from Spotify",
+                context={
+                    'songs': [{
+                        **song.model_dump(),
+                        'removed_at': song.removed_at.strftime("%B %d, %Y")
+                    } for song in final_songs],
+                    'user_id': user_id,
+                    'preheader_text': "Here are your recently removed songs from Spotify"
+                }
+            )
+    return None
+
+
+@celery_app.task
+def send_suggestion_email(user_id: str):
+    """
+    This Function takes user_id, and sends an email with suggestions for accidentally removed songs
+    """
+    annotate(user_id=user_id)
+    message = build_suggestion_email(user_id)
+    if message:
+        with phase('send'):
+            email_sender.send_message(message)
+
+
+@celery_app.task
+def send_suggestion_emails_batch(user_ids: List[str]):
+    """
+    Builds the suggestion emails of user_ids and sends them through the batch
+    API. A user whose email fails to build is logged and skipped.
+    """
+    def build(user_id: str) -> Optional[Dict]:
+        try:
+            return build_suggestion_email(user_id)
+        except Exception as e:
+            logger.error(f"Error building suggestion email for user {user_id}: {e}", extra={
+                         "user_id": user_id})
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(settings.EMAIL_BUILD_CONCURRENCY, len(user_ids)))) as executor:
+        messages = [message for message in executor.map(in_task_context(build), user_ids) if message]
+
+    with phase('send'):
+        response = email_sender.send_batch(messages)
+    logger.info("Sent suggestion emails", extra={
+                "users": len(user_ids), "skipped": len(user_ids) - len(messages), **response})
+    return response
@@ -1,25 +1,37 @@
+import random
+import threading
 import time
-import json
-import gzip
 import spotipy
 import dateutil.parser
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
 
 from requests import HTTPError
 from app.core.celery_app import celery_app
+from app.core.config import settings
+from app.core.metrics import SNAPSHOT_DIFF_TRACKS
+from app.core.profiling import annotate, in_task_context, phase
 from app.db.supabase import supabase
 from datetime import datetime, timedelta, timezone
 from app.services.spotify_service import SpotifyService
-from app.tasks.diff_snapshots import diff_snapshots
+from app.services.rate_limiter import retry_after_seconds, spotify_limiter
+from app.services.token_manager import token_manager
+from app.services.cadence import next_snapshot_at, observe_changes
+from app.services.snapshot_codec import diff_track_ids
+from app.services.snapshot_storage import SnapshotWriter, load_snapshot_ids, load_snapshot_order, needs_keyframe, snapshot_file_name
+from app.tasks.diff_snapshots import diff_snapshots, find_removed_since, record_removed_tracks
 from celery.exceptions import MaxRetriesExceededError
-from app.models.spotify_access import SpotifyAccess
+from app.models.track import Track
+from app.models.tracked_playlists import TrackedPlaylist
 from app.core.logging import setup_logging
 
 logger = setup_logging("take_snapshot")
 
 def calculate_next_snapshot_date(last_snapshot_date: datetime, song_count: int) -> datetime:
-    """Calculate the next snapshot date based on the song count"""
+    """Calculate the next snapshot date based on the song count, used until a playlist has a learned cadence"""
     if song_count < 1000:
         return last_snapshot_date
     elif song_count < 2000:
@@ -31,84 +43,318 @@ def calculate_next_snapshot_date(last_snapshot_date: datetime, song_count: int)
     else:
         return last_snapshot_date + timedelta(days=4)
 
-@celery_app.task(bind=True, max_retries=3)
-def take_snapshot(self, user_id: str, playlist_id: int, spotify_playlist_id: str, spotify_playlist_name: str):
-    logger.info("Taking user library snapshot", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id, "spotify_playlist_name": spotify_playlist_name})
+def count_changes(previous_snapshot_id: str, current_ids: np.ndarray, delta: Optional[Dict]) -> Optional[int]:
+    """Tracks added plus tracks removed since the previous snapshot, each is recorded in SNAPSHOT_DIFF_TRACKS"""
+    if delta is not None:
+        added, removed = len(delta['added']), len(delta['removed'])
+    else:
+        with phase('diff'):
+            previous_ids = load_snapshot_ids(previous_snapshot_id)
+            if previous_ids is None:
+                return None
+            added = len(diff_track_ids(current_ids, previous_ids))
+            removed = len(diff_track_ids(previous_ids, current_ids))
+    SNAPSHOT_DIFF_TRACKS.labels('added').observe(added)
+    SNAPSHOT_DIFF_TRACKS.labels('removed').observe(removed)
+    return added + removed
+
+def diff_fetched_tracks(user_id: str, spotify_user_id: str, playlist_id: int, spotify_service: SpotifyService,
+                        previous_snapshot_id: str, current_ids: np.ndarray, delta: Optional[Dict],
+                        tracked_playlist: Optional[Dict] = None):
+    """
+    Fused diff step: the fresh track ids are already in memory, so only the
+    previous snapshot is read (or nothing at all when a delta was just written).
+    """
+    if delta is not None:
+        removed_tracks = delta['removed']
+    else:
+        with phase('diff'):
+            removed_tracks = find_removed_since(previous_snapshot_id, current_ids)
+
+    if not removed_tracks:
+        logger.info(f"No changes found for user {user_id}", extra={"user_id": user_id, "playlist_id": playlist_id})
+        return
+
+    if tracked_playlist is None:
+        with phase('db_lookup'):
+            tracked_playlist_result = supabase.table('Tracked Playlists').select('*').eq('id', playlist_id).single().execute()
+        if not tracked_playlist_result or not tracked_playlist_result.data:
+            raise Exception(f"Error fetching tracked playlist for user: {user_id}: {tracked_playlist_result}")
+        tracked_playlist = tracked_playlist_result.data
+
+    record_removed_tracks(user_id, spotify_user_id, TrackedPlaylist(**tracked_playlist),
+                          removed_tracks, spotify_service)
+
+
+class SnapshotContext:
+    """
+    Identity and Spotify client of one user, loaded on first use and shared by
+    every playlist snapshotted for that user in the same task.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self._spotify_service: Optional[SpotifyService] = None
+        self._spotify_user_id: Optional[str] = None
+        self.lock = threading.Lock()
+
+    @property
+    def spotify_service(self) -> SpotifyService:
+        with self.lock:
+            if self._spotify_service is None:
+                with phase('token'):
+                    self._spotify_service = SpotifyService.for_user(self.user_id)
+            return self._spotify_service
+
+    @property
+    def spotify_user_id(self) -> str:
+        with self.lock:
+            if self._spotify_user_id is None:
+                # Get Spotify user id
+                with phase('db_lookup'):
+                    user = supabase.auth.admin.get_user_by_id(self.user_id)
+                self._spotify_user_id = user.user.user_metadata['provider_id']
+            return self._spotify_user_id
+
+    def reset_spotify_service(self):
+        """Drops the client so the next playlist builds one with a fresh token"""
+        with self.lock:
+            self._spotify_service = None
+
+
+def retry_countdown(exc: Exception, user_id: str) -> float:
+    """Seconds to wait before retrying after a Spotify error, invalidates the token on a 401"""
+    status = exc.http_status if isinstance(exc, spotipy.SpotifyException) else getattr(getattr(exc, 'response', None), 'status_code', None)
+    if status == 429:
+        # Rate limited, the token is fine. Come back once Spotify takes requests again,
+        # with jitter so the rescheduled tasks don't all land at once
+        retry_after = max(retry_after_seconds(exc), spotify_limiter.paused_for())
+        countdown = retry_after + random.uniform(0, retry_after)
+        logger.warning(f"Rate limited taking snapshot for user {user_id}", extra={"user_id": user_id, "countdown": countdown, "usage": spotify_limiter.usage()})
+        return countdown
+    if status == 401:
+        # Mark token as expired
+        token_manager.invalidate(user_id)
+    return 60
 
+
+def prepare_snapshot(user_id: str, playlist_id: int, tracked_playlist: Optional[Dict] = None) -> Optional[Dict]:
+    """
+    Database half before the fetch: loads the recent snapshots and the tracked
+    playlist, returns None if it's too soon for a new snapshot.
+    """
     # Check if there's a previous snapshot and if it's too soon for a new one
-    previous_snapshot = supabase.table('Library Snapshots').select('*').eq('user_id', user_id).eq('playlist_id', playlist_id).order('created_at', desc=True).limit(1).execute()
-    
+    # Enough history to tell how many deltas were written since the last keyframe
+    with phase('db_lookup'):
+        previous_snapshot = supabase.table('Library Snapshots').select('*').eq('user_id', user_id).eq('playlist_id', playlist_id).order('created_at', desc=True).limit(settings.SNAPSHOT_KEYFRAME_INTERVAL).execute()
+        if tracked_playlist is None:
+            tracked_playlist_result = supabase.table('Tracked Playlists').select('*').eq('id', playlist_id).limit(1).execute()
+            tracked_playlist = tracked_playlist_result.data[0] if tracked_playlist_result and tracked_playlist_result.data else None
+    last_snapshot = None
+    last_snapshot_date = None
+
     if previous_snapshot.data and len(previous_snapshot.data) > 0:
         last_snapshot = previous_snapshot.data[0]
         last_snapshot_date = dateutil.parser.parse(last_snapshot['created_at'])
         logger.info(f"Last snapshot date {last_snapshot_date}", extra={"user_id": user_id, "playlist_id": playlist_id, "last_snapshot_date": last_snapshot_date})
-        next_snapshot_date = calculate_next_snapshot_date(last_snapshot_date, last_snapshot['song_count'])
+        planned_snapshot_date = next_snapshot_at(tracked_playlist) if tracked_playlist else None
+        if planned_snapshot_date:
+            # Learned cadence, anything due before the current scheduling window closes is taken now
+            next_snapshot_date = planned_snapshot_date - timedelta(seconds=settings.SCHEDULER_WINDOW_SECONDS)
+        else:
+            # No change history yet
+            next_snapshot_date = calculate_next_snapshot_date(last_snapshot_date, last_snapshot['song_count'])
         logger.info(f"Next snapshot date {next_snapshot_date}", extra={"user_id": user_id, "playlist_id": playlist_id, "next_snapshot_date": next_snapshot_date})
         if datetime.now(timezone.utc) < next_snapshot_date:
             logger.warning(f"Skipping snapshot for user {user_id} and playlist {playlist_id} because it's too soon")
-            return
+            return None
 
-    spotify_access_result = supabase.table('Spotify Access').select('*').eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
-    if not spotify_access_result or not spotify_access_result.data:
-        logger.error(f"Error fetching Spotify access for user {user_id}", extra={"user_id": user_id, "spotify_access_result": spotify_access_result})
-        raise Exception(f"Error fetching Spotify access for user {user_id}")
-    
-    spotify_access: SpotifyAccess = SpotifyAccess(**spotify_access_result.data[0])
-    spotify_service = SpotifyService(spotify_access)
-    
-    # Get Spotify user id
-    user = supabase.auth.admin.get_user_by_id(user_id)
-    spotify_user_id = user.user.user_metadata['provider_id']
+    return {
+        'recent_snapshots': previous_snapshot.data or [],
+        'last_snapshot': last_snapshot,
+        'last_snapshot_date': last_snapshot_date,
+        'tracked_playlist': tracked_playlist
+    }
+
+
+def record_unchanged(state: Dict, user_id: str, playlist_id: int, spotify_playlist_id: str, spotify_snapshot_id: Optional[str]) -> bool:
+    """True if Spotify's snapshot_id matches the last snapshot, which is then recorded as a 0-change observation"""
+    last_snapshot = state['last_snapshot']
+    if not last_snapshot or not spotify_snapshot_id or last_snapshot.get('spotify_snapshot_id') != spotify_snapshot_id:
+        return False
+    if state['tracked_playlist']:
+        # Unchanged is an observation too, it stretches the interval
+        with phase('write_back'):
+            supabase.table('Tracked Playlists').update(observe_changes(state['tracked_playlist'], state['last_snapshot_date'], 0, datetime.now(timezone.utc))).eq('id', playlist_id).execute()
+    logger.info(f"Playlist {spotify_playlist_id} unchanged since last snapshot, skipping", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id, "spotify_snapshot_id": spotify_snapshot_id})
+    return True
+
+
+def store_snapshot(context: SnapshotContext, state: Dict, playlist_id: int, spotify_playlist_id: str,
+                   spotify_snapshot_id: Optional[str], pages: Optional[Iterable[List[Track]]]):
+    """
+    Database half around the fetch: writes the snapshot as its pages of tracks
+    arrive, uploads and records it and diffs it against the previous one
+    """
+    user_id = context.user_id
+    spotify_user_id = context.spotify_user_id
+    last_snapshot = state['last_snapshot']
+    tracked_playlist = state['tracked_playlist']
+
+    if pages is None:
+        logger.error(f"No tracks found for user {user_id} and playlist {playlist_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+        raise Exception(f"No tracks found for user {user_id} and playlist {playlist_id}")
 
     # File Information
     timestamp = int(time.time())
-    file_name = f"{user_id}/snapshot_{spotify_playlist_id}_{timestamp}.json.gz"
 
-    # Fetch all tracks
-    try:
-        if spotify_playlist_id == 'liked_songs':
-            logger.info(f"Getting liked songs for user {user_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-            all_tracks = spotify_service.get_user_liked_songs()
-        else:
-            logger.info(f"Getting playlist songs for user {user_id} and playlist {spotify_playlist_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-            all_tracks = spotify_service.get_user_playlist_songs(spotify_user_id, spotify_playlist_id)
-
-        if all_tracks is not None:
-            count = len(all_tracks)
-            json_data = json.dumps(all_tracks).encode('utf-8')
-            compressed_data = gzip.compress(json_data)
-            result = supabase.storage.from_('user-snapshots').upload(path=file_name, file=compressed_data, file_options={"content-type": "application/gzip"})
-            logger.info(f"File uploaded successfully {file_name}: {result}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-        else:
-            logger.error(f"No tracks found for user {user_id} and playlist {playlist_id}: {all_tracks}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-            raise Exception(f"No tracks found for user {user_id} and playlist {playlist_id}: {all_tracks}")
-        
-    except (HTTPError, spotipy.SpotifyException) as exc:
-        logger.error(f"Error taking snapshot for user {user_id}: {exc}, {spotify_playlist_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-        now = datetime.now(timezone.utc).isoformat()
-        # Mark token as expired
-        supabase.table('Spotify Access').update({'expires_at': now}).eq('id', spotify_access.id).execute()
-        try:
-            logger.info(f"Retrying snapshot for user {user_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-            self.retry(countdown=60)
-        except MaxRetriesExceededError:
-            logger.error(f"Max retries exceeded for user {user_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-        return
-    except Exception as exc:
-        logger.error(f"Unexpected error occurred: {str(exc)}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-        return
-    
+    # Store a delta against the previous snapshot unless a keyframe is due, only its ids are loaded
+    previous_ids = None
+    if last_snapshot and last_snapshot.get('snapshot_id') and not needs_keyframe(state['recent_snapshots']):
+        with phase('diff'):
+            previous_ids = load_snapshot_order(last_snapshot['snapshot_id'])
+
+    if previous_ids is not None:
+        writer = SnapshotWriter(snapshot_file_name(user_id, spotify_playlist_id, timestamp, delta=True),
+                                last_snapshot['snapshot_id'], previous_ids)
+    else:
+        writer = SnapshotWriter(snapshot_file_name(user_id, spotify_playlist_id, timestamp))
+
+    with writer:
+        # The next page is fetched once the previous one is written, only the ids are kept
+        with phase('fetch'):
+            for page in pages:
+                with phase('serialize'):
+                    writer.write(page)
+        size = writer.upload()
+    file_name = writer.file_name
+    count = writer.count
+    current_ids = writer.ids()
+    logger.info(f"File uploaded successfully {file_name}: {size} bytes", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id, "delta": writer.delta is not None, "size": size})
+
     snapshot_data = {
         'user_id': user_id,
         'song_count': count,
         'playlist_id': playlist_id, # Supabase id
-        'snapshot_id': file_name  # Using file_name as the snapshot_id
+        'snapshot_id': file_name,  # Using file_name as the snapshot_id
+        'spotify_snapshot_id': spotify_snapshot_id
     }
     
-    result = supabase.table('Library Snapshots').insert(snapshot_data).execute()
+    with phase('write_back'):
+        result = supabase.table('Library Snapshots').insert(snapshot_data).execute()
     if result.data:
-        diff_snapshots.delay(user_id, spotify_user_id, playlist_id)
+        # The scheduler costs the next run from this count
+        tracked_playlist_update = {'song_count': count}
+        if tracked_playlist and last_snapshot and last_snapshot.get('snapshot_id'):
+            changes = count_changes(last_snapshot['snapshot_id'], current_ids, writer.delta)
+            if changes is not None:
+                tracked_playlist_update.update(observe_changes(tracked_playlist, state['last_snapshot_date'], changes, datetime.now(timezone.utc)))
+        with phase('write_back'):
+            supabase.table('Tracked Playlists').update(tracked_playlist_update).eq('id', playlist_id).execute()
+        if settings.SNAPSHOT_FUSED_DIFF and last_snapshot and last_snapshot.get('snapshot_id'):
+            try:
+                diff_fetched_tracks(user_id, spotify_user_id, playlist_id, context.spotify_service,
+                                    last_snapshot['snapshot_id'], current_ids, writer.delta, tracked_playlist)
+            except Exception as exc:
+                # The snapshot is stored, so the standalone diff can still pick it up
+                logger.error(f"In-process diff failed, queueing diff_snapshots: {exc}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+                diff_snapshots.delay(user_id, spotify_user_id, playlist_id)
+        else:
+            diff_snapshots.delay(user_id, spotify_user_id, playlist_id)
         logger.info(f"Snapshot taken for user {user_id} with file name {file_name} and song count {count}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
     else:
         logger.error(f"Failed to take snapshot for user {user_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
-    return
\ No newline at end of file
+
+
+def snapshot_playlist(context: SnapshotContext, playlist_id: int, spotify_playlist_id: str, spotify_playlist_name: str,
+                      tracked_playlist: Optional[Dict] = None):
+    """Snapshots one playlist, Spotify errors are raised for the caller to retry"""
+    user_id = context.user_id
+    logger.info("Taking user library snapshot", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id, "spotify_playlist_name": spotify_playlist_name})
+
+    state = prepare_snapshot(user_id, playlist_id, tracked_playlist)
+    if state is None:
+        return
+
+    spotify_service = context.spotify_service
+    spotify_user_id = context.spotify_user_id
+
+    # Fetch all tracks
+    spotify_snapshot_id = None
+    if spotify_playlist_id != 'liked_songs':
+        # Spotify's snapshot_id only changes when the playlist is edited
+        with phase('fetch'):
+            spotify_snapshot_id = spotify_service.get_playlist_snapshot_id(spotify_playlist_id)
+        if record_unchanged(state, user_id, playlist_id, spotify_playlist_id, spotify_snapshot_id):
+            return
+
+    # Pages are fetched as store_snapshot writes them
+    if spotify_playlist_id == 'liked_songs':
+        logger.info(f"Getting liked songs for user {user_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+        pages = spotify_service.iter_user_liked_songs()
+    else:
+        logger.info(f"Getting playlist songs for user {user_id} and playlist {spotify_playlist_id}", extra={"user_id": user_id, "spotify_user_id": spotify_user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+        pages = spotify_service.iter_user_playlist_songs(spotify_user_id, spotify_playlist_id)
+
+    store_snapshot(context, state, playlist_id, spotify_playlist_id, spotify_snapshot_id, pages)
+
+
+@celery_app.task(bind=True, max_retries=3)
+def take_snapshot(self, user_id: str, playlist_id: int, spotify_playlist_id: str, spotify_playlist_name: str):
+    annotate(user_id=user_id, playlist_id=playlist_id)
+    context = SnapshotContext(user_id)
+    try:
+        snapshot_playlist(context, playlist_id, spotify_playlist_id, spotify_playlist_name)
+    except (HTTPError, spotipy.SpotifyException) as exc:
+        logger.error(f"Error taking snapshot for user {user_id}: {exc}, {spotify_playlist_id}", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+        countdown = retry_countdown(exc, user_id)
+        try:
+            logger.info(f"Retrying snapshot for user {user_id}", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id, "countdown": countdown})
+            self.retry(countdown=countdown)
+        except MaxRetriesExceededError:
+            logger.error(f"Max retries exceeded for user {user_id}", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+    except Exception as exc:
+        logger.error(f"Unexpected error occurred: {str(exc)}", extra={"user_id": user_id, "playlist_id": playlist_id, "spotify_playlist_id": spotify_playlist_id})
+
+
+@celery_app.task
+def snapshot_user(user_id: str, playlists: List[Dict]):
+    """
+    Snapshots all of a user's due playlists (dicts with id, playlist_id and
+    playlist_name) in one task, so identity, token and client are loaded once.
+    A failing playlist doesn't stop the others, Spotify errors requeue just that
+    playlist as a take_snapshot task.
+    """
+    logger.info(f"Taking snapshots for user {user_id}", extra={"user_id": user_id, "playlists": len(playlists)})
+    annotate(user_id=user_id, playlists=len(playlists))
+    context = SnapshotContext(user_id)
+
+    with phase('db_lookup'):
+        tracked_playlists_result = supabase.table('Tracked Playlists').select('*').in_('id', [playlist['id'] for playlist in playlists]).execute()
+    tracked_playlists = {row['id']: row for row in (tracked_playlists_result.data or [])}
+
+    def run(playlist: Dict) -> bool:
+        try:
+            snapshot_playlist(context, playlist['id'], playlist['playlist_id'], playlist['playlist_name'],
+                              tracked_playlists.get(playlist['id']))
+            return True
+        except (HTTPError, spotipy.SpotifyException) as exc:
+            logger.error(f"Error taking snapshot for user {user_id}: {exc}, {playlist['playlist_id']}", extra={"user_id": user_id, "playlist_id": playlist['id'], "spotify_playlist_id": playlist['playlist_id']})
+            countdown = retry_countdown(exc, user_id)
+            if isinstance(exc, spotipy.SpotifyException) and exc.http_status == 401:
+                context.reset_spotify_service()
+            take_snapshot.apply_async(args=[user_id, playlist['id'], playlist['playlist_id'], playlist['playlist_name']], countdown=countdown)
+        except Exception as exc:
+            logger.error(f"Unexpected error occurred: {str(exc)}", extra={"user_id": user_id, "playlist_id": playlist['id'], "spotify_playlist_id": playlist['playlist_id']})
+        return False
+
+    concurrency = min(settings.SNAPSHOT_USER_CONCURRENCY, len(playlists))
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(in_task_context(run), playlists))
+    else:
+        results = [run(playlist) for playlist in playlists]
+
+    succeeded = sum(results)
+    logger.info(f"Snapshots done for user {user_id}", extra={"user_id": user_id, "succeeded": succeeded, "failed": len(results) - succeeded})
+    return {"succeeded": succeeded, "failed": len(results) - succeeded}
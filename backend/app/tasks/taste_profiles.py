@@ -0,0 +1,14 @@
+from app.core.celery_app import celery_app
+from app.services.taste_profile import refresh_taste_profile as refresh_profile
+from app.core.logging import setup_logging
+
+logger = setup_logging("taste_profiles")
+
+
+@celery_app.task
+def refresh_taste_profile(user_id: str):
+    """
+    This Function takes user_id, and stores the user's current top tracks and artists as their taste profile
+    """
+    profile = refresh_profile(user_id)
+    return {"user_id": user_id, "top_tracks": len(profile.top_track_ids), "top_artists": len(profile.top_artist_ids)}
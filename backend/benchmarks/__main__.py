@@ -0,0 +1,75 @@
+"""
+Runs the benchmark suite from the backend directory:
+
+    python -m benchmarks                               # run and print
+    python -m benchmarks --save benchmarks/baselines/main.json
+    python -m benchmarks --compare benchmarks/baselines/main.json --threshold 0.15
+
+--compare exits with status 1 when a case got slower than the threshold allows.
+"""
+import argparse
+import logging
+import os
+import sys
+
+# Nothing here talks to Spotify, Supabase, Redis or Resend, the app only needs its settings to import
+for name, value in {
+    'SPOTIFY_CLIENT_ID': 'benchmark',
+    'SPOTIFY_CLIENT_SECRET': 'benchmark',
+    'SUPABASE_URL': 'https://benchmark.supabase.co',
+    'SUPABASE_KEY': 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYmVuY2htYXJrIn0.benchmark',
+    'SUPABASE_JWT_SECRET': 'benchmark',
+    'RESEND_API_KEY': 're_benchmark',
+    'ENTITY_CACHE_ENABLED': 'false',
+    'SNAPSHOT_CACHE_ENABLED': 'false',
+}.items():
+    os.environ.setdefault(name, value)
+
+from benchmarks import harness  # noqa: E402
+from benchmarks.cases import BENCHMARKS  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', '--filter', help="only run cases whose name contains this")
+    parser.add_argument('--max-size', type=int, help="skip sizes above this, for quick runs")
+    parser.add_argument('--repeat', type=int, default=5, help="timed samples per case")
+    parser.add_argument('--min-time', type=float, default=0.2, help="minimum seconds per sample")
+    parser.add_argument('--save', metavar='PATH', help="write the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown, as a fraction of the baseline median, that counts as a regression")
+    parser.add_argument('--list', action='store_true', help="list the cases and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for benchmark in BENCHMARKS:
+            for size in benchmark.sizes:
+                print(harness.case_name(benchmark.name, size))
+        return 0
+
+    # The app logs JSON to stdout on every call, which would drown the report and skew the timings
+    logging.disable(logging.WARNING)
+
+    report = harness.run(BENCHMARKS, repeat=args.repeat, min_time=args.min_time,
+                         name_filter=args.filter, max_size=args.max_size)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        harness.save(report, args.save)
+        print(f"Saved {len(report['results'])} results to {args.save}")
+
+    if args.compare:
+        baseline = harness.load(args.compare)
+        rows = harness.compare(baseline, report, args.threshold)
+        print()
+        harness.print_comparison(rows, baseline, report)
+        regressions = [row for row in rows if row['status'] == 'regression']
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""The benchmarked hot paths. Each setup builds its input outside the timed function."""
+import gzip
+import json
+from typing import List
+
+from app.core.config import settings
+from app.services.similarity import SimilarityMatrixEngine
+from app.services.snapshot_codec import diff_track_ids, encode_snapshot, encode_track_ids
+from app.services.snapshot_storage import _decode, apply_delta, build_delta, find_removed_tracks
+from app.services.spotify_service import SpotifyService
+
+from benchmarks.generators import FakeSpotify, audio_features, make_tracks, mutate, track_id, track_info
+from benchmarks.harness import Benchmark
+
+LIBRARY_SIZES = [100, 1_000, 10_000, 50_000]
+# Removed songs scored per suggestion run
+CANDIDATE_SIZES = [10, 100, 1_000]
+# Changes between two consecutive snapshots of a library
+CHURN = 0.02
+
+
+def _churn(size: int) -> int:
+    return max(1, int(size * CHURN))
+
+
+def serialize_json(size: int):
+    tracks = make_tracks(size)
+    return lambda: gzip.compress(json.dumps(tracks).encode('utf-8'))
+
+
+def serialize_binary(size: int):
+    tracks = make_tracks(size)
+    return lambda: encode_snapshot(tracks)
+
+
+def decode_json(size: int):
+    data = gzip.compress(json.dumps(make_tracks(size)).encode('utf-8'))
+    return lambda: _decode(data)
+
+
+def decode_binary(size: int):
+    data = encode_snapshot(make_tracks(size))
+    return lambda: _decode(data)
+
+
+def replay_deltas(size: int):
+    """load_snapshot without the downloads: a keyframe plus a full chain of deltas"""
+    keyframe = make_tracks(size)
+    chain_data = []
+    previous = keyframe
+    for i in range(settings.SNAPSHOT_KEYFRAME_INTERVAL - 1):
+        current = mutate(previous, _churn(size), _churn(size), seed=i + 1)
+        delta = build_delta(f"delta-{i}", previous, current)
+        chain_data.append(gzip.compress(json.dumps(delta).encode('utf-8')))
+        previous = current
+    keyframe_data = gzip.compress(json.dumps(keyframe).encode('utf-8'))
+
+    def fn():
+        tracks = _decode(keyframe_data)
+        for data in chain_data:
+            tracks = apply_delta(tracks, _decode(data))
+        return tracks
+    return fn
+
+
+def diff_sets(size: int):
+    """The dict/set diff diff_snapshots does on decoded track lists"""
+    previous = make_tracks(size)
+    current = mutate(previous, _churn(size), _churn(size))
+
+    def fn():
+        return find_removed_tracks(previous, {track['id'] for track in current})
+    return fn
+
+
+def diff_ids(size: int):
+    """The sorted id array diff used for binary snapshots and the fused diff"""
+    previous = make_tracks(size)
+    current = mutate(previous, _churn(size), _churn(size))
+    previous_ids = encode_track_ids(track['id'] for track in previous)
+    current_track_ids = [track['id'] for track in current]
+
+    def fn():
+        current_ids = encode_track_ids(current_track_ids)
+        return diff_track_ids(previous_ids, current_ids), diff_track_ids(current_ids, previous_ids)
+    return fn
+
+
+def _service(spotify: FakeSpotify) -> SpotifyService:
+    service = SpotifyService(access_token='benchmark')
+    service.sp = spotify
+    return service
+
+
+def _candidates(size: int) -> List[str]:
+    import random
+    rng = random.Random(size)
+    return [track_id(rng) for _ in range(size)]
+
+
+def similarity_pairwise(size: int):
+    """calculate_similarity for every candidate and top track pair, the original per-pair path"""
+    spotify = FakeSpotify()
+    service = _service(spotify)
+    top = [(audio_features(tid), track_info(tid)) for tid in spotify.top_track_ids]
+    candidates = [(audio_features(tid), track_info(tid)) for tid in _candidates(size)]
+    top_artists = [{'id': aid} for aid in spotify.top_artist_ids]
+    # Genres are fetched on first use, keep that out of the timing
+    service.get_artists_genres(list({info['artists'][0]['id'] for _, info in top + candidates}))
+
+    def fn():
+        return [service.calculate_similarity(features, info, top_features, top_info, top_artists)
+                for features, info in candidates for top_features, top_info in top]
+    return fn
+
+
+def similarity_matrix(size: int):
+    """SimilarityMatrixEngine scoring the same pairs in one pass"""
+    spotify = FakeSpotify()
+    service = _service(spotify)
+    top_ids = spotify.top_track_ids
+    candidate_ids = _candidates(size)
+    service.get_artists_genres(list({track_info(tid)['artists'][0]['id'] for tid in top_ids + candidate_ids}))
+    features = [audio_features(tid) for tid in candidate_ids]
+    infos = [track_info(tid) for tid in candidate_ids]
+
+    def fn():
+        engine = SimilarityMatrixEngine(
+            top_features=[audio_features(tid) for tid in top_ids],
+            top_infos=[track_info(tid) for tid in top_ids],
+            top_artist_ids=spotify.top_artist_ids,
+            artist_genres=service.cache['artist_genres'])
+        return engine.summarize(features, infos)
+    return fn
+
+
+def suggest(size: int):
+    """suggest_accidentally_removed_tracks end to end with a mocked sp, on a fresh service like each task"""
+    spotify = FakeSpotify()
+    candidate_ids = _candidates(size)
+
+    def fn():
+        return _service(spotify).suggest_accidentally_removed_tracks(candidate_ids, limit=10)
+    return fn
+
+
+def render_email(size: int):
+    """EmailSender._render_mjml for an email listing size songs, templates compiled beforehand"""
+    from app.services.email_sender import email_sender
+    songs = [{'name': f"Song {i}", 'artist': f"Artist {i}", 'playlist_name': 'Liked Songs',
+              'removed_at': 'January 01, 2025', 'accident': i % 3 == 0} for i in range(size)]
+    email_sender.templates.get('deleted_songs')
+
+    def fn():
+        return email_sender._render_mjml('deleted_songs', {
+            'songs': songs, 'user_id': 'benchmark', 'preheader_text': 'Benchmark'})
+    return fn
+
+
+BENCHMARKS = [
+    Benchmark('snapshot.serialize_json', serialize_json, LIBRARY_SIZES),
+    Benchmark('snapshot.serialize_binary', serialize_binary, LIBRARY_SIZES),
+    Benchmark('snapshot.decode_json', decode_json, LIBRARY_SIZES),
+    Benchmark('snapshot.decode_binary', decode_binary, LIBRARY_SIZES),
+    Benchmark('snapshot.replay_deltas', replay_deltas, LIBRARY_SIZES),
+    Benchmark('diff.sets', diff_sets, LIBRARY_SIZES),
+    Benchmark('diff.track_ids', diff_ids, LIBRARY_SIZES),
+    # The per-pair path already takes seconds at 100 candidates
+    Benchmark('similarity.pairwise', similarity_pairwise, [10, 100]),
+    Benchmark('similarity.matrix', similarity_matrix, CANDIDATE_SIZES),
+    Benchmark('suggest.accidentally_removed', suggest, CANDIDATE_SIZES),
+    Benchmark('email.render', render_email, [10]),
+]
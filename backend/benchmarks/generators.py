@@ -0,0 +1,114 @@
+"""Deterministic synthetic data for the benchmarks: track lists, audio features and a fake Spotify client."""
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+from app.models.track import Track
+
+BASE62_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+GENRES = ['pop', 'rock', 'indie', 'hip hop', 'rap', 'edm', 'house', 'techno', 'jazz', 'soul',
+          'r&b', 'folk', 'country', 'metal', 'punk', 'ambient', 'classical', 'latin', 'k-pop', 'funk']
+
+
+def track_id(rng: random.Random) -> str:
+    """A random 22 character base62 id of a 128-bit integer, like Spotify's"""
+    value = rng.getrandbits(128)
+    chars = []
+    for _ in range(22):
+        value, digit = divmod(value, 62)
+        chars.append(BASE62_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def make_tracks(count: int, seed: int = 0) -> List[Track]:
+    """A library of count tracks as take_snapshot stores them"""
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    return [{
+        'id': track_id(rng),
+        'name': f"Track {i}",
+        'artist': f"Artist {rng.randrange(max(1, count // 10))}",
+        'album': f"Album {rng.randrange(max(1, count // 12))}",
+        'added_at': (start + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'image': f"https://i.scdn.co/image/{track_id(rng)}" if rng.random() < 0.95 else None
+    } for i in range(count)]
+
+
+def mutate(tracks: List[Track], removed: int, added: int, seed: int = 0) -> List[Track]:
+    """The library after removing and adding some tracks, as between two snapshots"""
+    rng = random.Random(seed)
+    kept = list(tracks)
+    for _ in range(min(removed, len(kept))):
+        kept.pop(rng.randrange(len(kept)))
+    for track in make_tracks(added, seed=seed + 1_000_003):
+        kept.insert(rng.randrange(len(kept) + 1), track)
+    return kept
+
+
+def audio_features(track_id: str) -> Dict:
+    rng = random.Random(track_id)
+    return {
+        'id': track_id,
+        'danceability': rng.random(),
+        'energy': rng.random(),
+        'loudness': -60 * rng.random(),
+        'speechiness': rng.random(),
+        'acousticness': rng.random(),
+        'instrumentalness': rng.random(),
+        'liveness': rng.random(),
+        'valence': rng.random(),
+        'tempo': rng.uniform(60, 200),
+        'key': rng.randrange(12),
+        'mode': rng.randrange(2),
+    }
+
+
+def artist_id(track_id: str, artist_count: int) -> str:
+    return f"artist{random.Random(track_id).randrange(artist_count)}"
+
+
+def track_info(track_id: str, artist_count: int = 200) -> Dict:
+    """A full Spotify track object, as returned by the tracks endpoint"""
+    artist = artist_id(track_id, artist_count)
+    return {
+        'id': track_id,
+        'name': f"Track {track_id[:6]}",
+        'artists': [{'id': artist, 'name': f"Artist {artist}"}],
+        'album': {'name': f"Album {track_id[:4]}", 'images': []},
+    }
+
+
+def artist_genres(artist: str) -> List[str]:
+    rng = random.Random(artist)
+    return rng.sample(GENRES, rng.randrange(1, 5))
+
+
+class FakeSpotify:
+    """
+    Stands in for spotipy.Spotify in the suggestion benchmarks. Responses are
+    generated from the ids, so the same input always scores the same.
+    """
+
+    def __init__(self, top_tracks: int = 50, top_artists: int = 50, artist_count: int = 200, seed: int = 0):
+        rng = random.Random(seed)
+        self.artist_count = artist_count
+        self.top_track_ids = [track_id(rng) for _ in range(top_tracks)]
+        self.top_artist_ids = [f"artist{i}" for i in rng.sample(range(artist_count), top_artists)]
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        return {'items': [track_info(tid, self.artist_count) for tid in self.top_track_ids[:limit]]}
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        return {'items': [{'id': aid, 'genres': artist_genres(aid)} for aid in self.top_artist_ids[:limit]]}
+
+    def audio_features(self, tracks=None):
+        return [audio_features(tid) for tid in tracks]
+
+    def tracks(self, tracks, market=None):
+        return {'tracks': [track_info(tid, self.artist_count) for tid in tracks]}
+
+    def artists(self, artists):
+        return {'artists': [{'id': aid, 'genres': artist_genres(aid)} for aid in artists]}
+
+    def artist(self, artist_id):
+        return {'id': artist_id, 'genres': artist_genres(artist_id)}
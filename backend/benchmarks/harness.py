@@ -0,0 +1,158 @@
+"""Timing, result files and baseline comparison for the benchmark suite."""
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# A case's setup gets the size and returns the function to time, built outside the timed region
+Setup = Callable[[int], Callable[[], Any]]
+
+
+class Benchmark:
+    def __init__(self, name: str, setup: Setup, sizes: Sequence[int]):
+        self.name = name
+        self.setup = setup
+        self.sizes = list(sizes)
+
+
+def case_name(name: str, size: int) -> str:
+    return f"{name}[{size}]"
+
+
+def measure(fn: Callable[[], Any], repeat: int, min_time: float) -> Dict[str, float]:
+    """
+    Times fn like timeit: calls are looped until one sample takes at least
+    min_time, and repeat samples are taken. Reports seconds per call.
+    """
+    fn()  # Warm up caches and lazy imports
+
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+
+    samples = [elapsed / loops]
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            for _ in range(loops):
+                fn()
+            samples.append((time.perf_counter() - start) / loops)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "loops": loops,
+        "repeat": len(samples),
+    }
+
+
+def environment() -> Dict[str, str]:
+    import numpy
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+
+def run(benchmarks: List[Benchmark], repeat: int, min_time: float, name_filter: Optional[str] = None,
+        max_size: Optional[int] = None, log: Callable[[str], None] = print) -> Dict[str, Any]:
+    results: Dict[str, Dict[str, Any]] = {}
+    for benchmark in benchmarks:
+        if name_filter and name_filter not in benchmark.name:
+            continue
+        for size in benchmark.sizes:
+            if max_size is not None and size > max_size:
+                continue
+            name = case_name(benchmark.name, size)
+            try:
+                fn = benchmark.setup(size)
+            except Exception as e:
+                # e.g. the email benchmark needs network access to compile templates
+                results[name] = {"skipped": f"{type(e).__name__}: {e}"}
+                log(f"{name:<45} skipped: {results[name]['skipped']}")
+                continue
+            stats = measure(fn, repeat, min_time)
+            results[name] = stats
+            log(f"{name:<45} {format_seconds(stats['median']):>10}  (min {format_seconds(stats['min'])}, "
+                f"±{format_seconds(stats['stdev'])}, {stats['loops']} loops x {stats['repeat']})")
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": environment(),
+        "settings": {"repeat": repeat, "min_time": min_time},
+        "results": results,
+    }
+
+
+def format_seconds(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3g}{unit}"
+    return f"{seconds / 1e-9:.3g}ns"
+
+
+def save(report: Dict[str, Any], path: str):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    """
+    Compares medians case by case. A case more than threshold (a fraction)
+    slower than the baseline is a regression, more than threshold faster an
+    improvement.
+    """
+    rows = []
+    for name, stats in current["results"].items():
+        base = baseline["results"].get(name)
+        if "median" not in stats or not base or "median" not in base:
+            rows.append({"name": name, "status": "new" if not base else "skipped"})
+            continue
+        ratio = stats["median"] / base["median"] if base["median"] else float('inf')
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = "unchanged"
+        rows.append({"name": name, "status": status, "baseline": base["median"],
+                     "current": stats["median"], "ratio": ratio})
+    return rows
+
+
+def print_comparison(rows: List[Dict[str, Any]], baseline: Dict[str, Any], current: Dict[str, Any],
+                     out=sys.stdout):
+    if baseline.get("environment") != current.get("environment"):
+        print("warning: baseline was recorded in a different environment, "
+              f"{baseline.get('environment')}", file=out)
+    for row in rows:
+        if "ratio" not in row:
+            print(f"{row['name']:<45} {row['status']}", file=out)
+            continue
+        print(f"{row['name']:<45} {format_seconds(row['baseline']):>10} -> {format_seconds(row['current']):>10}"
+              f"  x{row['ratio']:.2f}  {row['status']}", file=out)
@@ -0,0 +1,280 @@
+"""
+End-to-end load test of the snapshot pipeline, run from the backend directory:
+
+    python -m loadtest --users 1000 --fake-redis
+    python -m loadtest --users 10000 --mode worker --concurrency 32 --latency-ms 80 --rate-429 0.01
+    python -m loadtest --users 2000 --set SNAPSHOT_ENGINE=async --output report.json
+
+Seeds synthetic users into an in-memory Supabase, serves their libraries from a
+local fake Spotify API, then runs queue_user_tasks for a number of rounds (the
+snapshots, and their diffs, of every due playlist) with simulated time passing
+and libraries changing between rounds, and finally the song expiry sweep.
+Each phase reports throughput, Spotify calls per user, bytes stored and task
+latency percentiles.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from typing import Any, Dict, List
+
+from loadtest.fake_spotify import FakeSpotifyServer, SpotifyWorld
+from loadtest.fake_supabase import FakeSupabase
+from loadtest.report import TaskRecorder, distribution, print_round
+from loadtest.seed import seed_users
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m loadtest', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    population = parser.add_argument_group('users')
+    population.add_argument('--users', type=int, default=100)
+    population.add_argument('--playlists-per-user', type=int, default=2)
+    population.add_argument('--liked-songs-fraction', type=float, default=0.8,
+                            help="users that also track their liked songs")
+    population.add_argument('--mean-songs', type=int, default=400, help="mean library size, log-normal")
+    population.add_argument('--max-songs', type=int, default=10000)
+    population.add_argument('--churn', type=float, default=0.02,
+                            help="fraction of a library removed, and added, when it changes")
+    population.add_argument('--change-probability', type=float, default=0.3,
+                            help="chance a library changes between rounds")
+    population.add_argument('--expiring-fraction', type=float, default=0.5,
+                            help="users whose removed songs expire after 30 days")
+    population.add_argument('--suggestion-fraction', type=float, default=1.0,
+                            help="users with suggestion emails, their removed songs are scored at diff time")
+    population.add_argument('--seed', type=int, default=0)
+
+    spotify = parser.add_argument_group('fake Spotify API')
+    spotify.add_argument('--latency-ms', type=float, default=0)
+    spotify.add_argument('--jitter-ms', type=float, default=0)
+    spotify.add_argument('--rate-429', type=float, default=0, help="fraction of requests answered with a 429")
+    spotify.add_argument('--retry-after', type=int, default=1, help="Retry-After of those 429s, in seconds")
+    spotify.add_argument('--error-rate', type=float, default=0, help="fraction of requests answered with a 503")
+    spotify.add_argument('--server-rate-limit', type=float,
+                         help="requests per second the fake accepts before answering 429")
+
+    run = parser.add_argument_group('run')
+    run.add_argument('--mode', choices=['eager', 'worker'], default='eager',
+                     help="eager runs every task inline, worker runs them on an in-process Celery worker")
+    run.add_argument('--concurrency', type=int, default=16, help="worker threads in worker mode")
+    run.add_argument('--rounds', type=int, default=3, help="queue_user_tasks runs")
+    run.add_argument('--round-hours', type=float, default=12, help="simulated time between rounds")
+    run.add_argument('--expire-after-days', type=float, default=31,
+                     help="simulated time before the expiry phase, 0 skips it")
+    run.add_argument('--expiry', choices=['sweep', 'playlist'], default='sweep',
+                     help="run expire_deleted_songs, or check_song_expiry for every tracked playlist")
+    run.add_argument('--window-seconds', type=int,
+                     help="scheduling window queue_user_tasks spreads snapshots over (default 12h eager, 30s worker)")
+    run.add_argument('--client-rate', type=float, default=1000,
+                     help="SPOTIFY_RATE_LIMIT_PER_SECOND of the app's own limiter")
+    run.add_argument('--timeout', type=float, default=3600, help="seconds to wait for a phase in worker mode")
+    run.add_argument('--redis-url', help="Redis for rate limits, token and entity caches (default REDIS_URL)")
+    run.add_argument('--fake-redis', action='store_true', help="use an in-process fakeredis instead")
+    run.add_argument('--flush-redis', action='store_true', help="flush the Redis database before starting")
+    run.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                     help="override an app setting, e.g. SNAPSHOT_FORMAT=binary, repeatable")
+    run.add_argument('--output', help="write the full report as JSON")
+    run.add_argument('--verbose', action='store_true', help="keep the app's logs")
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace, spotify_url: str):
+    """Settings are read once on import, so everything is set before the app is imported"""
+    for name, value in {
+        'SPOTIFY_CLIENT_ID': 'loadtest',
+        'SPOTIFY_CLIENT_SECRET': 'loadtest',
+        'SUPABASE_URL': 'https://loadtest.supabase.co',
+        'SUPABASE_KEY': 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoibG9hZHRlc3QifQ.loadtest',
+        'SUPABASE_JWT_SECRET': 'loadtest',
+        'RESEND_API_KEY': 're_loadtest',
+    }.items():
+        os.environ.setdefault(name, value)
+
+    window = args.window_seconds or (30 if args.mode == 'worker' else None)
+    overrides = {
+        'SPOTIFY_API_URL': spotify_url,
+        'EMAIL_TRANSPORT': 'recording',
+        # The in-process worker would otherwise serve /metrics on a fixed port
+        'CELERY_METRICS_PORT': '0',
+        'SPOTIFY_RATE_LIMIT_PER_SECOND': str(args.client_rate),
+        'SPOTIFY_RATE_LIMIT_BURST': str(max(1, int(args.client_rate))),
+        # A fresh cache per run, a warm one from an earlier run would skip downloads
+        'SNAPSHOT_CACHE_DIR': tempfile.mkdtemp(prefix='trackkeeper-loadtest-'),
+    }
+    if window:
+        overrides['SCHEDULER_WINDOW_SECONDS'] = str(window)
+        overrides['SCHEDULER_SLOT_SECONDS'] = str(max(1, window // 10))
+    if args.redis_url:
+        overrides['REDIS_URL'] = args.redis_url
+    for assignment in args.set:
+        name, _, value = assignment.partition('=')
+        overrides[name.strip()] = value.strip()
+    os.environ.update(overrides)
+
+
+def install_fakes(args: argparse.Namespace) -> FakeSupabase:
+    """Swaps the shared clients before any module that imports them is loaded"""
+    import app.db.supabase
+    db = FakeSupabase()
+    app.db.supabase.supabase = db
+
+    import app.db.redis
+    if args.fake_redis:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("--fake-redis needs the fakeredis package: pip install fakeredis")
+        app.db.redis.redis_client = fakeredis.FakeRedis()
+    if args.flush_redis:
+        app.db.redis.redis_client.flushdb()
+    return db
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, db: FakeSupabase, world: SpotifyWorld, recorder: TaskRecorder):
+        self.args = args
+        self.db = db
+        self.world = world
+        self.recorder = recorder
+        self.reports: List[Dict[str, Any]] = []
+
+    def wait_idle(self):
+        """Blocks until every published task, including retries and countdowns, has run"""
+        if self.args.mode == 'eager':
+            return
+        deadline = time.monotonic() + self.args.timeout
+        while self.recorder.pending() > 0:
+            if time.monotonic() > deadline:
+                print(f"warning: timed out with {self.recorder.pending()} tasks pending", file=sys.stderr)
+                return
+            time.sleep(0.1)
+
+    def phase(self, name: str, run) -> Dict[str, Any]:
+        from app.core.http import connection_stats
+
+        self.world.reset_counters()
+        self.recorder.reset()
+        db_before = self.db.stats()
+        snapshots_before = len(self.db.table_data('Library Snapshots').rows)
+
+        start = time.monotonic()
+        run()
+        self.wait_idle()
+        wall = time.monotonic() - start
+
+        db_after = self.db.stats()
+        calls_by_user = self.world.calls_by_user()
+        tasks = self.recorder.summary()
+        snapshots = len(self.db.table_data('Library Snapshots').rows) - snapshots_before
+        task_runs = sum(latency['count'] for latency in tasks['latency_seconds'].values())
+        report = {
+            "name": name,
+            "wall_seconds": round(wall, 3),
+            "throughput": {
+                "users": len(calls_by_user),
+                "snapshots": snapshots,
+                "users_per_second": round(len(calls_by_user) / wall, 2) if wall else 0,
+                "snapshots_per_second": round(snapshots / wall, 2) if wall else 0,
+                "tasks_per_second": round(task_runs / wall, 2) if wall else 0,
+            },
+            "spotify_api": {
+                "calls": sum(calls_by_user.values()),
+                "calls_per_user": distribution(calls_by_user.values()),
+                "calls_by_endpoint": self.world.calls_by_endpoint(),
+                "statuses": dict(self.world.statuses),
+            },
+            "supabase": {
+                **db_after,
+                "requests": db_after["requests"] - db_before["requests"],
+                "requests_per_user": round((db_after["requests"] - db_before["requests"]) / len(calls_by_user), 2)
+                if calls_by_user else 0,
+                "bytes_stored_delta": db_after["bytes_stored"] - db_before["bytes_stored"],
+                "files_delta": db_after["files"] - db_before["files"],
+            },
+            "tasks": tasks,
+            "connections": connection_stats(),
+        }
+        self.reports.append(report)
+        print_round(report)
+        return report
+
+    def run(self):
+        from app.tasks import check_song_expiry, expire_deleted_songs, queue_user_tasks
+
+        last_round = 0.0
+        for number in range(self.args.rounds):
+            if number:
+                changed = self.world.advance(self.args.change_probability)
+                self.db.advance_clock(timedelta(hours=self.args.round_hours))
+                print(f"\n{changed} libraries changed, {self.args.round_hours}h passed")
+                # Snapshot file names have second resolution
+                time.sleep(max(0.0, 1.0 - (time.monotonic() - last_round)))
+            last_round = time.monotonic()
+            self.phase(f"round {number + 1}", lambda: queue_user_tasks.apply_async())
+
+        if self.args.expire_after_days:
+            self.db.advance_clock(timedelta(days=self.args.expire_after_days))
+            if self.args.expiry == 'sweep':
+                self.phase("expiry", lambda: expire_deleted_songs.apply_async())
+            else:
+                playlists = list(self.db.table_data('Tracked Playlists').rows.values())
+                self.phase("expiry", lambda: [check_song_expiry.apply_async(args=[playlist['user_id'], playlist['id']])
+                                              for playlist in playlists])
+
+
+def main() -> int:
+    args = parse_args()
+
+    world = SpotifyWorld(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, rate_429=args.rate_429,
+                         retry_after=args.retry_after, error_rate=args.error_rate,
+                         server_rate_limit=args.server_rate_limit, seed=args.seed)
+    server = FakeSpotifyServer(world).start()
+    configure_environment(args, server.url)
+    if not args.verbose:
+        # Warnings too, 429s and retries are counted in the report instead
+        logging.disable(logging.WARNING)
+
+    db = install_fakes(args)
+    from app.core.celery_app import celery_app
+    import app.tasks  # noqa: F401, registers the tasks
+
+    recorder = TaskRecorder()
+    recorder.connect()
+    celery_app.conf.task_ignore_result = True
+
+    started = time.monotonic()
+    user_ids = seed_users(db, world, args.users, args.playlists_per_user, args.liked_songs_fraction,
+                          args.mean_songs, args.max_songs, args.churn, args.expiring_fraction,
+                          args.suggestion_fraction, seed=args.seed)
+    print(f"Seeded {len(user_ids)} users, {len(world.playlists)} playlists and {len(world.liked_songs)} "
+          f"liked songs libraries in {time.monotonic() - started:.1f}s, Spotify API at {server.url}")
+
+    load_test = LoadTest(args, db, world, recorder)
+    try:
+        if args.mode == 'eager':
+            celery_app.conf.task_always_eager = True
+            load_test.run()
+        else:
+            from celery.contrib.testing.worker import start_worker
+            celery_app.conf.broker_url = 'memory://'
+            celery_app.conf.result_backend = 'cache+memory://'
+            with start_worker(celery_app, concurrency=args.concurrency, pool='threads', perform_ping_check=False,
+                              queues=['default', 'cron_tasks'], shutdown_timeout=args.timeout):
+                load_test.run()
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"options": vars(args), "phases": load_test.reports}, f, indent=2, default=str)
+            f.write('\n')
+        print(f"\nWrote {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""
+Local fake of the Spotify Web API, served over HTTP so the real clients
+(spotipy on the pooled requests session, and the async httpx client) are
+exercised end to end. Libraries are generated from seeds rather than stored,
+so 10k users with thousands of tracks each fit in memory: a library is its
+seed, size and version, and each version removes and adds a few tracks.
+
+Latency, 429s with Retry-After, 5xx errors and a server-side rate limit can be
+injected to see how the tasks behave when Spotify does.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.generators import artist_genres, audio_features, track_id, track_info
+
+ADDED_AT = '2024-01-01T00:00:00Z'
+# Materialized track lists kept around, a snapshot reads all pages of one within seconds
+LIBRARY_CACHE_SIZE = 1024
+
+
+class Library:
+    """A playlist or liked songs. Version n is version n - 1 with churn tracks removed and as many added"""
+
+    def __init__(self, seed: str, size: int, churn: int):
+        self.seed = seed
+        self.size = size
+        self.churn = churn
+        self.version = 0
+
+    @property
+    def snapshot_id(self) -> str:
+        return f"{self.seed}-{self.version}"
+
+    def track_ids(self) -> List[str]:
+        rng = random.Random(self.seed)
+        ids = [track_id(rng) for _ in range(self.size)]
+        for version in range(1, self.version + 1):
+            rng = random.Random(f"{self.seed}:{version}")
+            for _ in range(min(self.churn, len(ids))):
+                ids.pop(rng.randrange(len(ids)))
+            for _ in range(self.churn):
+                ids.insert(rng.randrange(len(ids) + 1), track_id(rng))
+        return ids
+
+
+class SpotifyWorld:
+    """The users, their libraries and what was asked of the API, shared by the server's threads"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_429: float = 0.0,
+                 retry_after: int = 1, error_rate: float = 0.0, server_rate_limit: Optional[float] = None,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.server_rate_limit = server_rate_limit
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.tokens: Dict[str, str] = {}  # access token -> user id
+        self.playlists: Dict[str, Library] = {}
+        self.liked_songs: Dict[str, Library] = {}  # user id -> library
+        self.removed_playlists: Counter = Counter()  # created playlist id -> tracks added
+        self._cache: 'OrderedDict[Tuple[str, int], List[str]]' = OrderedDict()
+
+        self.calls: Counter = Counter()  # (user id, endpoint)
+        self.statuses: Counter = Counter()
+        self._bucket_tokens = server_rate_limit or 0.0
+        self._bucket_updated = time.monotonic()
+
+    def add_user(self, user_id: str, access_token: str):
+        self.tokens[access_token] = user_id
+
+    def add_playlist(self, playlist_id: str, size: int, churn: int):
+        self.playlists[playlist_id] = Library(playlist_id, size, churn)
+
+    def add_liked_songs(self, user_id: str, size: int, churn: int):
+        self.liked_songs[user_id] = Library(f"liked-{user_id}", size, churn)
+
+    def advance(self, change_probability: float) -> int:
+        """Edits each library with the given probability, returns how many changed"""
+        changed = 0
+        for library in list(self.playlists.values()) + list(self.liked_songs.values()):
+            if library.churn and self.rng.random() < change_probability:
+                library.version += 1
+                changed += 1
+        return changed
+
+    def track_ids(self, library: Library) -> List[str]:
+        key = (library.seed, library.version)
+        with self.lock:
+            ids = self._cache.get(key)
+            if ids is not None:
+                self._cache.move_to_end(key)
+                return ids
+        ids = library.track_ids()
+        with self.lock:
+            self._cache[key] = ids
+            while len(self._cache) > LIBRARY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return ids
+
+    def take_rate_limit_token(self) -> bool:
+        if not self.server_rate_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self._bucket_tokens = min(self.server_rate_limit, self._bucket_tokens +
+                                      (now - self._bucket_updated) * self.server_rate_limit)
+            self._bucket_updated = now
+            if self._bucket_tokens < 1:
+                return False
+            self._bucket_tokens -= 1
+            return True
+
+    def record(self, user_id: Optional[str], endpoint: str, status: int):
+        with self.lock:
+            self.calls[(user_id, endpoint)] += 1
+            self.statuses[status] += 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.statuses.clear()
+
+    def calls_by_user(self) -> Dict[str, int]:
+        totals: Counter = Counter()
+        with self.lock:
+            for (user_id, _), count in self.calls.items():
+                if user_id:
+                    totals[user_id] += count
+        return dict(totals)
+
+    def calls_by_endpoint(self) -> Dict[str, int]:
+        totals: Counter = Counter()
+        with self.lock:
+            for (_, endpoint), count in self.calls.items():
+                totals[endpoint] += count
+        return dict(sorted(totals.items()))
+
+
+def _item(tid: str) -> Dict[str, Any]:
+    track = track_info(tid)
+    track['album']['images'] = [{'url': f"https://i.scdn.co/image/{tid}", 'height': 640, 'width': 640}]
+    return {'added_at': ADDED_AT, 'track': track}
+
+
+def _page(world: SpotifyWorld, library: Library, query: Dict[str, List[str]], max_limit: int) -> Dict:
+    limit = min(int(query.get('limit', ['20'])[0]), max_limit)
+    offset = int(query.get('offset', ['0'])[0])
+    ids = world.track_ids(library)
+    return {
+        'items': [_item(tid) for tid in ids[offset:offset + limit]],
+        'total': len(ids),
+        'limit': limit,
+        'offset': offset,
+        'next': None if offset + limit >= len(ids) else f"offset={offset + limit}",
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, as the pooled clients expect
+    # Headers and body are separate writes, Nagle would hold the body back for the delayed ACK
+    disable_nagle_algorithm = True
+    world: SpotifyWorld
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        self._send(status, {'error': {'status': status, 'message': message}}, headers)
+
+    def _body(self) -> Any:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def _handle(self, method: str):
+        world = self.world
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts[:1] == ['v1']:
+            parts = parts[1:]
+        query = parse_qs(url.query)
+        body = self._body() if method in ('POST', 'PUT', 'DELETE') else {}
+        token = (self.headers.get('Authorization') or '').replace('Bearer ', '')
+        user_id = world.tokens.get(token)
+        endpoint = f"{method} {self._route_name(parts)}"
+
+        if world.latency or world.jitter:
+            time.sleep(max(0.0, world.latency + random.uniform(-world.jitter, world.jitter)))
+
+        if user_id is None:
+            status = 401
+            self._error(status, 'Invalid access token')
+        elif not world.take_rate_limit_token() or random.random() < world.rate_429:
+            status = 429
+            self._error(status, 'API rate limit exceeded', {'Retry-After': str(world.retry_after)})
+        elif random.random() < world.error_rate:
+            status = 503
+            self._error(status, 'Service unavailable')
+        else:
+            status, response = self._route(method, parts, query, body, user_id)
+            if status >= 400:
+                self._error(status, response)
+            else:
+                self._send(status, response)
+        world.record(user_id, endpoint, status)
+
+    @staticmethod
+    def _route_name(parts: List[str]) -> str:
+        """The endpoint with ids left out, for per-endpoint counts"""
+        if parts[:1] == ['playlists']:
+            return 'playlists/{id}' + (f"/{'/'.join(parts[2:])}" if len(parts) > 2 else '')
+        if parts[:1] == ['users'] and len(parts) >= 3:
+            return 'users/{id}/' + '/'.join(parts[2:])
+        if parts[:1] == ['artists'] and len(parts) == 2:
+            return 'artists/{id}'
+        return '/'.join(parts)
+
+    def _route(self, method: str, parts: List[str], query: Dict[str, List[str]], body: Dict,
+               user_id: str) -> Tuple[int, Any]:
+        world = self.world
+        ids = query.get('ids', [''])[0].split(',') if 'ids' in query else []
+
+        if method == 'GET' and parts == ['me', 'tracks']:
+            library = world.liked_songs.get(user_id)
+            if library is None:
+                return 200, {'items': [], 'total': 0, 'limit': 50, 'offset': 0, 'next': None}
+            return 200, _page(world, library, query, 50)
+
+        if parts[:1] == ['playlists'] and len(parts) >= 2:
+            playlist_id = parts[1]
+            if len(parts) == 2 and method == 'GET':
+                library = world.playlists.get(playlist_id)
+                if library is None:
+                    return 404, 'Resource not found'
+                return 200, {'id': playlist_id, 'snapshot_id': library.snapshot_id}
+            if parts[2:] == ['tracks']:
+                if method == 'GET':
+                    library = world.playlists.get(playlist_id)
+                    if library is None:
+                        return 404, 'Resource not found'
+                    return 200, _page(world, library, query, 100)
+                if method == 'POST':
+                    # spotipy posts the uris as a bare list
+                    uris = body if isinstance(body, list) else body.get('uris', [])
+                    with world.lock:
+                        world.removed_playlists[playlist_id] += len(uris)
+                    return 201, {'snapshot_id': f"{playlist_id}-added"}
+                if method == 'DELETE':
+                    with world.lock:
+                        world.removed_playlists[playlist_id] -= len(body.get('tracks', []))
+                    return 200, {'snapshot_id': f"{playlist_id}-removed"}
+
+        if method == 'POST' and parts[:1] == ['users'] and parts[2:] == ['playlists']:
+            playlist_id = f"removed{random.getrandbits(64):016x}"
+            with world.lock:
+                world.removed_playlists[playlist_id] += 0
+            return 201, {'id': playlist_id, 'name': body.get('name'), 'snapshot_id': f"{playlist_id}-0"}
+
+        if method == 'GET' and parts == ['me', 'top', 'tracks']:
+            rng = random.Random(f"top-tracks-{user_id}")
+            limit = int(query.get('limit', ['20'])[0])
+            return 200, {'items': [track_info(track_id(rng)) for _ in range(limit)]}
+
+        if method == 'GET' and parts == ['me', 'top', 'artists']:
+            rng = random.Random(f"top-artists-{user_id}")
+            limit = int(query.get('limit', ['20'])[0])
+            artists = [f"artist{i}" for i in rng.sample(range(200), min(limit, 200))]
+            return 200, {'items': [{'id': aid, 'genres': artist_genres(aid)} for aid in artists]}
+
+        if method == 'GET' and parts == ['audio-features']:
+            return 200, {'audio_features': [audio_features(tid) for tid in ids]}
+
+        if method == 'GET' and parts == ['tracks']:
+            return 200, {'tracks': [track_info(tid) for tid in ids]}
+
+        if method == 'GET' and parts == ['artists']:
+            return 200, {'artists': [{'id': aid, 'genres': artist_genres(aid)} for aid in ids]}
+
+        if method == 'GET' and parts[:1] == ['artists'] and len(parts) == 2:
+            return 200, {'id': parts[1], 'genres': artist_genres(parts[1])}
+
+        return 404, 'Service not found'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Every client connection gets a thread, don't refuse bursts of new ones
+    request_queue_size = 1024
+
+
+class FakeSpotifyServer:
+    """Serves world on 127.0.0.1 from a background thread, one thread per connection"""
+
+    def __init__(self, world: SpotifyWorld, port: int = 0):
+        handler = type('WorldHandler', (Handler,), {'world': world})
+        self.world = world
+        self.httpd = _Server(('127.0.0.1', port), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-spotify', daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self) -> 'FakeSpotifyServer':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,351 @@
+"""
+In-memory stand-in for the Supabase client, covering the parts of the
+PostgREST query builder, Storage and Auth admin API the tasks use. Tables are
+indexed on the columns they are filtered by, so 10k users don't turn every
+query into a full scan. Thread-safe, for running tasks on a local worker.
+"""
+import itertools
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from storage3.utils import StorageException
+
+# Columns the database fills in when an insert leaves them out
+TABLE_DEFAULTS = {
+    'Deleted Songs': {'active': True},
+    'Tracked Playlists': {'active': True, 'liked_songs': False, 'public': False},
+}
+# Timestamp columns that advance_clock moves into the past. Spotify Access
+# expires_at is left alone, tokens expire on the real clock
+CLOCK_COLUMNS = {'created_at', 'updated_at', 'removed_at', 'scored_at',
+                 'next_snapshot_at', 'change_rate_updated_at'}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _comparable(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return value
+    return value
+
+
+class Response:
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+
+class Table:
+    def __init__(self, name: str):
+        self.name = name
+        self.rows: Dict[int, Dict] = {}
+        # column -> value -> row ids, built the first time a query filters on the column
+        self.indexes: Dict[str, Dict[Any, Set[int]]] = {}
+        # on_conflict columns -> key -> row id
+        self.unique: Dict[Tuple[str, ...], Dict[Tuple, int]] = {}
+
+    def _index(self, column: str) -> Optional[Dict[Any, Set[int]]]:
+        if column not in self.indexes:
+            index: Dict[Any, Set[int]] = {}
+            try:
+                for row_id, row in self.rows.items():
+                    index.setdefault(row.get(column), set()).add(row_id)
+            except TypeError:  # Unhashable values, e.g. arrays
+                return None
+            self.indexes[column] = index
+        return self.indexes[column]
+
+    def _unique(self, columns: Tuple[str, ...]) -> Dict[Tuple, int]:
+        if columns not in self.unique:
+            self.unique[columns] = {tuple(row.get(c) for c in columns): row_id
+                                    for row_id, row in self.rows.items()}
+        return self.unique[columns]
+
+    def _add_to_indexes(self, row_id: int, row: Dict):
+        for column, index in self.indexes.items():
+            index.setdefault(row.get(column), set()).add(row_id)
+        for columns, unique in self.unique.items():
+            unique[tuple(row.get(c) for c in columns)] = row_id
+
+    def _remove_from_indexes(self, row_id: int, row: Dict):
+        for column, index in self.indexes.items():
+            index.get(row.get(column), set()).discard(row_id)
+        for columns, unique in self.unique.items():
+            unique.pop(tuple(row.get(c) for c in columns), None)
+
+    def insert(self, row: Dict, row_id: int) -> Dict:
+        row = {**TABLE_DEFAULTS.get(self.name, {}), 'created_at': _now(), **row}
+        row.setdefault('id', row_id)
+        self.rows[row['id']] = row
+        self._add_to_indexes(row['id'], row)
+        return row
+
+    def update(self, row_id: int, values: Dict) -> Dict:
+        row = self.rows[row_id]
+        self._remove_from_indexes(row_id, row)
+        row.update(values)
+        self._add_to_indexes(row_id, row)
+        return row
+
+    def delete(self, row_id: int) -> Dict:
+        row = self.rows.pop(row_id)
+        self._remove_from_indexes(row_id, row)
+        return row
+
+    def candidates(self, filters: List[Tuple[str, str, Any]]) -> Iterable[int]:
+        """Row ids that can match, narrowed by the first indexable eq or in_ filter"""
+        for op, column, value in filters:
+            if op not in ('eq', 'in'):
+                continue
+            index = self._index(column)
+            if index is None:
+                continue
+            if op == 'eq':
+                return sorted(index.get(value, ()))
+            return sorted(set().union(*(index.get(v, ()) for v in value)))
+        return list(self.rows)
+
+
+def _matches(row: Dict, filters: List[Tuple[str, str, Any]]) -> bool:
+    for op, column, value in filters:
+        actual = row.get(column)
+        if op == 'eq' and actual != value:
+            return False
+        if op == 'neq' and actual == value:
+            return False
+        if op == 'in' and actual not in value:
+            return False
+        if op == 'is' and not (actual is None if value in (None, 'null') else actual == value):
+            return False
+        if op in ('gt', 'gte', 'lt', 'lte'):
+            if actual is None:
+                return False
+            left, right = _comparable(actual), _comparable(value)
+            if (op == 'gt' and not left > right) or (op == 'gte' and not left >= right) or \
+                    (op == 'lt' and not left < right) or (op == 'lte' and not left <= right):
+                return False
+    return True
+
+
+class Query:
+    """One PostgREST request being built. Results are copies, like rows decoded from a response"""
+
+    def __init__(self, db: 'FakeSupabase', table: str):
+        self.db = db
+        self.table = table
+        self.filters: List[Tuple[str, str, Any]] = []
+        self.method = 'select'
+        self.payload: Any = None
+        self.on_conflict: Optional[str] = None
+        self._order: Optional[Tuple[str, bool]] = None
+        self._limit: Optional[int] = None
+        self._range: Optional[Tuple[int, int]] = None
+        self._single = False
+
+    def _filter(self, op: str, column: str, value: Any) -> 'Query':
+        self.filters.append((op, column, value))
+        return self
+
+    def select(self, *columns, **kwargs) -> 'Query':
+        # Every column is returned, embedded resources (joins) are not supported
+        return self
+
+    def eq(self, column: str, value: Any) -> 'Query':
+        return self._filter('eq', column, value)
+
+    def neq(self, column: str, value: Any) -> 'Query':
+        return self._filter('neq', column, value)
+
+    def in_(self, column: str, values: Iterable) -> 'Query':
+        return self._filter('in', column, set(values))
+
+    def is_(self, column: str, value: Any) -> 'Query':
+        return self._filter('is', column, value)
+
+    def gt(self, column: str, value: Any) -> 'Query':
+        return self._filter('gt', column, value)
+
+    def gte(self, column: str, value: Any) -> 'Query':
+        return self._filter('gte', column, value)
+
+    def lt(self, column: str, value: Any) -> 'Query':
+        return self._filter('lt', column, value)
+
+    def lte(self, column: str, value: Any) -> 'Query':
+        return self._filter('lte', column, value)
+
+    def order(self, column: str, desc: bool = False) -> 'Query':
+        self._order = (column, desc)
+        return self
+
+    def limit(self, count: int) -> 'Query':
+        self._limit = count
+        return self
+
+    def range(self, start: int, end: int) -> 'Query':
+        self._range = (start, end)
+        return self
+
+    def single(self) -> 'Query':
+        self._single = True
+        return self
+
+    def insert(self, payload: Any) -> 'Query':
+        self.method, self.payload = 'insert', payload
+        return self
+
+    def upsert(self, payload: Any, on_conflict: Optional[str] = None, **kwargs) -> 'Query':
+        self.method, self.payload, self.on_conflict = 'upsert', payload, on_conflict
+        return self
+
+    def update(self, payload: Dict) -> 'Query':
+        self.method, self.payload = 'update', payload
+        return self
+
+    def delete(self) -> 'Query':
+        self.method = 'delete'
+        return self
+
+    def execute(self) -> Response:
+        with self.db.lock:
+            self.db.requests[(self.table, self.method)] += 1
+            table = self.db.table_data(self.table)
+            if self.method in ('insert', 'upsert'):
+                return Response([dict(row) for row in self._write(table)])
+
+            matched = [row_id for row_id in table.candidates(self.filters)
+                       if _matches(table.rows[row_id], self.filters)]
+            if self.method == 'update':
+                return Response([dict(table.update(row_id, self.payload)) for row_id in matched])
+            if self.method == 'delete':
+                return Response([table.delete(row_id) for row_id in matched])
+
+            rows = [table.rows[row_id] for row_id in matched]
+            if self._order:
+                column, desc = self._order
+                rows.sort(key=lambda row: (row.get(column) is None, _comparable(row.get(column)) or 0),
+                          reverse=desc)
+            if self._range:
+                rows = rows[self._range[0]:self._range[1] + 1]
+            if self._limit is not None:
+                rows = rows[:self._limit]
+            rows = [dict(row) for row in rows]
+            if self._single:
+                return Response(rows[0] if rows else None)
+            return Response(rows)
+
+    def _write(self, table: Table) -> List[Dict]:
+        items = self.payload if isinstance(self.payload, list) else [self.payload]
+        columns = tuple(c.strip() for c in self.on_conflict.split(',')) if self.on_conflict else ('id',)
+        written = []
+        for item in items:
+            existing = None
+            if self.method == 'upsert':
+                existing = table._unique(columns).get(tuple(item.get(c) for c in columns))
+            if existing is not None:
+                written.append(table.update(existing, item))
+            else:
+                written.append(table.insert(dict(item), next(self.db.ids)))
+        return written
+
+
+class Bucket:
+    def __init__(self, db: 'FakeSupabase', name: str):
+        self.db = db
+        self.name = name
+
+    def upload(self, path: str, file: Any, file_options: Optional[Dict] = None):
+        data = file.read() if hasattr(file, 'read') else bytes(file)
+        with self.db.lock:
+            files = self.db.files.setdefault(self.name, {})
+            if path in files:
+                raise StorageException({'statusCode': 409, 'error': 'Duplicate',
+                                        'message': 'The resource already exists'})
+            files[path] = data
+            self.db.storage_stats['uploads'] += 1
+            self.db.storage_stats['bytes_uploaded'] += len(data)
+        return SimpleNamespace(path=path, full_path=f"{self.name}/{path}")
+
+    def download(self, path: str) -> bytes:
+        with self.db.lock:
+            data = self.db.files.get(self.name, {}).get(path)
+            if data is None:
+                raise StorageException({'statusCode': 404, 'error': 'not_found',
+                                        'message': 'Object not found'})
+            self.db.storage_stats['downloads'] += 1
+            self.db.storage_stats['bytes_downloaded'] += len(data)
+        return data
+
+
+class FakeSupabase:
+    """Drop-in for the supabase client in app.db.supabase"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tables: Dict[str, Table] = {}
+        self.files: Dict[str, Dict[str, bytes]] = {}
+        self.ids = itertools.count(1)
+        self.requests: Counter = Counter()
+        self.storage_stats: Counter = Counter()
+        self.users: Dict[str, Dict] = {}
+        self.storage = SimpleNamespace(from_=lambda bucket: Bucket(self, bucket))
+        self.auth = SimpleNamespace(admin=SimpleNamespace(
+            get_user_by_id=self._get_user_by_id, get_user=self._get_user_by_id))
+
+    def table(self, name: str) -> Query:
+        return Query(self, name)
+
+    def table_data(self, name: str) -> Table:
+        if name not in self.tables:
+            self.tables[name] = Table(name)
+        return self.tables[name]
+
+    def add_user(self, user_id: str, email: str, spotify_user_id: str):
+        self.users[user_id] = {'id': user_id, 'email': email,
+                               'user_metadata': {'provider_id': spotify_user_id}}
+
+    def _get_user_by_id(self, user_id: str):
+        with self.lock:
+            self.requests[('auth', 'get_user_by_id')] += 1
+        user = self.users.get(user_id)
+        if user is None:
+            raise Exception(f"User not found: {user_id}")
+        return SimpleNamespace(user=SimpleNamespace(**user))
+
+    def advance_clock(self, delta: timedelta):
+        """
+        Simulates delta passing by moving every stored timestamp in CLOCK_COLUMNS
+        back by delta, so cadence and expiry checks against the real clock see
+        the rows as that much older.
+        """
+        with self.lock:
+            for table in self.tables.values():
+                for row_id, row in table.rows.items():
+                    shifted = {}
+                    for column in CLOCK_COLUMNS.intersection(row):
+                        value = row[column]
+                        if isinstance(value, str):
+                            shifted[column] = (_comparable(value) - delta).isoformat()
+                    if shifted:
+                        table.update(row_id, shifted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            files = [data for bucket in self.files.values() for data in bucket.values()]
+            return {
+                "rows": {name: len(table.rows) for name, table in sorted(self.tables.items())},
+                "requests": sum(self.requests.values()),
+                "requests_by_table": {f"{table}.{method}": count
+                                      for (table, method), count in sorted(self.requests.items())},
+                "files": len(files),
+                "bytes_stored": sum(len(data) for data in files),
+                **self.storage_stats,
+            }
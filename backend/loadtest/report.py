@@ -0,0 +1,105 @@
+"""Task timings from Celery signals, and the numbers each load test round reports."""
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List
+
+from celery import signals
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile, 0 for no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def distribution(values: Iterable[float]) -> Dict[str, float]:
+    values = list(values)
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4) if values else 0.0,
+        "p50": round(percentile(values, 50), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values, default=0.0), 4),
+    }
+
+
+class TaskRecorder:
+    """
+    Times every task run in this process from task_prerun to task_postrun and
+    counts published messages, so a run on a local worker knows when the
+    queue has drained. Eagerly run tasks are timed including the tasks they
+    call, as those run inline.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started: Dict[str, float] = {}
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.states: Counter = Counter()
+        self.published = 0
+        self.finished = 0
+
+    def connect(self):
+        signals.before_task_publish.connect(self._published, weak=False)
+        signals.task_prerun.connect(self._prerun, weak=False)
+        signals.task_postrun.connect(self._postrun, weak=False)
+
+    def _published(self, sender=None, **kwargs):
+        with self.lock:
+            self.published += 1
+
+    def _prerun(self, task_id=None, task=None, **kwargs):
+        with self.lock:
+            self.started[task_id] = time.perf_counter()
+
+    def _postrun(self, task_id=None, task=None, state=None, **kwargs):
+        with self.lock:
+            started = self.started.pop(task_id, None)
+            if started is not None:
+                self.durations[task.name.rsplit('.', 1)[-1]].append(time.perf_counter() - started)
+            self.states[state] += 1
+            self.finished += 1
+
+    def pending(self) -> int:
+        """Messages published but not yet run, counting retries and countdowns"""
+        with self.lock:
+            return self.published - self.finished
+
+    def reset(self):
+        with self.lock:
+            self.durations.clear()
+            self.states.clear()
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "latency_seconds": {name: distribution(values) for name, values in sorted(self.durations.items())},
+                "states": dict(self.states),
+            }
+
+
+def print_round(report: Dict[str, Any]):
+    throughput = report["throughput"]
+    api = report["spotify_api"]
+    db = report["supabase"]
+    print(f"\n== {report['name']} ({report['wall_seconds']:.1f}s) ==")
+    print(f"users {throughput['users']}, snapshots {throughput['snapshots']}, "
+          f"{throughput['users_per_second']:.1f} users/s, {throughput['snapshots_per_second']:.1f} snapshots/s, "
+          f"{throughput['tasks_per_second']:.1f} tasks/s")
+    per_user = api["calls_per_user"]
+    print(f"spotify calls {api['calls']}, per user mean {per_user['mean']} p50 {per_user['p50']} "
+          f"p99 {per_user['p99']} max {per_user['max']}, statuses {api['statuses']}")
+    for endpoint, count in api["calls_by_endpoint"].items():
+        print(f"  {endpoint:<40} {count}")
+    print(f"supabase requests {db['requests']}, stored {db['bytes_stored_delta']} bytes in "
+          f"{db['files_delta']} files (total {db['bytes_stored']} bytes, {db['files']} files)")
+    for name, latency in report["tasks"]["latency_seconds"].items():
+        print(f"  {name:<30} n={latency['count']:<6} p50 {latency['p50'] * 1000:.1f}ms "
+              f"p99 {latency['p99'] * 1000:.1f}ms max {latency['max'] * 1000:.1f}ms")
+    if report["tasks"]["states"]:
+        print(f"task states {report['tasks']['states']}")
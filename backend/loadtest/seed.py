@@ -0,0 +1,77 @@
+"""Synthetic users: their Supabase rows and their Spotify libraries."""
+import math
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from loadtest.fake_spotify import SpotifyWorld
+from loadtest.fake_supabase import FakeSupabase
+
+
+def library_size(rng: random.Random, mean_songs: int, max_songs: int) -> int:
+    # Log-normal: most libraries are small, a long tail is very large
+    sigma = 1.0
+    mu = math.log(mean_songs) - sigma ** 2 / 2
+    return max(1, min(max_songs, int(rng.lognormvariate(mu, sigma))))
+
+
+def seed_users(db: FakeSupabase, world: SpotifyWorld, users: int, playlists_per_user: int,
+               liked_songs_fraction: float, mean_songs: int, max_songs: int, churn: float,
+               expiring_fraction: float, suggestion_fraction: float, seed: int = 0) -> List[str]:
+    """Creates users with valid tokens and tracked playlists, returns their ids"""
+    rng = random.Random(seed)
+    expires_at = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+    user_ids = []
+    settings_rows, access_rows, playlist_rows = [], [], []
+
+    for index in range(users):
+        user_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        spotify_user_id = f"spotify{index:06d}"
+        access_token = f"loadtest-{user_id}"
+        user_ids.append(user_id)
+        db.add_user(user_id, f"{spotify_user_id}@loadtest.invalid", spotify_user_id)
+        world.add_user(user_id, access_token)
+
+        settings_rows.append({
+            'user_id': user_id,
+            'snapshots_enabled': True,
+            'suggestion_emails': rng.random() < suggestion_fraction,
+            'playlist_persistence': '30 days' if rng.random() < expiring_fraction else 'forever',
+            'remove_from_playlist': True,
+        })
+        access_rows.append({
+            'user_id': user_id,
+            'access_token': access_token,
+            'refresh_token': f"refresh-{user_id}",
+            'expires_at': expires_at,
+        })
+
+        for number in range(playlists_per_user):
+            playlist_id = f"pl{index:06d}n{number}"
+            size = library_size(rng, mean_songs, max_songs)
+            world.add_playlist(playlist_id, size, max(1, round(size * churn)))
+            playlist_rows.append({
+                'user_id': user_id,
+                'playlist_id': playlist_id,
+                'playlist_name': f"Playlist {number}",
+                'removed_playlist_name': f"Playlist {number} (Removed)",
+                'liked_songs': False,
+            })
+
+        if rng.random() < liked_songs_fraction:
+            size = library_size(rng, mean_songs, max_songs)
+            world.add_liked_songs(user_id, size, max(1, round(size * churn)))
+            playlist_rows.append({
+                'user_id': user_id,
+                'playlist_id': 'liked_songs',
+                'playlist_name': 'Liked Songs',
+                'removed_playlist_name': 'Liked Songs (Removed)',
+                'liked_songs': True,
+            })
+
+    db.table('User Settings').insert(settings_rows).execute()
+    db.table('Spotify Access').insert(access_rows).execute()
+    db.table('Tracked Playlists').insert(playlist_rows).execute()
+    db.requests.clear()
+    return user_ids
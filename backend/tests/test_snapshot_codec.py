@@ -0,0 +1,41 @@
+import numpy as np
+
+from app.services.snapshot_codec import (decode_snapshot, decode_track_ids, diff_track_ids, encode_snapshot,
+                                         encode_track_id, encode_track_ids, is_track_id)
+
+VALID_IDS = ['4uLU6hMCjMI75M1A2tKUQC', '0000000000000000000000', '7GhIk7Il098yCjg4BQjzvb']
+# Wrong length, not base62, and base62 but above 2**128
+MALFORMED_IDS = ['4uLU6hMCjMI75M1A2tKUQ', '4uLU6hMCjMI75M1A2tKU-C', 'ZZZZZZZZZZZZZZZZZZZZZZ', '', None]
+
+
+def track(track_id, name='name'):
+    return {'id': track_id, 'name': name, 'artist': 'artist', 'album': 'album',
+            'added_at': '2024-03-01T10:00:00Z', 'image': None}
+
+
+def test_is_track_id():
+    assert all(is_track_id(track_id) for track_id in VALID_IDS)
+    assert not any(is_track_id(track_id) for track_id in MALFORMED_IDS)
+
+
+def test_track_ids_round_trip():
+    assert decode_track_ids(encode_track_ids(VALID_IDS)) == sorted(VALID_IDS, key=encode_track_id)
+
+
+def test_encode_track_ids_skips_malformed_ids():
+    ids = encode_track_ids(VALID_IDS + MALFORMED_IDS)
+    assert sorted(decode_track_ids(ids)) == sorted(VALID_IDS)
+
+
+def test_diff_ignores_malformed_ids():
+    previous_ids = encode_track_ids(VALID_IDS + MALFORMED_IDS)
+    current_ids = encode_track_ids(VALID_IDS[1:] + MALFORMED_IDS[:2])
+    assert decode_track_ids(diff_track_ids(previous_ids, current_ids)) == VALID_IDS[:1]
+    assert len(diff_track_ids(current_ids, previous_ids)) == 0
+
+
+def test_encode_snapshot_skips_malformed_ids():
+    tracks = [track(VALID_IDS[0]), track(MALFORMED_IDS[1]), track(VALID_IDS[1]), track(MALFORMED_IDS[2])]
+    decoded = decode_snapshot(encode_snapshot(tracks))
+    assert [decoded_track['id'] for decoded_track in decoded] == VALID_IDS[:2]
+    assert np.array_equal(encode_track_ids(t['id'] for t in decoded), encode_track_ids(VALID_IDS[:2]))
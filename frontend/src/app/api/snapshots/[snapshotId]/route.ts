@@ -22,7 +22,156 @@ export type SnapshotDetailResponse = {
   tracks: Track[]
 }
 
+type SnapshotDelta = {
+  format: 'delta'
+  base: string
+  added: { index: number; track: Track }[]
+  removed: Track[]
+  // Previous index of every kept track, only when tracks moved or repeat
+  order?: number[]
+}
+
 const gunzipAsync = promisify(gunzip)
+
+// Guards against broken chains, matches MAX_DELTA_CHAIN in the backend
+const MAX_DELTA_CHAIN = 100
+
+// Binary keyframe layout, see backend/app/services/snapshot_codec.py
+const BINARY_MAGIC = 'TKSNAP'
+const BINARY_VERSION = 2
+const BINARY_HEADER_SIZE = 20
+const BINARY_POSITIONS_SIZE = 4
+const BINARY_ID_SIZE = 16
+const BINARY_FLAG_METADATA = 0x01
+const BINARY_MISSING_ADDED_AT = BigInt('-9223372036854775808')
+const BASE62_ALPHABET =
+  '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+function decodeTrackId(buffer: Buffer, offset: number): string {
+  let value = BigInt(0)
+  for (let i = 0; i < BINARY_ID_SIZE; i++) {
+    value = value * BigInt(256) + BigInt(buffer[offset + i])
+  }
+  let id = ''
+  for (let i = 0; i < 22; i++) {
+    id = BASE62_ALPHABET[Number(value % BigInt(62))] + id
+    value = value / BigInt(62)
+  }
+  return id
+}
+
+// Version 2 stores each id once and an order section with the index into the
+// ids of every track, added_at and metadata follow that order. Version 1 has
+// neither the track count nor the order, its tracks are the ids
+async function decodeBinarySnapshot(buffer: Buffer): Promise<Track[] | null> {
+  const version = buffer.readUInt8(6)
+  const flags = buffer.readUInt8(7)
+  const count = buffer.readUInt32BE(8)
+  const metadataLength = Number(buffer.readBigUInt64BE(12))
+
+  let positions = count
+  let idsOffset = BINARY_HEADER_SIZE
+  if (version === BINARY_VERSION) {
+    positions = buffer.readUInt32BE(BINARY_HEADER_SIZE)
+    idsOffset += BINARY_POSITIONS_SIZE
+  } else if (version !== 1) {
+    console.error('Unsupported binary snapshot version: ', version)
+    return null
+  }
+  const orderOffset = idsOffset + count * BINARY_ID_SIZE
+  const addedAtOffset =
+    version === BINARY_VERSION ? orderOffset + positions * 4 : orderOffset
+  const metadataOffset = addedAtOffset + positions * 8
+
+  // Repeated tracks share their id, so each one is decoded once
+  const ids: string[] = []
+  for (let i = 0; i < count; i++) {
+    ids.push(decodeTrackId(buffer, idsOffset + i * BINARY_ID_SIZE))
+  }
+
+  let metadata: (string | null)[][] = []
+  if (flags & BINARY_FLAG_METADATA) {
+    const uncompressedMetadata = await gunzipAsync(
+      buffer.subarray(metadataOffset, metadataOffset + metadataLength)
+    )
+    metadata = JSON.parse(uncompressedMetadata.toString())
+  }
+
+  const tracks: Track[] = []
+  for (let i = 0; i < positions; i++) {
+    const [name, artist, album, image] = metadata[i] ?? []
+    const addedAt = buffer.readBigInt64BE(addedAtOffset + i * 8)
+    const index =
+      version === BINARY_VERSION ? buffer.readUInt32BE(orderOffset + i * 4) : i
+    tracks.push({
+      id: ids[index],
+      name: name ?? '',
+      artist: artist ?? '',
+      album: album ?? '',
+      image: image ?? '',
+      added_at:
+        addedAt === BINARY_MISSING_ADDED_AT
+          ? ''
+          : new Date(Number(addedAt) * 1000).toISOString(),
+    })
+  }
+  return tracks
+}
+
+async function downloadSnapshotFile(
+  supabase: Awaited<ReturnType<typeof createServerClient>>,
+  path: string
+): Promise<Track[] | SnapshotDelta | null> {
+  const { data, error } = await supabase.storage
+    .from('user-snapshots')
+    .download(path)
+  if (error || !data) {
+    return null
+  }
+  const buffer = Buffer.from(await data.arrayBuffer())
+  if (buffer.subarray(0, BINARY_MAGIC.length).toString() === BINARY_MAGIC) {
+    return decodeBinarySnapshot(buffer)
+  }
+  const uncompressedData = await gunzipAsync(buffer)
+  return JSON.parse(uncompressedData.toString())
+}
+
+// Delta snapshots only store changes against the previous snapshot, so walk
+// back to the last full keyframe and replay the deltas on top of it
+async function loadSnapshotTracks(
+  supabase: Awaited<ReturnType<typeof createServerClient>>,
+  path: string
+): Promise<Track[] | null> {
+  const chain: SnapshotDelta[] = []
+  let payload = await downloadSnapshotFile(supabase, path)
+  while (payload && !Array.isArray(payload) && payload.format === 'delta') {
+    chain.push(payload)
+    if (chain.length > MAX_DELTA_CHAIN) {
+      return null
+    }
+    payload = await downloadSnapshotFile(supabase, payload.base)
+  }
+  if (!payload || !Array.isArray(payload)) {
+    return null
+  }
+
+  let tracks = payload
+  for (const delta of chain.reverse()) {
+    if (delta.order) {
+      const kept = tracks
+      tracks = delta.order.map((index) => kept[index])
+    } else {
+      const removedIds = new Set(delta.removed.map((track) => track.id))
+      tracks = tracks.filter((track) => !removedIds.has(track.id))
+    }
+    const added = [...delta.added].sort((a, b) => a.index - b.index)
+    for (const { index, track } of added) {
+      tracks.splice(index, 0, track)
+    }
+  }
+  return tracks
+}
+
 export async function GET(
   request: NextRequest,
   props: { params: Promise<{ snapshotId: string }> }
@@ -62,21 +211,15 @@ export async function GET(
   console.log('Snapshot: ', snapshot)
 
   // Download the gzipped data from Supabase storage
-  const { data: gzippedData, error: downloadError } = await supabase.storage
-    .from('user-snapshots')
-    .download(`${snapshot.snapshot_id}`)
+  const tracks = await loadSnapshotTracks(supabase, `${snapshot.snapshot_id}`)
 
-  if (downloadError || !gzippedData) {
+  if (!tracks) {
     return NextResponse.json(
       { error: 'Failed to download snapshot data' },
       { status: 500 }
     )
   }
 
-  const buffer = await gzippedData.arrayBuffer()
-  const uncompressedData = await gunzipAsync(Buffer.from(buffer))
-  const tracks = JSON.parse(uncompressedData.toString())
-
   return NextResponse.json(
     {
       snapshot,
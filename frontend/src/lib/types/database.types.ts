@@ -45,28 +45,37 @@ export type Database = {
       "Deleted Songs": {
         Row: {
           active: boolean
+          avg_similarity: number | null
           created_at: string
           id: number
+          max_similarity: number | null
           playlist_id: number
           removed_at: string
+          scored_at: string | null
           track_id: string | null
           user_id: string
         }
         Insert: {
           active?: boolean
+          avg_similarity?: number | null
           created_at?: string
           id?: number
+          max_similarity?: number | null
           playlist_id: number
           removed_at: string
+          scored_at?: string | null
           track_id?: string | null
           user_id: string
         }
         Update: {
           active?: boolean
+          avg_similarity?: number | null
           created_at?: string
           id?: number
+          max_similarity?: number | null
           playlist_id?: number
           removed_at?: string
+          scored_at?: string | null
           track_id?: string | null
           user_id?: string
         }
@@ -94,6 +103,7 @@ export type Database = {
           playlist_id: number | null
           snapshot_id: string | null
           song_count: number | null
+          spotify_snapshot_id: string | null
           user_id: string
         }
         Insert: {
@@ -102,6 +112,7 @@ export type Database = {
           playlist_id?: number | null
           snapshot_id?: string | null
           song_count?: number | null
+          spotify_snapshot_id?: string | null
           user_id: string
         }
         Update: {
@@ -110,6 +121,7 @@ export type Database = {
           playlist_id?: number | null
           snapshot_id?: string | null
           song_count?: number | null
+          spotify_snapshot_id?: string | null
           user_id?: string
         }
         Relationships: [
@@ -149,41 +161,80 @@ export type Database = {
         }
         Relationships: []
       }
+      "Taste Profiles": {
+        Row: {
+          created_at: string
+          id: number
+          top_artist_ids: string[]
+          top_track_ids: string[]
+          updated_at: string
+          user_id: string
+        }
+        Insert: {
+          created_at?: string
+          id?: number
+          top_artist_ids: string[]
+          top_track_ids: string[]
+          updated_at?: string
+          user_id: string
+        }
+        Update: {
+          created_at?: string
+          id?: number
+          top_artist_ids?: string[]
+          top_track_ids?: string[]
+          updated_at?: string
+          user_id?: string
+        }
+        Relationships: []
+      }
       "Tracked Playlists": {
         Row: {
           active: boolean
+          change_rate: number | null
+          change_rate_updated_at: string | null
           created_at: string
           id: number
           liked_songs: boolean
+          next_snapshot_at: string | null
           playlist_id: string
           playlist_name: string
           public: boolean
           removed_playlist_id: string | null
           removed_playlist_name: string | null
+          song_count: number | null
           user_id: string
         }
         Insert: {
           active?: boolean
+          change_rate?: number | null
+          change_rate_updated_at?: string | null
           created_at?: string
           id?: number
           liked_songs?: boolean
+          next_snapshot_at?: string | null
           playlist_id: string
           playlist_name: string
           public?: boolean
           removed_playlist_id?: string | null
           removed_playlist_name?: string | null
+          song_count?: number | null
           user_id: string
         }
         Update: {
           active?: boolean
+          change_rate?: number | null
+          change_rate_updated_at?: string | null
           created_at?: string
           id?: number
           liked_songs?: boolean
+          next_snapshot_at?: string | null
           playlist_id?: string
           playlist_name?: string
           public?: boolean
           removed_playlist_id?: string | null
           removed_playlist_name?: string | null
+          song_count?: number | null
           user_id?: string
         }
         Relationships: []